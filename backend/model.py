@@ -1,193 +1,726 @@
+import os
 import sys
 import json
+import hashlib
+import time
+import threading
+from contextlib import ExitStack
 import torch
 import torch.nn as nn
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import io
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
 from sklearn.preprocessing import MinMaxScaler
 from torch.utils.data import DataLoader, TensorDataset
 from torch.optim.lr_scheduler import CosineAnnealingLR
 
-# 1. Set backend to 'Agg' to prevent GUI errors
-plt.switch_backend('Agg')
+# Plots are drawn on standalone Figure objects (Agg canvas, no GUI) rather
+# than through pyplot's global state, so --serve can run requests in threads.
+SERVE_WORKERS = int(os.getenv("MODEL_SERVE_WORKERS", "4"))
 
-def predict_disease(file_path, disease_name):
-    # --- GPU CONFIGURATION ---
-    # This automatically uses the GPU if available
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# --- GPU CONFIGURATION ---
+# This automatically uses the GPU if available
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    # Hyperparameters
-    LOOK_BACK = 15
-    BATCH_SIZE = 16
-    EPOCHS = 100 
-    LEARNING_RATE = 0.001
+# Hyperparameters (environment, or e.g. --epochs 50 on the command line)
+LOOK_BACK = int(os.getenv("MODEL_LOOK_BACK", "15"))
+BATCH_SIZE = int(os.getenv("MODEL_BATCH_SIZE", "16"))
+EPOCHS = int(os.getenv("MODEL_EPOCHS", "100"))  # upper bound; early stopping usually ends sooner
+LEARNING_RATE = 0.001
 
-    # --- Data Processing ---
-    records = []
+# Early stopping: the windows predicting the most recent weeks are held out,
+# training stops once their loss has not improved for PATIENCE epochs, and
+# the best epoch's weights are restored. With REFIT=1 the model is then
+# refitted from its initial weights on every window for the best epoch
+# count, so the held-out weeks are learned too (about twice the training time).
+VALIDATION_WEEKS = int(os.getenv("MODEL_VALIDATION_WEEKS", "8"))
+PATIENCE = int(os.getenv("MODEL_PATIENCE", "20"))
+REFIT = int(os.getenv("MODEL_REFIT", "0"))
+
+TRAINING_OPTIONS = {
+    "--look-back": "LOOK_BACK",
+    "--batch-size": "BATCH_SIZE",
+    "--epochs": "EPOCHS",
+    "--validation-weeks": "VALIDATION_WEEKS",
+    "--patience": "PATIENCE",
+    "--refit": "REFIT",
+}
+
+# Trained-model registry: weights and scaler range per disease, so unchanged
+# data is answered from cache and a few new weeks only cost a fine-tune.
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_cache"))
+FINE_TUNE_EPOCHS = 10
+MAX_NEW_WEEKS = 8  # more new weeks than this since the cached model -> train from scratch
+MAX_FINE_TUNES = 12  # consecutive fine-tunes before a full retrain, so the model cannot drift forever
+SCALER_SLACK = 0.1  # new values may exceed the cached scaler range by this share of it
+
+# Batch forecasts train one MultiDiseaseLSTM over every series that needs it,
+# with batches large enough to keep torch's intra-op threads busy.
+SHARED_BATCH_SIZE = 256
+DISEASE_EMBED_DIM = 8
+
+
+# --- LSTM Model ---
+class InfluenzaLSTM(nn.Module):
+    def __init__(self, input_size=1, hidden_size=64, output_size=1):
+        super(InfluenzaLSTM, self).__init__()
+        self.lstm = nn.LSTM(input_size, hidden_size, num_layers=2, batch_first=True, dropout=0.2)
+        self.linear = nn.Linear(hidden_size, output_size)
+
+    def forward(self, x):
+        out, _ = self.lstm(x)
+        last_step = out[:, -1, :]
+        prediction = self.linear(last_step)
+        return prediction
+
+
+class MultiDiseaseLSTM(nn.Module):
+    """One LSTM for several diseases: every time step sees the scaled count plus a learned disease embedding."""
+    def __init__(self, n_diseases, embed_dim=DISEASE_EMBED_DIM, hidden_size=64, output_size=1):
+        super(MultiDiseaseLSTM, self).__init__()
+        self.embedding = nn.Embedding(n_diseases, embed_dim)
+        self.lstm = nn.LSTM(1 + embed_dim, hidden_size, num_layers=2, batch_first=True, dropout=0.2)
+        self.linear = nn.Linear(hidden_size, output_size)
+
+    def forward(self, x, disease):
+        disease_steps = self.embedding(disease).unsqueeze(1).expand(-1, x.size(1), -1)
+        out, _ = self.lstm(torch.cat([x, disease_steps], dim=2))
+        return self.linear(out[:, -1, :])
+
+
+def _read_records(file_path):
+    """Raw export rows as a DataFrame: one bulk read, line by line only if a line is malformed."""
     try:
+        return pd.read_json(file_path, lines=True, dtype=False)
+    except ValueError:
+        rows = []
         with open(file_path, 'r') as f:
             for line in f:
                 if not line.strip(): continue
                 try:
-                    patient = json.loads(line)
-                    
-                    # Normalize and find diagnosis
-                    diagnosis = patient.get('diagnosis', '')
-                    if not diagnosis and 'final_diagnostic' in patient:
-                         diagnosis = patient['final_diagnostic'].get('most_probable_diagnostic', '')
-                    
-                    # Case-insensitive check
-                    if disease_name.lower() in str(diagnosis).lower():
-                        date_str = patient.get('date') or patient.get('report_date')
-                        if date_str:
-                            records.append({'date': date_str})
-                    
-                    # REMOVED print("processed data") - This breaks Node.js
+                    rows.append(json.loads(line))
                 except json.JSONDecodeError:
                     continue
-    except FileNotFoundError:
-        return None, None, "Data file not found"
+        return pd.DataFrame(rows)
+
 
-    if not records:
-        return 0, None, None # No data found
+def load_export(file_path):
+    """(label, date) per usable record; labels are stripped and lower-cased once here."""
+    df = _read_records(file_path)
+    empty = pd.DataFrame({'label': pd.Series(dtype=str), 'date': pd.Series(dtype='datetime64[ns, UTC]')})
+    if df.empty:
+        return empty
 
-    df_raw = pd.DataFrame(records)
-    df_raw['date'] = pd.to_datetime(df_raw['date'], utc=True)
-    df_raw = df_raw.sort_values('date')
+    # Normalize and find diagnosis
+    label = df['diagnosis'] if 'diagnosis' in df else pd.Series('', index=df.index)
+    if 'final_diagnostic' in df:
+        fallback = df['final_diagnostic'].map(lambda d: d.get('most_probable_diagnostic', '') if isinstance(d, dict) else '')
+        label = label.where(label.notna() & (label != ''), fallback)
+    date = df['date'] if 'date' in df else pd.Series(None, index=df.index, dtype=object)
+    if 'report_date' in df:
+        date = date.where(date.notna() & (date != ''), df['report_date'])
 
+    records = pd.DataFrame({
+        'label': label.fillna('').astype(str).str.strip().str.lower(),
+        # Exports mix naive and UTC ("...Z") timestamps, so no single format can be inferred
+        'date': pd.to_datetime(date, utc=True, errors='coerce', format='ISO8601'),
+    })
+    records = records[(records['label'] != '') & records['date'].notna()]
+    return records if not records.empty else empty
+
+
+def weekly_matrix(records):
+    """Disease x week matrix of case counts (rows: labels, columns: every W-MON week in the export)."""
+    if records.empty:
+        return pd.DataFrame(dtype=float)
     # Aggregate to Weekly counts
-    df_weekly = df_raw.groupby(pd.Grouper(key='date', freq='W-MON')).size().reset_index(name='cases')
-    df_weekly.set_index('date', inplace=True)
-    
+    counts = records.groupby(['label', pd.Grouper(key='date', freq='W-MON')]).size()
+    matrix = counts.unstack('date', fill_value=0)
     # Fill missing weeks with 0
-    if not df_weekly.empty:
-        full_idx = pd.date_range(start=df_weekly.index.min(), end=df_weekly.index.max(), freq='W-MON')
-        df_weekly = df_weekly.reindex(full_idx, fill_value=0)
-    
-    # Smoothing
-    df_weekly['cases'] = df_weekly['cases'].rolling(window=4, min_periods=1).mean()
-    
-    # Prepare for LSTM
-    raw_values = df_weekly['cases'].values.reshape(-1, 1)
-    
-    # Not enough data fallback
-    if len(raw_values) < LOOK_BACK + 2:
-         return int(raw_values[-1][0]) if len(raw_values) > 0 else 0, None, None
+    full_idx = pd.date_range(start=matrix.columns.min(), end=matrix.columns.max(), freq='W-MON')
+    return matrix.reindex(columns=full_idx, fill_value=0).astype(float)
 
-    scaler = MinMaxScaler(feature_range=(0, 1))
-    scaled_data = scaler.fit_transform(raw_values)
-
-    def create_sequences(data, seq_length):
-        xs, ys = [], []
-        if len(data) <= seq_length:
-            return np.array([]), np.array([])
-        for i in range(len(data) - seq_length):
-            x = data[i:(i + seq_length)]
-            y = data[i + seq_length]
-            xs.append(x)
-            ys.append(y)
-        return np.array(xs), np.array(ys)
 
-    X, y = create_sequences(scaled_data, LOOK_BACK)
-    
-    X_tensor = torch.from_numpy(X).float()
-    y_tensor = torch.from_numpy(y).float()
-
-    # --- LSTM Model ---
-    class InfluenzaLSTM(nn.Module):
-        def __init__(self, input_size=1, hidden_size=64, output_size=1):
-            super(InfluenzaLSTM, self).__init__()
-            self.lstm = nn.LSTM(input_size, hidden_size, num_layers=2, batch_first=True, dropout=0.2)
-            self.linear = nn.Linear(hidden_size, output_size)
-
-        def forward(self, x):
-            out, _ = self.lstm(x)
-            last_step = out[:, -1, :]
-            prediction = self.linear(last_step)
-            return prediction
-
-    model = InfluenzaLSTM().to(device) # Move model to GPU
+_exports = {}  # file path -> ((mtime, size), weekly matrix)
+_exports_lock = threading.Lock()
+
+
+def export_matrix(file_path):
+    """(weekly matrix of an export, error); reused until the file changes, so batches read it once."""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None, "Data file not found"
+    signature = (st.st_mtime_ns, st.st_size)
+    with _exports_lock:
+        cached = _exports.get(file_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1], None
+        matrix = weekly_matrix(load_export(file_path))
+        _exports[file_path] = (signature, matrix)
+    return matrix, None
+
+
+def disease_series(matrix, disease_name):
+    """Weekly counts of every label containing disease_name (case-insensitive), first to last case."""
+    if matrix.empty:
+        return pd.Series(dtype=float)
+    rows = matrix.index.str.contains(disease_name.strip().lower(), regex=False)
+    weekly = matrix[rows].sum(axis=0)
+    seen = np.flatnonzero(weekly.values)
+    if not len(seen):
+        return pd.Series(dtype=float)
+    return weekly.iloc[seen[0]:seen[-1] + 1]
+
+
+def weekly_cases(file_path, disease_name):
+    """(weekly case counts as a Series indexed by week, error); counts are raw, not smoothed."""
+    matrix, err = export_matrix(file_path)
+    if err:
+        return None, err
+    return disease_series(matrix, disease_name), None
+
+
+def create_sequences(data, seq_length):
+    xs, ys = [], []
+    if len(data) <= seq_length:
+        return np.array([]), np.array([])
+    for i in range(len(data) - seq_length):
+        x = data[i:(i + seq_length)]
+        y = data[i + seq_length]
+        xs.append(x)
+        ys.append(y)
+    return np.array(xs), np.array(ys)
+
+
+def validation_loss(model, dataset):
+    model.eval()
+    *inputs, label = [t.to(DEVICE) for t in dataset.tensors]
+    with torch.no_grad():
+        return nn.functional.mse_loss(model(*inputs), label).item()
+
+
+def fit(model, train_dataset, epochs, batch_size=None, val_dataset=None, early_stopping=True):
+    """Trains model in place; returns (epochs run, best epoch, best loss).
+
+    The datasets yield (*inputs, label) and model(*inputs) predicts label.
+    Training stops once the validation loss (the training loss if there is
+    no validation set) has not improved for PATIENCE epochs, and the
+    weights of the best epoch are restored. Without early_stopping all
+    epochs run and the final weights are kept.
+    """
     criterion = nn.MSELoss()
     optimizer = torch.optim.AdamW(model.parameters(), lr=LEARNING_RATE)
     
     # REMOVED print("started training") - This breaks Node.js
 
     # --- Training ---
-    train_dataset = TensorDataset(X_tensor, y_tensor)
-    train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size or BATCH_SIZE, shuffle=True)
 
-    model.train()
-    for epoch in range(EPOCHS):
-        for seq, label in train_loader:
+    best_loss, best_state, best_epoch, stale, epochs_run = float("inf"), None, 0, 0, 0
+    for epoch in range(epochs):
+        model.train()
+        train_loss = 0.0
+        for *inputs, label in train_loader:
             # Move data to GPU
-            seq, label = seq.to(device), label.to(device)
+            inputs, label = [t.to(DEVICE) for t in inputs], label.to(DEVICE)
             
             optimizer.zero_grad()
-            output = model(seq)
+            output = model(*inputs)
             loss = criterion(output, label)
             loss.backward()
             optimizer.step()
+            train_loss += loss.item() * len(label)
+        epochs_run = epoch + 1
+
+        epoch_loss = validation_loss(model, val_dataset) if val_dataset is not None else train_loss / len(train_dataset)
+        if not early_stopping:
+            best_loss, best_epoch = epoch_loss, epochs_run
+        elif epoch_loss < best_loss:
+            best_loss, best_epoch, stale = epoch_loss, epochs_run, 0
+            best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+        else:
+            stale += 1
+            if stale >= PATIENCE:
+                break
+
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    return epochs_run, best_epoch, best_loss
+
+
+def fit_validated(model, dataset, val_dataset, epochs, batch_size=None):
+    """fit() with early stopping on val_dataset, keeping the best epoch's weights; returns
+    (epochs run, refit epochs, best loss).
+
+    With REFIT the model is then refitted from the same initial weights on
+    dataset + val_dataset for the best epoch count. Without a validation set
+    the model is fitted once, early-stopping on the training loss.
+    """
+    if val_dataset is None or not REFIT:
+        epochs_run, _, best_loss = fit(model, dataset, epochs, batch_size, val_dataset=val_dataset)
+        return epochs_run, 0, best_loss
+    initial = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    epochs_run, best_epoch, best_loss = fit(model, dataset, epochs, batch_size, val_dataset=val_dataset)
+    model.load_state_dict(initial)
+    everything = TensorDataset(*(torch.cat(parts) for parts in zip(dataset.tensors, val_dataset.tensors)))
+    fit(model, everything, best_epoch, batch_size, early_stopping=False)
+    return epochs_run, best_epoch, best_loss
+
+
+def split_windows(scaled_data):
+    """(X, y, validation windows): the last VALIDATION_WEEKS windows, or none if the series is too short to spare them."""
+    X, y = create_sequences(scaled_data, LOOK_BACK)
+    n_val = VALIDATION_WEEKS if len(X) >= 3 * VALIDATION_WEEKS else 0
+    return torch.from_numpy(X).float(), torch.from_numpy(y).float(), n_val
+
+
+def train_model(model, scaled_data, epochs, new_windows=None):
+    """Trains model in place on the LOOK_BACK-week windows of scaled_data; returns (epochs run, refit epochs, best loss).
+
+    With new_windows (a fine-tune) only the last new_windows windows are
+    trained on, early-stopping on their training loss.
+    """
+    X, y, n_val = split_windows(scaled_data)
+    if new_windows is not None:
+        epochs_run, _, best_loss = fit(model, TensorDataset(X[-new_windows:], y[-new_windows:]), epochs)
+        return epochs_run, 0, best_loss
+    n_train = len(X) - n_val
+    val_dataset = TensorDataset(X[n_train:], y[n_train:]) if n_val else None
+    return fit_validated(model, TensorDataset(X[:n_train], y[:n_train]), val_dataset, epochs)
+
+
+def train_shared(scaled_series, epochs):
+    """MultiDiseaseLSTM trained on the windows of every scaled series at once; series i is disease i.
+
+    Returns (model, epochs run, refit epochs, best loss); each series holds out its own most recent windows.
+    """
+    train_parts, val_parts = [], []
+    for i, scaled_data in enumerate(scaled_series):
+        X, y, n_val = split_windows(scaled_data)
+        d = torch.full((len(X),), i, dtype=torch.long)
+        n_train = len(X) - n_val
+        train_parts.append((X[:n_train], d[:n_train], y[:n_train]))
+        if n_val:
+            val_parts.append((X[n_train:], d[n_train:], y[n_train:]))
+    dataset = TensorDataset(*(torch.cat(parts) for parts in zip(*train_parts)))
+    val_dataset = TensorDataset(*(torch.cat(parts) for parts in zip(*val_parts))) if val_parts else None
+    model = MultiDiseaseLSTM(len(scaled_series)).to(DEVICE)
+    epochs_run, refit_epochs, best_loss = fit_validated(model, dataset, val_dataset, epochs, batch_size=SHARED_BATCH_SIZE)
+    return model, epochs_run, refit_epochs, best_loss
+
+
+def forecast_shared(model, scalers, scaled_series):
+    """Next week's cases for every disease of a MultiDiseaseLSTM, in one forward pass."""
+    model.eval()
+    last_sequences = torch.tensor(np.stack([s[-LOOK_BACK:] for s in scaled_series])).float().to(DEVICE)
+    diseases = torch.arange(len(scaled_series), device=DEVICE)
+    with torch.no_grad():
+        next_week_scaled = model(last_sequences, diseases).cpu().numpy()
+    return [max(0, int(scaler.inverse_transform(row.reshape(1, 1))[0][0]))
+            for scaler, row in zip(scalers, next_week_scaled)]
+
 
+def forecast_next_week(model, scaler, scaled_data):
     # --- Prediction ---
     model.eval()
     last_sequence = scaled_data[-LOOK_BACK:]
     # Move input to GPU
-    input_tensor = torch.tensor(last_sequence).float().unsqueeze(0).to(device)
+    input_tensor = torch.tensor(last_sequence).float().unsqueeze(0).to(DEVICE)
 
     with torch.no_grad():
         next_week_scaled = model(input_tensor)
         next_week_cases = scaler.inverse_transform(next_week_scaled.cpu().numpy())
     
-    prediction_result = max(0, int(next_week_cases[0][0]))
+    return max(0, int(next_week_cases[0][0]))
 
-    # --- Generate Plot ---
+
+def plot_forecast(smoothed, prediction_result, disease_name):
+    """Base64 PNG of the smoothed history and the predicted next week ("" if plotting fails)."""
     img_base64 = "" # FIX: Removed random text
     try:
-        plt.figure(figsize=(10, 5))
-        plt.plot(df_weekly.index, df_weekly['cases'], label='Historical (Smoothed)', color='#1f77b4', linewidth=2)
+        fig = Figure(figsize=(10, 5))
+        ax = fig.add_subplot()
+        ax.plot(smoothed.index, smoothed.values, label='Historical (Smoothed)', color='#1f77b4', linewidth=2)
         
-        last_date = df_weekly.index[-1]
+        last_date = smoothed.index[-1]
         next_date = last_date + pd.Timedelta(weeks=1)
         
         # FIX: Removed random text at end of line
-        plt.scatter([next_date], [prediction_result], color='#ff7f0e', s=100, label='AI Prediction', zorder=5)
+        ax.scatter([next_date], [prediction_result], color='#ff7f0e', s=100, label='AI Prediction', zorder=5)
         
-        plt.title(f"Forecast: {disease_name}")
-        plt.xlabel("Date")
-        plt.ylabel("Weekly Cases")
-        plt.legend()
-        plt.grid(True, alpha=0.3)
-        plt.tight_layout()
+        ax.set_title(f"Forecast: {disease_name}")
+        ax.set_xlabel("Date")
+        ax.set_ylabel("Weekly Cases")
+        ax.legend()
+        ax.grid(True, alpha=0.3)
+        fig.tight_layout()
 
         buf = io.BytesIO()
-        plt.savefig(buf, format='png')
+        fig.savefig(buf, format='png')
         buf.seek(0)
         img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-        plt.close()
     except Exception:
         pass 
+    return img_base64
+
+
+def series_fingerprint(weekly):
+    """Identity of a weekly series: its first week and every count."""
+    digest = hashlib.sha256(str(weekly.index[0]).encode())
+    digest.update(np.ascontiguousarray(weekly.values, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """Trained models keyed by disease, each tagged with the fingerprint of the data it saw.
+
+    Entries live in memory (for --serve) and in MODEL_CACHE_DIR, so one-shot
+    CLI runs share them too. For a request, lookup() decides:
+      hit        - same fingerprint: the cached forecast is returned as is
+      fine_tune  - same history plus up to MAX_NEW_WEEKS appended weeks (the
+                   last cached week may have grown, as it was still in
+                   progress), values within the cached scaler range and fewer
+                   than MAX_FINE_TUNES fine-tunes in a row: the cached weights
+                   train for FINE_TUNE_EPOCHS more
+      train      - anything else (no entry, an entry from a shared batch model,
+                   rewritten history, a new range,
+                   other hyperparameters): a fresh model for EPOCHS
+    """
+
+    def __init__(self, cache_dir=MODEL_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "fine_tune": 0, "train": 0}
+        try:
+            with open(os.path.join(cache_dir, "stats.json")) as f:
+                self.stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def key(disease_name):
+        return disease_name.strip().lower()
+
+    @staticmethod
+    def config():
+        return {"look_back": LOOK_BACK, "epochs": EPOCHS, "lr": LEARNING_RATE, "batch_size": BATCH_SIZE,
+                "validation_weeks": VALIDATION_WEEKS, "patience": PATIENCE, "refit": REFIT}
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".pt")
+
+    def disease_lock(self, disease_name):
+        """Serializes requests for one disease, so concurrent ones do not train it twice."""
+        with self._lock:
+            return self._locks.setdefault(self.key(disease_name), threading.Lock())
+
+    def get(self, disease_name):
+        key = self.key(disease_name)
+        entry = self._entries.get(key)
+        if entry is None and os.path.exists(self._path(key)):
+            try:
+                entry = torch.load(self._path(key), map_location=DEVICE, weights_only=True)
+            except Exception:
+                entry = None  # unreadable or from an incompatible version; retrain
+            if entry is not None:
+                self._entries[key] = entry
+        return entry
+
+    def put(self, disease_name, entry):
+        key = self.key(disease_name)
+        self._entries[key] = entry
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = self._path(key) + ".tmp"
+            torch.save(entry, tmp)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            pass  # the in-memory entry still serves this process
+
+    def lookup(self, disease_name, weekly, smoothed):
+        """("hit" | "fine_tune" | "train", cached entry or None) for this series."""
+        entry = self.get(disease_name)
+        if entry is None or entry["config"] != self.config():
+            return "train", None
+        if entry["fingerprint"] == series_fingerprint(weekly):
+            return "hit", entry
+        if entry["state_dict"] is None:
+            return "train", None
+        old = np.asarray(entry["weekly"], dtype=np.float64)
+        new = weekly.values
+        appended = len(new) - len(old)
+        if (entry["start"] != str(weekly.index[0]) or appended < 0 or appended > MAX_NEW_WEEKS
+                or not np.array_equal(new[:len(old) - 1], old[:-1])
+                or entry["fine_tunes"] >= MAX_FINE_TUNES):
+            return "train", None
+        low, high = entry["scaler_min"], entry["scaler_max"]
+        slack = SCALER_SLACK * max(high - low, 1.0)
+        if smoothed.min() < low - slack or smoothed.max() > high + slack:
+            return "train", None
+        return "fine_tune", entry
+
+    def record(self, status):
+        """Counts a lookup outcome; totals persist in stats.json so one-shot runs add up."""
+        with self._lock:
+            self.stats[status] += 1
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp = os.path.join(self.cache_dir, "stats.json.tmp")
+                with open(tmp, "w") as f:
+                    json.dump(self.stats, f)
+                os.replace(tmp, os.path.join(self.cache_dir, "stats.json"))
+            except OSError:
+                pass
+
+    def metrics(self):
+        with self._lock:
+            total = sum(self.stats.values())
+            return {**self.stats, "hit_rate": round(self.stats["hit"] / total, 4) if total else 0.0}
+
+
+registry = ModelRegistry()
+
+
+def _cache_entry(weekly, scaler, model, fine_tunes, prediction, image_base64):
+    return {
+        "config": ModelRegistry.config(),
+        "fingerprint": series_fingerprint(weekly),
+        "start": str(weekly.index[0]),
+        "weekly": weekly.values.tolist(),
+        "scaler_min": float(scaler.data_min_[0]),
+        "scaler_max": float(scaler.data_max_[0]),
+        # Weights of a shared model are not kept per disease, so those entries cannot be fine-tuned
+        "state_dict": {k: v.detach().cpu() for k, v in model.state_dict().items()} if model is not None else None,
+        "fine_tunes": fine_tunes,
+        "prediction": prediction,
+        "image_base64": image_base64,
+    }
+
+
+def training_report(epochs_run, refit_epochs, max_epochs, best_loss, started, shared=False):
+    """The "training" part of a prediction's output."""
+    report = {"epochs_run": epochs_run, "refit_epochs": refit_epochs, "max_epochs": max_epochs,
+              "best_loss": round(best_loss, 6),
+              "seconds": round(time.perf_counter() - started, 3)}
+    if shared:
+        report["shared"] = True
+    return report
+
+
+def _train_single(disease_name, weekly, smoothed, status, entry):
+    """(prediction, plot, cache entry, training report) from a per-disease InfluenzaLSTM, fine-tuned or trained from scratch."""
+    started = time.perf_counter()
+    # Prepare for LSTM
+    raw_values = smoothed.values.reshape(-1, 1)
+    scaler = MinMaxScaler(feature_range=(0, 1))
+    model = InfluenzaLSTM().to(DEVICE) # Move model to GPU
+    if status == "fine_tune":
+        # Keep the cached scale: the weights were learned against it
+        scaler.fit([[entry["scaler_min"]], [entry["scaler_max"]]])
+        model.load_state_dict(entry["state_dict"])
+        max_epochs = FINE_TUNE_EPOCHS
+        # Windows ending in an appended week or in the last cached one, which may have been revised
+        new_windows = len(weekly) - len(entry["weekly"]) + 1
+    else:
+        scaler.fit(raw_values)
+        max_epochs = EPOCHS
+        new_windows = None
+    epochs_run, refit_epochs, best_loss = train_model(model, scaler.transform(raw_values), max_epochs, new_windows)
+    report = training_report(epochs_run, refit_epochs, max_epochs, best_loss, started)
+
+    scaled_data = scaler.transform(raw_values)
+    prediction_result = forecast_next_week(model, scaler, scaled_data)
+    img_base64 = plot_forecast(smoothed, prediction_result, disease_name)
+    fine_tunes = entry["fine_tunes"] + 1 if status == "fine_tune" else 0
+    return prediction_result, img_base64, _cache_entry(weekly, scaler, model, fine_tunes, prediction_result, img_base64), report
+
 
-    return prediction_result, img_base64, None
+def predict_diseases(file_path, disease_names, registry=registry):
+    """{disease: (next week's predicted cases, base64 plot, error, cache status, training report)}.
+
+    Cache hits are answered directly and fine-tunes run per disease; all
+    diseases that need a fresh model are trained together in one
+    MultiDiseaseLSTM (a lone one gets its own InfluenzaLSTM).
+    """
+    matrix, err = export_matrix(file_path)
+    if err:
+        return {name: (None, None, err, None, None) for name in disease_names}
+
+    results, series = {}, {}
+    for name in disease_names:
+        key = ModelRegistry.key(name)
+        if key in series or key in results:
+            continue
+        weekly = disease_series(matrix, name)
+        if weekly.empty:
+            results[key] = (0, None, None, None, None) # No data found
+            continue
+        # Smoothing
+        smoothed = weekly.rolling(window=4, min_periods=1).mean()
+        # Not enough data fallback
+        if len(smoothed) < LOOK_BACK + 2:
+            results[key] = (int(smoothed.values[-1]), None, None, None, None)
+            continue
+        series[key] = (name, weekly, smoothed)
+
+    with ExitStack() as locks:
+        for key in sorted(series):
+            locks.enter_context(registry.disease_lock(key))
+        to_train = []
+        for key, (name, weekly, smoothed) in series.items():
+            status, entry = registry.lookup(name, weekly, smoothed)
+            registry.record(status)
+            if status == "hit":
+                results[key] = (entry["prediction"], entry["image_base64"], None, status, None)
+            elif status == "fine_tune" or len(series) == 1:
+                pred, img, new_entry, report = _train_single(name, weekly, smoothed, status, entry)
+                registry.put(name, new_entry)
+                results[key] = (pred, img, None, status, report)
+            else:
+                to_train.append(key)
+
+        if len(to_train) == 1:
+            name, weekly, smoothed = series[to_train[0]]
+            pred, img, new_entry, report = _train_single(name, weekly, smoothed, "train", None)
+            registry.put(name, new_entry)
+            results[to_train[0]] = (pred, img, None, "train", report)
+        elif to_train:
+            started = time.perf_counter()
+            scalers, scaled_series = [], []
+            for key in to_train:
+                scaler = MinMaxScaler(feature_range=(0, 1))
+                scaled_series.append(scaler.fit_transform(series[key][2].values.reshape(-1, 1)))
+                scalers.append(scaler)
+            model, epochs_run, refit_epochs, best_loss = train_shared(scaled_series, EPOCHS)
+            predictions = forecast_shared(model, scalers, scaled_series)
+            report = training_report(epochs_run, refit_epochs, EPOCHS, best_loss, started, shared=True)
+            for key, scaler, pred in zip(to_train, scalers, predictions):
+                name, weekly, smoothed = series[key]
+                img = plot_forecast(smoothed, pred, name)
+                registry.put(name, _cache_entry(weekly, scaler, None, 0, pred, img))
+                results[key] = (pred, img, None, "train", report)
+
+    return {name: results[ModelRegistry.key(name)] for name in disease_names}
+
+
+def predict_disease(file_path, disease_name, registry=registry):
+    """(next week's predicted cases, base64 plot, error, cache status, training report) for one disease."""
+    return predict_diseases(file_path, [disease_name], registry)[disease_name]
+
+def prediction_output(file_path, disease_name):
+    """The JSON object the CLI prints (and --serve answers) for one prediction."""
+    return _output(*predict_disease(file_path, disease_name))
+
+def _output(pred, img, err, cache_status, training):
+    if err:
+        return {"error": err}
+    return {
+        "prediction": pred,
+        "image_base64": img,
+        "model_cache": {"status": cache_status, **registry.metrics()},
+        "training": training
+    }
+
+def batch_output(file_path, disease_names=None):
+    """{"results": {disease: prediction_output}} for several diseases from one read of the export.
+
+    Without disease_names, every diagnosis label in the export is forecast.
+    """
+    matrix, err = export_matrix(file_path)
+    if err:
+        return {"error": err}
+    if not disease_names:
+        disease_names = matrix.index.tolist()
+    predictions = predict_diseases(file_path, disease_names)
+    return {"results": {name: _output(*predictions[name]) for name in disease_names}}
+
+def serve(workers=SERVE_WORKERS):
+    """Long-lived worker speaking JSON lines on stdin/stdout.
+
+    Prints {"ready": true} once the imports are loaded, then answers each
+    request line {"id", "file_path", "disease"} with the CLI's output plus the
+    same "id"; {"id", "file_path", "diseases": [...]} gets batch_output. Requests run concurrently on `workers` threads, so responses
+    can arrive out of order. The process exits when stdin closes.
+    """
+    # Concurrent trainings share the cores instead of each spawning a full thread pool
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    out_lock = threading.Lock()
+
+    def respond(payload):
+        with out_lock:
+            sys.stdout.write(json.dumps(payload) + "\n")
+            sys.stdout.flush()
+
+    def run(request):
+        try:
+            if "diseases" in request:
+                result = batch_output(request["file_path"], request["diseases"])
+            else:
+                result = prediction_output(request["file_path"], request["disease"])
+        except Exception as e:
+            result = {"error": str(e)}
+        respond({"id": request.get("id"), **result})
+
+    respond({"ready": True})
+    with ThreadPoolExecutor(workers) as pool:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            request = None
+            try:
+                request = json.loads(line)
+                if not request.get("file_path") or not (request.get("disease") or "diseases" in request):
+                    raise ValueError("Missing arguments")
+            except (ValueError, AttributeError) as e:
+                respond({"id": request.get("id") if isinstance(request, dict) else None, "error": str(e)})
+                continue
+            pool.submit(run, request)
+
+def apply_training_options(argv):
+    """Sets the hyperparameters given in argv (e.g. --epochs 50) and returns the other arguments."""
+    rest = []
+    args = iter(argv)
+    for arg in args:
+        name = TRAINING_OPTIONS.get(arg)
+        if name is None:
+            rest.append(arg)
+            continue
+        value = next(args, None)
+        if value is None or not value.isdigit() or int(value) < (0 if name in ("VALIDATION_WEEKS", "REFIT") else 1):
+            raise ValueError(f"Invalid value for {arg}")
+        globals()[name] = int(value)
+    return rest
 
 # --- Main Entry Point ---
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print(json.dumps({"error": "Missing arguments"}))
+    try:
+        argv = apply_training_options(sys.argv[1:])
+    except ValueError as e:
+        print(json.dumps({"error": str(e)}))
         sys.exit(1)
 
-    file_path = sys.argv[1]
-    disease_name = sys.argv[2]
+    if len(argv) > 0 and argv[0] == "--serve":
+        serve(int(argv[1]) if len(argv) > 1 else SERVE_WORKERS)
+        sys.exit(0)
 
-    pred, img, err = predict_disease(file_path, disease_name)
+    if len(argv) > 1 and argv[0] == "--batch":
+        # --batch <data.jsonl> [disease ...]: one JSON object with a result per disease
+        torch.set_num_threads(os.cpu_count() or 1)
+        print(json.dumps(batch_output(argv[1], argv[2:])))
+        sys.exit(0)
 
-    if err:
-        print(json.dumps({"error": err}))
-    else:
-        # This is the ONLY thing that should be printed
-        print(json.dumps({
-            "prediction": pred,
-            "image_base64": img
-        }))
\ No newline at end of file
+    if len(argv) < 2:
+        print(json.dumps({"error": "Missing arguments"}))
+        sys.exit(1)
+
+    file_path = argv[0]
+    disease_name = argv[1]
+
+    # This is the ONLY thing that should be printed
+    print(json.dumps(prediction_output(file_path, disease_name)))
\ No newline at end of file
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from collections import Counter
+from pathlib import Path
+
+# Cold vs warm latency of model.py predictions:
+#   cold - a fresh `python3 model.py <file> <disease>` per request (interpreter
+#          start + torch/pandas/sklearn/matplotlib imports + the work)
+#   warm - requests sent to one `model.py --serve` worker, one at a time and
+#          then all at once
+# Each mode starts from its own empty MODEL_CACHE_DIR, so neither is served
+# by models the other trained; the cache column counts each answer's
+# model_cache.status (train / fine_tune / hit).
+# e.g. python model_bench.py sourceCode/data_export.jsonl "Tension Headache" --requests 5
+
+MODEL_SCRIPT = str(Path(__file__).with_name("model.py"))
+
+
+def cache_env(cache_dir):
+    return {**os.environ, "MODEL_CACHE_DIR": cache_dir}
+
+
+def cache_status(answer):
+    return (answer.get("model_cache") or {}).get("status") or answer.get("error", "none")
+
+
+def cold(file_path, disease, n, cache_dir):
+    latencies, statuses = [], Counter()
+    for _ in range(n):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, MODEL_SCRIPT, file_path, disease], env=cache_env(cache_dir),
+                             capture_output=True, text=True, check=True).stdout
+        latencies.append(time.perf_counter() - t0)
+        statuses[cache_status(json.loads(out))] += 1
+    return latencies, statuses
+
+
+class Worker:
+    def __init__(self, workers, cache_dir):
+        t0 = time.perf_counter()
+        self.proc = subprocess.Popen([sys.executable, MODEL_SCRIPT, "--serve", str(workers)], env=cache_env(cache_dir),
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        assert json.loads(self.proc.stdout.readline()).get("ready")
+        self.startup = time.perf_counter() - t0
+        self.next_id = 0
+
+    def send(self, file_path, disease):
+        self.next_id += 1
+        self.proc.stdin.write(json.dumps({"id": self.next_id, "file_path": file_path, "disease": disease}) + "\n")
+        self.proc.stdin.flush()
+
+    def receive(self):
+        return json.loads(self.proc.stdout.readline())
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def warm(worker, file_path, disease, n):
+    latencies, statuses = [], Counter()
+    for _ in range(n):
+        t0 = time.perf_counter()
+        worker.send(file_path, disease)
+        statuses[cache_status(worker.receive())] += 1
+        latencies.append(time.perf_counter() - t0)
+    return latencies, statuses
+
+
+def concurrent(worker, file_path, disease, n):
+    """Wall time for n requests in flight at once."""
+    statuses = Counter()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        worker.send(file_path, disease)
+    for _ in range(n):
+        statuses[cache_status(worker.receive())] += 1
+    return time.perf_counter() - t0, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="model.py cold vs warm request latency")
+    parser.add_argument("file_path")
+    parser.add_argument("disease")
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="threads of the --serve worker")
+    args = parser.parse_args()
+
+    def statuses_text(statuses):
+        return ", ".join(f"{status} {count}" for status, count in statuses.items())
+
+    def row(name, result):
+        lat, statuses = result
+        print(f"{name:<24} {np.mean(lat):>8.2f} {np.percentile(lat, 50):>8.2f} {np.max(lat):>8.2f}  "
+              f"{statuses_text(statuses)}")
+
+    print(f"{args.requests} requests for {args.disease!r}, each mode from an empty model cache")
+    print(f"{'mode':<24} {'mean s':>8} {'p50 s':>8} {'max s':>8}  cache")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        row("cold (spawn per request)", cold(args.file_path, args.disease, args.requests, cache_dir))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        worker = Worker(args.workers, cache_dir)
+        try:
+            row("warm (--serve)", warm(worker, args.file_path, args.disease, args.requests))
+            wall, statuses = concurrent(worker, args.file_path, args.disease, args.requests)
+        finally:
+            worker.close()
+    print(f"worker startup {worker.startup:.2f}s; {args.requests} concurrent requests in {wall:.2f}s "
+          f"({wall / args.requests:.2f}s each; {statuses_text(statuses)})")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,9 @@ const Joi = require('joi');
 const bcrypt = require('bcrypt');
 const fs = require('fs');
 const path = require('path');
-const { spawn } = require('child_process');
 const AuthService = require("../services/auth.service");
 const DatabaseService = require("../services/database.service");
+const ForecastService = require("../services/forecast.service");
 
 // Validation for Partners
 const partnerRegisterSchema = Joi.object({
@@ -141,50 +141,30 @@ const PartnersController = {
             }
 
             // 3. Write to JSONL file
+            // Written to a temp file and renamed, so a prediction still reading the previous export is unaffected
             const dataFilePath = path.join(__dirname, '../data_export.jsonl');
-            const fileStream = fs.createWriteStream(dataFilePath);
-            dataset.forEach(entry => {
-                fileStream.write(JSON.stringify(entry) + '\n');
-            });
-            fileStream.end();
-
-            // 4. Run Python Script
-            // We assume 'model.py' is in the root of the backend folder
-            const pythonScriptPath = path.join(__dirname, '../../model.py'); 
-            
-            console.log(`🚀 Running python script: ${pythonScriptPath}`);
-            const pythonProcess = spawn('python3', [pythonScriptPath, dataFilePath, disease]);
-
-            let scriptOutput = "";
-            let scriptError = "";
-
-            pythonProcess.stdout.on('data', (data) => {
-                scriptOutput += data.toString();
-            });
-
-            pythonProcess.stderr.on('data', (data) => {
-                scriptError += data.toString();
-            });
-
-            pythonProcess.on('close', (code) => {
-                if (code !== 0) {
-                    console.error("❌ Python Script Error:", scriptError);
-                    return res.status(500).send({ error: "Prediction model failed to run." });
-                }
+            const tmpPath = `${dataFilePath}.${process.pid}.${Date.now()}.tmp`;
+            await fs.promises.writeFile(tmpPath, dataset.map(entry => JSON.stringify(entry)).join('\n') + '\n');
+            await fs.promises.rename(tmpPath, dataFilePath);
+
+            // 4. Ask the long-lived model.py worker
+            let result;
+            try {
+                result = await ForecastService.predict(dataFilePath, disease);
+            } catch (e) {
+                console.error("❌ Forecast worker error:", e);
+                return res.status(500).send({ error: "Prediction model failed to run." });
+            }
+            if (result.error) {
+                console.error("❌ Prediction error:", result.error);
+                return res.status(500).send({ error: "Prediction model failed to run." });
+            }
 
-                try {
-                    console.log("✅ Python Output:", scriptOutput);
-                    const result = JSON.parse(scriptOutput);
-                    
-                    res.status(200).json({
-                        success: true,
-                        prediction: result.prediction,
-                        plot_image: `data:image/png;base64,${result.image_base64}`
-                    });
-                } catch (e) {
-                    console.error("❌ Failed to parse Python output:", scriptOutput);
-                    res.status(500).send({ error: "Invalid model output format." });
-                }
+            console.log(`✅ Prediction for ${disease}: ${result.prediction}`);
+            res.status(200).json({
+                success: true,
+                prediction: result.prediction,
+                plot_image: `data:image/png;base64,${result.image_base64}`
             });
 
         } catch (err) {
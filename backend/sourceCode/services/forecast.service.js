@@ -0,0 +1,112 @@
+const path = require('path');
+const readline = require('readline');
+const { spawn } = require('child_process');
+
+// model.py runs as one long-lived worker (python3 model.py --serve) instead of a
+// fresh process per prediction, so torch/pandas/sklearn are imported only once.
+// Requests and responses are JSON lines matched by id.
+const MODEL_SCRIPT = path.join(__dirname, '../../model.py');
+const REQUEST_TIMEOUT_MS = 10 * 60 * 1000;
+
+// The running worker: { proc, ready, pending }, where pending maps a request id
+// to { resolve, reject, timer }. Each worker keeps its own pending requests, so
+// an old process exiting cannot fail the requests sent to its replacement.
+let worker = null;
+let nextId = 1;
+
+function startWorker() {
+    const proc = spawn('python3', [MODEL_SCRIPT, '--serve']);
+    const state = { proc, ready: null, pending: new Map() };
+    worker = state;
+
+    state.ready = new Promise((resolve, reject) => {
+        // Fails everything waiting on this worker; the next prediction starts a new one
+        const fail = (error) => {
+            if (worker === state) worker = null;
+            reject(error);
+            for (const { reject: rejectRequest, timer } of state.pending.values()) {
+                clearTimeout(timer);
+                rejectRequest(error);
+            }
+            state.pending.clear();
+        };
+
+        readline.createInterface({ input: proc.stdout }).on('line', (line) => {
+            let msg;
+            try {
+                msg = JSON.parse(line);
+            } catch (e) {
+                console.error("❌ Invalid line from forecast worker:", line);
+                return;
+            }
+            if (msg.ready) return resolve();
+
+            const request = state.pending.get(msg.id);
+            if (!request) return;
+            state.pending.delete(msg.id);
+            clearTimeout(request.timer);
+            request.resolve(msg);
+        });
+
+        proc.stderr.on('data', (data) => console.error("Forecast worker:", data.toString()));
+
+        // Spawn failures (e.g. python3 missing) emit 'error' without an 'exit'
+        proc.on('error', (err) => {
+            console.error("❌ Could not start forecast worker:", err);
+            fail(err);
+        });
+
+        // Writing to a worker that has died (EPIPE) must not crash the server
+        proc.stdin.on('error', (err) => {
+            console.error("❌ Could not send to forecast worker:", err);
+            fail(err);
+        });
+
+        proc.on('exit', (code) => {
+            if (worker === state) {
+                // Not stopped by us
+                console.error(`❌ Forecast worker exited (code ${code})`);
+            }
+            fail(new Error('Forecast worker exited'));
+        });
+    });
+    // Avoid an unhandled rejection when the worker dies before anyone waits on it
+    state.ready.catch(() => {});
+    return state;
+}
+
+const ForecastService = {
+
+    // Resolves with the worker's answer: { prediction, image_base64 } or { error }
+    predict: async (dataFilePath, disease) => {
+        let current = worker;
+        if (!current) {
+            console.log(`🚀 Starting forecast worker: ${MODEL_SCRIPT}`);
+            current = startWorker();
+        }
+        await current.ready;
+
+        const id = nextId++;
+        return new Promise((resolve, reject) => {
+            if (worker !== current) {
+                return reject(new Error('Forecast worker exited'));
+            }
+            const timer = setTimeout(() => {
+                current.pending.delete(id);
+                reject(new Error('Forecast request timed out'));
+            }, REQUEST_TIMEOUT_MS);
+            current.pending.set(id, { resolve, reject, timer });
+            current.proc.stdin.write(JSON.stringify({ id, file_path: dataFilePath, disease }) + '\n');
+        });
+    },
+
+    // Optional: Useful for testing or shutting down the server
+    stop: () => {
+        if (worker) {
+            worker.proc.stdin.end();
+            worker = null;
+        }
+    }
+};
+
+module.exports = ForecastService;
@@ -0,0 +1,121 @@
+from typing import List, Optional
+
+from token_count import count_tokens as _count_tokens, get_encoding
+
+# Token-budgeted prompt assembly for the triage chat: the system prompt, the
+# retrieved evidence, a cached summary of older turns and as many recent
+# turns as fit, in that order of priority. Kept free of server state.
+
+EVIDENCE_SNIPPET_CHARS = 400
+MESSAGE_OVERHEAD_TOKENS = 4  # per chat message, for the role and separators
+CHAT_ENCODING = "o200k_base"  # tokenizer of gpt-4o
+_ENCODING = get_encoding(CHAT_ENCODING)
+
+
+def count_tokens(text: str) -> int:
+    return _count_tokens(text, CHAT_ENCODING)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of text within max_tokens (keeps the start of a message)."""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _ENCODING is not None:
+        return _ENCODING.decode(_ENCODING.encode_ordinary(text)[:max_tokens]) + "..."
+    return text[:max_tokens * 4] + "..."
+
+
+def format_message(msg: dict) -> str:
+    """One history line, or "" for messages the model should not see (the final report)."""
+    sender = msg.get("sender", "")
+    text = msg.get("text") or ""
+    if sender == "user":
+        return f" | Patient: {text}"
+    if sender == "bot" and "final medical analysis" not in text.lower():
+        return f" | AI Question: {text}"
+    return ""
+
+
+def evidence_key(doc: dict) -> str:
+    """Identity of a retrieved chunk: its content hash, else url and chunk ID."""
+    return doc.get("content_hash") or f"{doc.get('url')}#{doc.get('chunk_id')}"
+
+
+def build_evidence(docs: List[dict], max_tokens: int) -> str:
+    """Evidence block quoting docs in rank order within max_tokens.
+
+    The same chunk retrieved twice is quoted once. Chunks are quoted again on
+    later turns, since neither the history nor the summary keeps their text;
+    lower-ranked chunks are dropped once the budget is spent.
+    """
+    quoted, keys, used = [], set(), 0
+    for doc in docs:
+        key = evidence_key(doc)
+        if key in keys:
+            continue
+        entry = f"Source: {doc['source_title']} (Score: {doc['score']:.2f})\nContent: {doc['text'][:EVIDENCE_SNIPPET_CHARS]}..."
+        n = count_tokens(entry)
+        if used + n > max_tokens:
+            break
+        quoted.append(entry)
+        keys.add(key)
+        used += n
+    if not quoted:
+        return ""
+    return "\n\n=== RELEVANT MEDICAL KNOWLEDGE ===\n" + "\n---\n".join(quoted) + "\n==================================\n"
+
+
+def assemble_prompt(system_prompt: str, messages: List[dict], retrieved_docs: List[dict],
+                    summary: str = None, summary_until: Optional[str] = None,
+                    budget: int = 3000, evidence_budget: int = 600, recent_messages: int = 6) -> dict:
+    """Builds the chat messages for one turn within a token budget.
+
+    messages is the stored history, oldest first, ending with the new patient
+    message. Messages with a timestamp up to summary_until are covered by
+    summary. The last recent_messages are always candidates for verbatim
+    inclusion; older messages the summary does not cover yet are included
+    only while budget remains and are returned as "unsummarized" so the
+    caller can fold them into the summary.
+
+    Returns {"messages", "unsummarized"}.
+    """
+    system_tokens = count_tokens(system_prompt) + 2 * MESSAGE_OVERHEAD_TOKENS
+    remaining = max(0, budget - system_tokens)
+    evidence_block = build_evidence(retrieved_docs, min(evidence_budget, remaining // 2))
+    remaining -= count_tokens(evidence_block)
+
+    summary_block = ""
+    if summary:
+        summary_block = truncate_to_tokens(f"\n\nSummary of the earlier conversation: {summary}", remaining // 2)
+        remaining -= count_tokens(summary_block)
+
+    lines = [(msg, format_message(msg)) for msg in messages]
+    lines = [(msg, line) for msg, line in lines if line]
+    split = max(0, len(lines) - recent_messages)
+    older, recent = lines[:split], lines[split:]
+    unsummarized = [msg for msg, _ in older
+                    if summary_until is None or (msg.get("timestamp") or "") > summary_until]
+    # Newest first: the current patient message is kept (truncated if need be), older lines while they fit
+    history = []
+    pending = [line for msg, line in reversed(recent)]
+    pending += [format_message(msg) for msg in reversed(unsummarized)]
+    for line in pending:
+        n = count_tokens(line)
+        if n > remaining:
+            if not history:
+                history.append(truncate_to_tokens(line, remaining))
+            break
+        history.append(line)
+        remaining -= n
+    history_str = "".join(reversed(history))
+
+    user_content = f"{evidence_block}{summary_block}\n\nPatient History: {history_str}"
+    return {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ],
+        "unsummarized": unsummarized,
+    }
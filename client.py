@@ -1,6 +1,7 @@
 import requests
 import json
 import sys
+import time
 
 SERVER_URL = "http://127.0.0.1:8000"
 TOP_K_OUTPUT = 3
@@ -14,10 +15,33 @@ def ingest_mode():
     print("⏳ Ingesting...")
     try:
         resp = requests.post(f"{SERVER_URL}/ingest_url", json={"url": url})
-        if resp.status_code == 200:
-            print(f"✅ Success: {resp.json().get('message')}")
-        else:
+        if resp.status_code == 409:
+            print(f"❌ The server refused the write (read-only worker): {resp.text}")
+            return
+        if resp.status_code != 200:
             print(f"❌ Error: {resp.text}")
+            return
+        job_id = resp.json()["job_id"]
+
+        # Ingestion runs as a background job on the server; poll until it finishes
+        while True:
+            resp = requests.get(f"{SERVER_URL}/jobs/{job_id}")
+            if resp.status_code == 404:
+                print(f"❌ Error: job {job_id} is unknown to the server (restarted or pruned)")
+                break
+            if resp.status_code != 200:
+                print(f"❌ Error ({resp.status_code}): {resp.text}")
+                break
+            job = resp.json()
+            if job["status"] == "done":
+                print(f"✅ Success: {job.get('message')}")
+                break
+            if job["status"] == "failed":
+                print(f"❌ Error: {job.get('error')}")
+                break
+            progress = job.get("progress") or {}
+            print(f"   ... {job['status']} ({progress.get('done', 0)}/{progress.get('total', 0)})")
+            time.sleep(1)
     except Exception as e:
         print(f"Connection Failed: {e}")
 
@@ -28,9 +52,37 @@ def show_index_info():
         print(f"\n📊 Current RAG Index Status:")
         print(f"   - Total Text Chunks: {data.get('num_chunks')}")
         print(f"   - FAISS Optimized: {data.get('has_faiss')}")
+        cache = data.get("query_cache") or {}
+        print(f"   - Query Cache Hit Rate: {cache.get('hit_rate', 0):.0%} ({cache.get('entries', 0)} entries)")
     except Exception as e:
         print(f"Could not fetch info: {e}")
 
+def stream_chat_step(payload):
+    """Calls /chat_step_stream, printing the next question as it arrives.
+
+    Returns (final response dict, whether the question was already printed)."""
+    resp = requests.post(f"{SERVER_URL}/chat_step_stream", json=payload, stream=True)
+    if resp.status_code != 200:
+        return {"error": resp.text}, False
+
+    data = {"error": "Stream ended without a result"}
+    streamed = False
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line: continue
+        event = json.loads(line)
+        if event.get("type") == "delta":
+            if not streamed:
+                print(f"\n🤖 AI: ", end="")
+                streamed = True
+            print(event["next_question"], end="", flush=True)
+        elif event.get("type") == "done":
+            data = event
+        elif event.get("type") == "error":
+            data = {"error": event["error"]}
+    if streamed:
+        print()
+    return data, streamed
+
 def serve_loop():
     print("\n" + "="*60)
     print(" 🏥 MedHelp AI Triage + RAG ")
@@ -62,8 +114,7 @@ def serve_loop():
         }
 
         try:
-            resp = requests.post(f"{SERVER_URL}/chat_step", json=payload)
-            data = resp.json()
+            data, question_shown = stream_chat_step(payload)
 
             if "error" in data:
                 print(f"Server Error: {data['error']}")
@@ -124,7 +175,8 @@ def serve_loop():
                 break
             
             # --- 4. Next Question Loop ---
-            print(f"\n🤖 AI: {next_q}")
+            if not question_shown:
+                print(f"\n🤖 AI: {next_q}")
             
             ans = input("\nYour Answer (or 'exit'):\n> ").strip()
             if ans.lower() in ['exit', 'quit', 'stop']:
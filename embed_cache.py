@@ -0,0 +1,90 @@
+import os
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+
+
+def normalize_query(text: str) -> str:
+    """Case- and whitespace-insensitive form used as the cache key."""
+    return " ".join(text.lower().split())
+
+
+class EmbeddingCache:
+    """Bounded LRU map of (model, normalized text) -> float32 embedding."""
+
+    def __init__(self, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model: str, text: str) -> str:
+        return f"{model}\x00{normalize_query(text)}"
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        key = self._key(model, text)
+        with self._lock:
+            vec = self._entries.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, model: str, text: str, vec: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        vec = np.array(vec, dtype=np.float32)
+        vec.setflags(write=False)
+        key = self._key(model, text)
+        with self._lock:
+            self._entries[key] = vec
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def save(self, path: str):
+        """Writes entries (least recently used first) to an .npz file."""
+        with self._lock:
+            if not self._entries:
+                return
+            keys = np.array(list(self._entries.keys()))
+            vecs = np.stack(list(self._entries.values()))
+        # A temp file per call: workers shutting down together must not share one
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".npz")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, keys=keys, vecs=vecs)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def load(self, path: str) -> int:
+        """Restores entries saved by save(); returns how many were loaded."""
+        if self.max_entries <= 0 or not os.path.exists(path):
+            return 0
+        with np.load(path) as data:
+            keys, vecs = data["keys"], data["vecs"]
+        with self._lock:
+            for key, vec in zip(keys[-self.max_entries:], vecs[-self.max_entries:]):
+                vec = np.array(vec, dtype=np.float32)
+                vec.setflags(write=False)
+                self._entries[str(key)] = vec
+        return len(self._entries)
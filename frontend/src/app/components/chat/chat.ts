@@ -29,6 +29,7 @@ export class ChatComponent implements OnInit, AfterViewChecked {
   currentUserId: string | null = null;
   
   isTyping: boolean = false;
+  isStreaming: boolean = false; // next question is being streamed in
   isDropdownOpen: boolean = false;
   isDiagnosisComplete: boolean = false;
 
@@ -89,7 +90,7 @@ export class ChatComponent implements OnInit, AfterViewChecked {
 
   sendMessage() {
     // Added check for 'isTyping' so you can't send twice at once
-    if (!this.newMessage.trim() || this.isDiagnosisComplete || this.isTyping) return;
+    if (!this.newMessage.trim() || this.isDiagnosisComplete || this.isTyping || this.isStreaming) return;
 
     const textToSend = this.newMessage;
     this.newMessage = ''; 
@@ -102,21 +103,39 @@ export class ChatComponent implements OnInit, AfterViewChecked {
 
     this.isTyping = true;
 
-    this.triageService.sendMessage(textToSend, this.currentConversationId, this.currentUserId).subscribe({
-      next: (response) => {
-        this.isTyping = false; // Stop loading animation
-        
-        if (!this.currentConversationId && response.conversation_id) {
-          this.currentConversationId = response.conversation_id;
+    // Bot bubble filled in while the next question streams; replaced by the final message
+    let liveMessage: ChatMessage | null = null;
+
+    this.triageService.streamMessage(textToSend, this.currentConversationId, this.currentUserId).subscribe({
+      next: (event) => {
+        if (event.type === 'start') {
+          if (!this.currentConversationId && event.conversation_id) {
+            this.currentConversationId = event.conversation_id;
+          }
+        } else if (event.type === 'delta') {
+          this.isTyping = false; // Stop loading animation, text is arriving
+          this.isStreaming = true;
+          if (!liveMessage) {
+            liveMessage = { sender: 'bot', text: '', timestamp: new Date().toISOString() };
+            this.messages.push(liveMessage);
+          }
+          liveMessage.text += event.next_question;
+        } else if (event.type === 'done' || event.type === 'error') {
+          this.isTyping = false;
+          this.isStreaming = false;
+          if (liveMessage) {
+            this.messages = this.messages.filter(m => m !== liveMessage);
+            liveMessage = null;
+          }
+          this.handleAiResponse(event);
         }
 
-        this.handleAiResponse(response);
-        
         // --- FIX: FORCE SCREEN UPDATE ---
         this.cdr.detectChanges(); 
       },
       error: (err) => {
         this.isTyping = false;
+        this.isStreaming = false;
         console.error(err);
         this.messages.push({
           sender: 'bot',
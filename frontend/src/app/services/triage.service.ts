@@ -19,4 +19,47 @@ export class TriageService {
     };
     return this.http.post<any>(`${this.baseUrl}/chat_step`, payload);
   }
+
+  // Streams /chat_step_stream as NDJSON events: 'start' (conversation_id),
+  // 'delta' (next_question text fragments), then 'done' (same body as /chat_step) or 'error'
+  streamMessage(message: string, conversationId: string | null, userId: string | null): Observable<any> {
+    const payload = {
+      message: message,
+      conversation_id: conversationId,
+      user_id: userId
+    };
+    return new Observable<any>(observer => {
+      const controller = new AbortController();
+      fetch(`${this.baseUrl}/chat_step_stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(payload),
+        signal: controller.signal
+      }).then(async response => {
+        if (!response.ok || !response.body) {
+          throw new Error(`Stream request failed with status ${response.status}`);
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          let newline = buffer.indexOf('\n');
+          while (newline >= 0) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (line) observer.next(JSON.parse(line));
+            newline = buffer.indexOf('\n');
+          }
+        }
+        if (buffer.trim()) observer.next(JSON.parse(buffer));
+        observer.complete();
+      }).catch(err => {
+        if (err.name !== 'AbortError') observer.error(err);
+      });
+      return () => controller.abort();
+    });
+  }
 }
\ No newline at end of file
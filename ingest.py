@@ -0,0 +1,612 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+import multiprocessing
+import numpy as np
+import requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from token_count import count_tokens as _count_tokens, get_encoding
+
+# Scrape -> chunk -> embed pipeline for bulk ingestion. Kept free of server
+# state so HTML parsing can run in worker processes.
+
+USER_AGENT = "Mozilla/5.0"
+FETCH_TIMEOUT = 10
+MIN_PARAGRAPH_CHARS = 50  # shorter <p> blocks are captions, bylines and buttons
+CHUNK_TOKENS = 200  # per chunk; about the 800 characters chunk_text cut
+EMBED_ENCODING = "cl100k_base"  # tokenizer of the text-embedding-3 models
+_ENCODING = get_encoding(EMBED_ENCODING)
+# Trailing sentences repeated at the start of the next chunk. Chunks end on
+# sentence boundaries, so no sentence is split and no overlap is needed by default.
+CHUNK_OVERLAP_SENTENCES = 0
+# A sentence ends at . ! or ? (plus closing quotes/brackets) followed by
+# whitespace and an upper-case letter, digit or opening quote/bracket. Only
+# the whitespace (group 1) is dropped when splitting.
+SENTENCE_END_RE = re.compile(r"[.!?][\"')\]]*(\s+)(?=[A-Z0-9\"'(\[])")
+ABBREVIATIONS = frozenset("dr mr mrs ms prof st vs etc approx e.g i.e".split())
+# Abbreviations only before a number ("No. 5", "Fig. 2"); otherwise plain words that can end a sentence
+NUMBER_ABBREVIATIONS = frozenset("no fig".split())
+
+
+def count_tokens(text: str) -> int:
+    return _count_tokens(text, EMBED_ENCODING)
+
+
+def _content_root(html: str, url: str):
+    """(title, main content element or None) of a page."""
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Cleanup
+    for tag in soup(["script", "style", "nav", "footer"]):
+        tag.decompose()
+
+    title = soup.title.string.strip() if soup.title and soup.title.string else url
+    # Try to find main content, fallback to body
+    return title, soup.find("main") or soup.find("div", {"id": "content"}) or soup.body
+
+
+def iter_paragraphs(content_div) -> Iterator[str]:
+    """Text of each substantial <p> under content_div, one at a time."""
+    if content_div is None:
+        return
+    for p in content_div.find_all("p"):
+        text = p.get_text(separator=" ", strip=True)
+        if len(text) > MIN_PARAGRAPH_CHARS:
+            yield text
+
+
+def parse_html(html: str, url: str) -> Tuple[str, str]:
+    """Extracts (title, paragraph text) from a page."""
+    title, content_div = _content_root(html, url)
+    return title, "\n\n".join(iter_paragraphs(content_div))
+
+
+def split_sentences(paragraph: str) -> List[str]:
+    """Sentences of a paragraph, with its whitespace collapsed.
+
+    >>> split_sentences("The answer was no. The test starts. See No. 5 and Dr. Smith.")
+    ['The answer was no.', 'The test starts.', 'See No. 5 and Dr. Smith.']
+    """
+    text = " ".join(paragraph.split())
+    bounds = [0]
+    for m in SENTENCE_END_RE.finditer(text):
+        bounds += [m.start(1), m.end(1)]
+    bounds.append(len(text))
+    sentences = []
+    for part in (text[bounds[i]:bounds[i + 1]] for i in range(0, len(bounds), 2)):
+        last = sentences[-1].rsplit(" ", 1)[-1].rstrip(".").lower() if sentences else None
+        if last in ABBREVIATIONS or (last in NUMBER_ABBREVIATIONS and part[:1].isdigit()):
+            sentences[-1] += " " + part  # "Dr. Smith" is not a sentence break
+        elif part:
+            sentences.append(part)
+    return sentences
+
+
+def _split_long_sentence(sentence: str, max_tokens: int) -> Iterator[Tuple[str, int]]:
+    """Word-boundary pieces of a sentence that alone exceeds max_tokens."""
+    words, used = [], 0.0
+    for word in sentence.split(" "):
+        n = len(_ENCODING.encode_ordinary(" " + word)) if _ENCODING is not None else (len(word) + 1) / 4
+        if words and used + n > max_tokens:
+            piece = " ".join(words)
+            yield piece, count_tokens(piece)
+            words, used = [], 0.0
+        words.append(word)
+        used += n
+    if words:
+        piece = " ".join(words)
+        yield piece, count_tokens(piece)
+
+
+def iter_chunks(paragraphs: Iterable[str], max_tokens: int = CHUNK_TOKENS,
+                overlap_sentences: int = CHUNK_OVERLAP_SENTENCES) -> Iterator[str]:
+    """Packs whole sentences into chunks of at most max_tokens, yielding each as soon as it is full.
+
+    Chunks break between sentences (never mid-word) and keep paragraph breaks;
+    each chunk starts with the last overlap_sentences sentences of the one
+    before. Only a sentence longer than max_tokens is cut, at word boundaries.
+    """
+    window = []  # (sentence, tokens, starts a paragraph) in the current chunk
+    used = fresh = 0  # tokens in window; sentences not yet yielded in any chunk
+
+    def render():
+        return "".join(("\n\n" if new_para else " ") + sent if i else sent
+                       for i, (sent, _, new_para) in enumerate(window))
+
+    for paragraph in paragraphs:
+        new_para = True
+        for sentence in split_sentences(paragraph):
+            n = count_tokens(sentence)
+            pieces = _split_long_sentence(sentence, max_tokens) if n > max_tokens else [(sentence, n)]
+            for piece, n in pieces:
+                if window and used + n > max_tokens:
+                    if fresh:
+                        yield render()
+                    window = window[-overlap_sentences:] if overlap_sentences else []
+                    while window and sum(t for _, t, _ in window) + n > max_tokens:
+                        window.pop(0)
+                    used = sum(t for _, t, _ in window)
+                    fresh = 0
+                window.append((piece, n, new_para))
+                used += n
+                fresh += 1
+                new_para = False
+    if fresh:
+        yield render()
+
+
+def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
+    """Splits text into overlapping fixed-width chunks.
+
+    The splitter used before iter_chunks; kept as the baseline for rag_bench.py chunking.
+    """
+    text = text.strip()
+    if not text: return []
+    chunks = []
+    i = 0
+    while i < len(text):
+        end = min(i + chunk_size, len(text))
+        chunk = text[i:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        i += (chunk_size - overlap)
+    return chunks
+
+
+def chunk_hash(text: str) -> str:
+    """Whitespace-insensitive content hash used to skip re-embedding identical chunks."""
+    return hashlib.blake2b(" ".join(text.split()).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """HTTP session with a shared keep-alive connection pool."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host by at least min_interval seconds."""
+
+    def __init__(self, min_interval: float = 1.0):
+        self.min_interval = min_interval
+        self._next_allowed = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_allowed[host])
+            self._next_allowed[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def fetch_page(session: requests.Session, url: str, limiter: HostRateLimiter = None,
+               previous: dict = None) -> dict:
+    """GETs a page, conditionally if validators from a previous crawl are known.
+
+    Returns {"status", "html", "etag", "last_modified", "body_sha256"}; on a
+    304 html is None and the previous validators are carried over.
+    """
+    headers = {}
+    if previous:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+    if limiter is not None:
+        limiter.wait(url)
+    resp = session.get(url, timeout=FETCH_TIMEOUT, headers=headers)
+    if resp.status_code == 304:
+        return {"status": 304, "html": None, "etag": previous.get("etag"),
+                "last_modified": previous.get("last_modified"), "body_sha256": previous.get("body_sha256")}
+    resp.raise_for_status()
+    return {
+        "status": resp.status_code,
+        "html": resp.text,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "body_sha256": hashlib.sha256(resp.content).hexdigest(),
+    }
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - t0
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def parse_pool(workers: int) -> ProcessPoolExecutor:
+    """The process pool that parses pages, started on first use and kept for later ingests.
+
+    Spawned workers import this module afresh, which costs more than parsing
+    a page, so they are not started per ingest. A pool that lost a worker is
+    dropped and the next call starts a new one.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max(1, workers), mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pool
+
+
+def _drop_parse_pool(pool: ProcessPoolExecutor):
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    pool.shutdown(wait=False)
+
+
+def _parse_and_chunk(html: str, url: str):
+    # Paragraphs are streamed into the chunker; the page text is never joined into one string
+    title, content_div = _content_root(html, url)
+    chunks, hashes = [], []
+    for chunk in iter_chunks(iter_paragraphs(content_div)):
+        chunks.append(chunk)
+        hashes.append(chunk_hash(chunk))
+    return title, chunks, hashes
+
+
+def run_ingest_pipeline(sites: List[dict], embed_batch: Callable[[List[str]], np.ndarray],
+                        indexed_vector: Callable[[str], Optional[np.ndarray]] = None,
+                        page_hashes: Callable[[str], set] = None, sources: dict = None,
+                        fetch_workers: int = 8, parse_workers: int = 4, embed_workers: int = 4,
+                        batch_size: int = 32, per_host_interval: float = 1.0,
+                        progress: Callable[[int, int], None] = None):
+    """Fetches, parses and embeds sites with the stages overlapping.
+
+    sites are {"url", "category"} dicts. Pages are fetched concurrently over a
+    pooled session (rate limited per host), parsed and chunked in the
+    process's parse_pool (started with parse_workers on first use; a single
+    site is parsed on a thread), and embedded in concurrent batches. progress, if given, is called
+    with (sites finished, total sites) as each site ends.
+
+    sources maps url -> record from a previous crawl (ETag, Last-Modified,
+    body hash); unchanged pages are skipped via a conditional GET or the body
+    hash, unless page_hashes(url) (content hashes indexed under the URL) lacks
+    some of the recorded chunks. A page gets its own row for every chunk it
+    does not have yet, but only text never seen before is embedded: a chunk
+    already indexed for another page reuses indexed_vector(hash), and one
+    shared by pages of this run is embedded once.
+
+    Returns (embeddings, metadatas, source_updates) for the new rows only.
+    source_updates maps url -> its new record, including "chunk_hashes" (all
+    chunks currently on the page) so the caller can drop chunks that vanished.
+    Nothing is added to the index here, so the caller can commit at once.
+    """
+    t_start = time.perf_counter()
+    indexed_vector = indexed_vector or (lambda h: None)
+    page_hashes = page_hashes or (lambda url: set())
+    sources = sources or {}
+    busy = defaultdict(float)
+    counts = defaultdict(int)
+    limiter = HostRateLimiter(per_host_interval)
+    pages = {}  # url -> fetch_page() result
+    results = {}  # url -> {"title", "chunks", "hashes", "vectors", "category", "embs": [batch arrays], "left": n batches}
+    source_updates = {}
+    seen_hashes = set()  # text embedded by some page of this run
+    run_vectors = {}  # hash -> vector embedded in this run
+    failed = set()
+    finished = [0]
+
+    def site_finished():
+        finished[0] += 1
+        if progress is not None:
+            progress(finished[0], len(sites))
+
+    def source_record(url, chunk_hashes):
+        page = pages[url]
+        return {
+            "etag": page["etag"],
+            "last_modified": page["last_modified"],
+            "body_sha256": page["body_sha256"],
+            "chunk_hashes": chunk_hashes,
+            "crawled_at": time.time(),
+        }
+
+    session = make_session(fetch_workers)
+    with ThreadPoolExecutor(fetch_workers) as fetch_pool, ThreadPoolExecutor(embed_workers) as embed_pool:
+        # A single page is parsed on a fetch thread: not worth a round trip to the worker processes
+        parser = fetch_pool if len(sites) == 1 else parse_pool(parse_workers)
+        stage_of = {}
+        complete = {}  # url -> whether every chunk of the last crawl is still indexed for it
+        for site in sites:
+            print(f"   Downloading {site['url']}...")
+            previous = sources.get(site["url"])
+            complete[site["url"]] = bool(previous) and set(previous.get("chunk_hashes", [])) <= page_hashes(site["url"])
+            # An incomplete page is fetched in full (no validators) so its missing chunks come back
+            fut = fetch_pool.submit(_timed, fetch_page, session, site["url"], limiter,
+                                    previous if complete[site["url"]] else None)
+            stage_of[fut] = ("fetch", site, None)
+        pending = set(stage_of)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                stage, site, batch_no = stage_of.pop(fut)
+                url = site["url"]
+                if url in failed:
+                    continue
+                try:
+                    if stage == "parse":
+                        (title, chunks, hashes), seconds = fut.result()
+                    else:
+                        value, seconds = fut.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool) and parser is not fetch_pool:
+                        # A worker died: parse the rest of this run on threads, the next run gets a new pool
+                        _drop_parse_pool(parser)
+                        parser = fetch_pool
+                    print(f"   ❌ Failed {url} ({stage}): {e}")
+                    failed.add(url)
+                    site_finished()
+                    continue
+                busy[stage] += seconds
+                counts[stage] += 1
+
+                if stage == "fetch":
+                    previous = sources.get(url)
+                    if complete[url] and (value["status"] == 304 or value["body_sha256"] == previous.get("body_sha256")):
+                        print(f"   ⏭️ Unchanged since last crawl: {url}")
+                        source_updates[url] = {**previous, "crawled_at": time.time()}
+                        site_finished()
+                        continue
+                    pages[url] = value
+                    nxt = parser.submit(_timed, _parse_and_chunk, value["html"], url)
+                    stage_of[nxt] = ("parse", site, None)
+                    pending.add(nxt)
+                elif stage == "parse":
+                    if not chunks:
+                        print(f"   ⚠️ No text found for {url}")
+                        site_finished()
+                        continue
+                    on_page = set(page_hashes(url))
+                    rows, vectors, to_embed = [], [], []
+                    for c, h in zip(chunks, hashes):
+                        if h in on_page:
+                            continue
+                        on_page.add(h)
+                        rows.append((c, h))
+                        vec = indexed_vector(h)
+                        vectors.append(vec)  # None: embedded below or by another page of this run
+                        if vec is None and h not in seen_hashes:
+                            seen_hashes.add(h)
+                            to_embed.append(c)
+                    if not rows:
+                        print(f"   ⏭️ No new chunks on {url}")
+                        source_updates[url] = source_record(url, hashes)
+                        site_finished()
+                        continue
+                    batches = [to_embed[i:i + batch_size] for i in range(0, len(to_embed), batch_size)]
+                    results[url] = {"title": title, "chunks": [c for c, _ in rows], "hashes": [h for _, h in rows],
+                                    "vectors": vectors, "all_hashes": hashes, "category": site["category"],
+                                    "embed_hashes": [chunk_hash(c) for c in to_embed],
+                                    "embs": [None] * len(batches), "left": len(batches)}
+                    if not batches:
+                        print(f"   ✅ Indexed {len(rows)} chunks from {title}, all already embedded")
+                        site_finished()
+                    for n, batch in enumerate(batches):
+                        nxt = embed_pool.submit(_timed, embed_batch, batch)
+                        stage_of[nxt] = ("embed", site, n)
+                        pending.add(nxt)
+                else:
+                    entry = results[url]
+                    entry["embs"][batch_no] = value
+                    entry["left"] -= 1
+                    if entry["left"] == 0:
+                        run_vectors.update(zip(entry["embed_hashes"], np.vstack(entry["embs"])))
+                        reused = len(entry["chunks"]) - len(entry["embed_hashes"])
+                        print(f"   ✅ Ingested {len(entry['chunks'])} new chunks from {entry['title']}"
+                              + (f" ({reused} reuse an existing embedding)" if reused else ""))
+                        site_finished()
+    session.close()
+
+    all_embs, all_metas = [], []
+    now = time.time()
+    for url, entry in results.items():
+        if url in failed or entry["left"]:
+            continue
+        vectors = [v if v is not None else run_vectors.get(h) for v, h in zip(entry["vectors"], entry["hashes"])]
+        if any(v is None for v in vectors):
+            # The page embedding shared text failed; leave this one unrecorded so it is crawled again
+            print(f"   ❌ Skipped {url}: a shared chunk could not be embedded")
+            continue
+        all_embs.append(np.vstack(vectors))
+        all_metas.extend({
+            "source_title": entry["title"],
+            "url": url,
+            "text": chunk,
+            "category": entry["category"],
+            "ingested_at": now,
+            "content_hash": h
+        } for chunk, h in zip(entry["chunks"], entry["hashes"]))
+        source_updates[url] = source_record(url, entry["all_hashes"])
+
+    wall = time.perf_counter() - t_start
+    for stage in ("fetch", "parse", "embed"):
+        print(f"   ⏱️ {stage}: {counts[stage]} tasks, {busy[stage]:.2f}s of work")
+    print(f"   ⏱️ pipeline wall time: {wall:.2f}s for {len(all_metas)} chunks")
+
+    embs = np.vstack(all_embs) if all_embs else np.empty((0, 0), dtype=np.float32)
+    return embs, all_metas, source_updates
+
+
+JOB_ID_RE = re.compile(r"[0-9a-f]{32}")  # uuid4().hex; job files are named after it
+
+
+class JobQueue:
+    """Runs ingestion jobs on a small thread pool and keeps their status for polling.
+
+    A job function is called as fn(job, *args); it may report progress with
+    update(job, progress=...) and its return value becomes job["message"].
+    Exceptions mark the job failed.
+
+    With path, every job record is also written there as <id>.json, so any
+    process sharing the directory can answer for it. forward() queues a job
+    there for another process to run; that process picks it up with
+    run_forwarded().
+    """
+
+    def __init__(self, workers: int = 2, keep: int = 100, path: str = None):
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="ingest-job")
+        self._jobs = {}
+        self._keep = keep
+        self._path = path
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _new_job(kind: str) -> dict:
+        return {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "progress": {"done": 0, "total": 0},
+            "message": None,
+            "error": None,
+            "submitted_at": datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+        }
+
+    def submit(self, kind: str, fn: Callable, *args) -> dict:
+        job = self._new_job(kind)
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self._prune()
+        self._save(job)
+        self._pool.submit(self._run, job, fn, args)
+        return dict(job)
+
+    def forward(self, kind: str, *args) -> dict:
+        """Queues a job in the shared directory for the process that calls run_forwarded(); args must be JSON."""
+        if not self._path:
+            raise ValueError("Jobs can only be forwarded through a shared job directory")
+        job = self._new_job(kind)
+        job["forwarded_args"] = list(args)
+        self._save(job)
+        return dict(job)
+
+    def run_forwarded(self, handlers: dict) -> int:
+        """Starts the forwarded jobs still queued in the shared directory; returns how many.
+
+        handlers maps a job kind to its function. Only one process (the
+        index writer) may call this, so a job is never claimed twice.
+        """
+        started = 0
+        for job in self._read_all():
+            if job["status"] != "queued" or "forwarded_args" not in job or job["id"] in self._jobs:
+                continue
+            fn = handlers.get(job["kind"])
+            if fn is None:
+                job.update(status="failed", error=f"Unknown job kind {job['kind']!r}",
+                           finished_at=datetime.now().isoformat())
+                self._save(job)
+                continue
+            with self._lock:
+                self._jobs[job["id"]] = job
+                self._prune()
+            self._pool.submit(self._run, job, fn, tuple(job["forwarded_args"]))
+            started += 1
+        return started
+
+    def update(self, job: dict, **fields):
+        """Sets fields (e.g. progress) on a running job and saves its record."""
+        job.update(fields)
+        self._save(job)
+
+    def _run(self, job: dict, fn: Callable, args: tuple):
+        self.update(job, status="running", started_at=datetime.now().isoformat())
+        try:
+            job["message"] = fn(job, *args)
+            job["status"] = "done"
+        except Exception as e:
+            print(f"❌ Job {job['id']} ({job['kind']}) failed: {e}")
+            job["error"] = str(e)
+            job["status"] = "failed"
+        self.update(job, finished_at=datetime.now().isoformat())
+
+    def _file(self, job_id: str) -> Optional[str]:
+        if not self._path or not JOB_ID_RE.fullmatch(job_id):
+            return None
+        return os.path.join(self._path, job_id + ".json")
+
+    def _save(self, job: dict):
+        path = self._file(job["id"])
+        if path is None:
+            return
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(job, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Could not save job {job['id']}: {e}")
+
+    def _read(self, path: str) -> Optional[dict]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None  # removed by a prune, or not written yet
+
+    def _read_all(self) -> List[dict]:
+        """Every job record in the shared directory, oldest first."""
+        if not self._path:
+            return []
+        records = (self._read(os.path.join(self._path, name))
+                   for name in os.listdir(self._path) if name.endswith(".json"))
+        return sorted((r for r in records if r), key=lambda j: j["submitted_at"])
+
+    def _prune(self):
+        """Forgets the oldest finished jobs beyond the retention limit (call under _lock)."""
+        finished = [j for j in self._jobs.values() if j["status"] in ("done", "failed")]
+        for job in finished[:max(0, len(finished) - self._keep)]:
+            del self._jobs[job["id"]]
+        shared = [j for j in self._read_all() if j["status"] in ("done", "failed")]
+        for job in shared[:max(0, len(shared) - self._keep)]:
+            try:
+                os.remove(self._file(job["id"]))
+            except OSError:
+                pass
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return dict(job)
+        path = self._file(job_id)
+        return self._read(path) if path else None
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            local = {j["id"]: dict(j) for j in self._jobs.values()}
+        shared = {j["id"]: j for j in self._read_all()}
+        shared.update(local)
+        return sorted(shared.values(), key=lambda j: j["submitted_at"], reverse=True)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,415 @@
+import gc
+import os
+import time
+import random
+import tempfile
+import argparse
+import multiprocessing
+import numpy as np
+import requests
+from typing import List
+
+from ingest import (FETCH_TIMEOUT, USER_AGENT, _content_root, chunk_text, count_tokens, iter_chunks,
+                    iter_paragraphs, parse_html, split_sentences)
+from rag_lexical import BM25Index
+from rag_store import RagStore
+from rag_search import (PRECISIONS, QuantizedRows, build_index, choose_index_kind, set_search_params, default_nlist,
+                        rerank_rows, top_k_rows, faiss)
+
+# Offline benchmarks for the RAG index. Run against the stored corpus or a
+# synthetic one, e.g.:
+#   python rag_bench.py ann --synthetic 200000 --queries 300
+#   python rag_bench.py batch --synthetic 100000 --queries 2000
+#   python rag_bench.py precision --synthetic 100000 --queries 200
+#   python rag_bench.py metadata --chunks 200000
+#   python rag_bench.py chunking https://www.nhs.uk/conditions/asthma/ saved_page.html
+#   python rag_bench.py reload --synthetic 20000
+
+
+def synthetic_corpus(n: int, dim: int = 1536, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    """Clustered unit vectors, closer to real embedding geometry than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    embs = centers[rng.integers(0, clusters, n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+    return embs
+
+
+def load_corpus(args) -> np.ndarray:
+    if args.synthetic:
+        return synthetic_corpus(args.synthetic, args.dim)
+    embs, _ = RagStore(args.index).open()
+    if embs is None:
+        raise SystemExit(f"No embeddings stored in {args.index}")
+    return np.ascontiguousarray(embs)
+
+
+def make_queries(embs: np.ndarray, n_queries: int, noise: float = 0.05, seed: int = 1) -> np.ndarray:
+    """Perturbed corpus rows, so every query has genuine near neighbours."""
+    rng = np.random.default_rng(seed)
+    q = embs[rng.integers(0, len(embs), n_queries)].copy()
+    q += noise * rng.normal(size=q.shape).astype(np.float32) / np.sqrt(embs.shape[1])
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    return q
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    k = truth.shape[1]
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / (k * len(truth))
+
+
+def single_query_latencies(idx, queries: np.ndarray, k: int):
+    """Searches one query at a time, as retrieve() does; returns (ids, latencies in ms)."""
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    lat = np.empty(len(queries))
+    for i in range(len(queries)):
+        t0 = time.perf_counter()
+        _, ids[i:i + 1] = idx.search(queries[i:i + 1], k)
+        lat[i] = (time.perf_counter() - t0) * 1000
+    return ids, lat
+
+
+def ann_report(args):
+    if faiss is None:
+        raise SystemExit("faiss is required for the ANN report (pip install faiss-cpu)")
+    embs = load_corpus(args)
+    n, d = embs.shape
+    queries = make_queries(embs, args.queries)
+    k = min(args.k, n)
+
+    configs = [("flat", None, None)]
+    configs += [("hnsw", "efSearch", v) for v in (16, 32, 64, 128, 256)]
+    configs += [("ivf", "nprobe", v) for v in (1, 4, 16, 64)]
+    if d % 64 == 0:
+        configs += [("ivfpq", "nprobe", v) for v in (4, 16, 64)]
+
+    print(f"Corpus: {n} x {d}, {len(queries)} queries, recall@{k} against the flat baseline")
+    print(f"{'tier':<6} {'param':<14} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8} {'index MB':>9}")
+    built = {}
+    truth = None
+    for kind, param, value in configs:
+        if choose_index_kind(n, kind) != kind:
+            continue  # too few rows to train this tier
+        if kind not in built:
+            t0 = time.perf_counter()
+            idx = build_index(embs, kind, nlist=default_nlist(n))
+            built[kind] = (idx, time.perf_counter() - t0, faiss.serialize_index(idx).nbytes / 2**20)
+        idx, build_s, size_mb = built[kind]
+        if param == "efSearch":
+            set_search_params(idx, ef_search=value)
+        elif param == "nprobe":
+            set_search_params(idx, nprobe=value)
+        ids, lat = single_query_latencies(idx, queries, k)
+        if truth is None:
+            truth = ids
+        label = f"{param}={value}" if param else "exact"
+        print(f"{kind:<6} {label:<14} {recall_at_k(ids, truth):>7.3f} {np.percentile(lat, 50):>8.3f} "
+              f"{np.percentile(lat, 95):>8.3f} {build_s:>8.2f} {size_mb:>9.1f}")
+
+
+def numpy_search(embs: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """The server's NumPy fallback: one GEMM for the block, then per-row top-k."""
+    return top_k_rows(queries @ embs.T, k)
+
+
+def batch_report(args):
+    embs = load_corpus(args)
+    n, d = embs.shape
+    queries = make_queries(embs, args.queries)
+    k = min(args.k, n)
+    backends = [("numpy", lambda q: numpy_search(embs, q, k))]
+    if faiss is not None:
+        kind = choose_index_kind(n, args.kind)
+        idx = build_index(embs, kind)
+        set_search_params(idx, nprobe=16, ef_search=64)
+        backends.insert(0, (f"faiss-{kind}", lambda q: idx.search(q, k)))
+
+    print(f"Corpus: {n} x {d}, {len(queries)} queries, k={k}")
+    print(f"{'backend':<12} {'batch':>6} {'queries/s':>11} {'speedup':>8}")
+    for name, search in backends:
+        base = None
+        for size in args.batch_sizes:
+            t0 = time.perf_counter()
+            for start in range(0, len(queries), size):
+                search(queries[start:start + size])
+            qps = len(queries) / (time.perf_counter() - t0)
+            base = base or qps
+            print(f"{name:<12} {size:>6} {qps:>11.0f} {qps / base:>7.1f}x")
+
+
+def precision_report(args):
+    embs = load_corpus(args)
+    n, d = embs.shape
+    queries = make_queries(embs, args.queries)
+    k = min(args.k, n)
+    fetch = min(k * args.rerank, n)
+    truth = top_k_rows(queries @ embs.T, k)
+
+    backends = []
+    for precision in PRECISIONS:
+        if faiss is not None:
+            idx = build_index(embs, choose_index_kind(n, args.kind), precision=precision)
+            set_search_params(idx, nprobe=16, ef_search=64)
+            backends.append((f"faiss-{args.kind}", precision, faiss.serialize_index(idx).nbytes,
+                             lambda q, idx=idx: idx.search(q, fetch)[1]))
+        if precision == "float32":
+            backends.append(("numpy", precision, embs.nbytes, lambda q: top_k_rows(q @ embs.T, fetch)))
+        else:
+            rows = QuantizedRows.from_rows(embs, precision)
+            backends.append(("numpy", precision, rows.nbytes, lambda q, rows=rows: top_k_rows(rows.scores(q), fetch)))
+
+    print(f"Corpus: {n} x {d}, {len(queries)} queries, recall@{k} against exact float32, "
+          f"re-rank of the top {fetch} in float32")
+    # The server re-ranks against the float32 rows mapped from embeddings.f32;
+    # "+f32 MB" counts them on top of the searched vectors
+    print(f"{'backend':<12} {'precision':<9} {'MB':>8} {'+f32 MB':>8} {'recall':>7} {'+rerank':>8} "
+          f"{'p50 ms':>8} {'+rerank':>8}")
+    for name, precision, nbytes, search in backends:
+        found = np.empty((len(queries), k), dtype=np.int64)
+        reranked = np.empty((len(queries), k), dtype=np.int64)
+        lat, rerank_lat = np.empty(len(queries)), np.empty(len(queries))
+        for i in range(len(queries)):
+            t0 = time.perf_counter()
+            cand = search(queries[i:i + 1])[0]
+            t1 = time.perf_counter()
+            best = rerank_rows(queries[i], embs, cand[cand >= 0], k)
+            t2 = time.perf_counter()
+            found[i] = cand[:k]
+            reranked[i] = [row for _, row in best]
+            lat[i], rerank_lat[i] = (t1 - t0) * 1000, (t2 - t0) * 1000
+        with_f32 = nbytes if name == "numpy" and precision == "float32" else nbytes + embs.nbytes
+        print(f"{name:<12} {precision:<9} {nbytes / 2**20:>8.1f} {with_f32 / 2**20:>8.1f} {recall_at_k(found, truth):>7.3f} "
+              f"{recall_at_k(reranked, truth):>8.3f} {np.percentile(lat, 50):>8.3f} {np.percentile(rerank_lat, 50):>8.3f}")
+
+
+def synthetic_records(n: int, sites: int = 50, text_len: int = 800, seed: int = 0):
+    """Chunk metadata shaped like run_ingest_pipeline's output (source strings shared per site)."""
+    rng = random.Random(seed)
+    words = ["fever", "cough", "patients", "symptoms", "treatment", "diagnosis", "chronic",
+             "infection", "therapy", "blood", "pressure", "medication", "risk", "clinical"]
+    site_info = [(f"Health Topic {s}", f"https://example.org/topics/{s}", f"Category {s % 8}") for s in range(sites)]
+    now = time.time()
+    for i in range(n):
+        title, url, category = site_info[i % sites]
+        text = " ".join(rng.choice(words) for _ in range(text_len // 7))[:text_len]
+        yield {
+            "source_title": title,
+            "url": url,
+            "text": text,
+            "category": category,
+            "ingested_at": now,
+            "content_hash": f"{rng.getrandbits(128):032x}",
+        }
+
+
+def rss_bytes():
+    """(anonymous, file-backed) resident bytes of this process (Linux /proc)."""
+    fields = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("RssAnon", "RssFile"):
+                fields[key] = int(value.split()[0]) * 1024
+    return fields["RssAnon"], fields["RssFile"]
+
+
+def _measure_metadata(layout: str, path: str, n: int) -> dict:
+    """Loads the stored metadata as the given layout in a fresh process; RSS growth and access times."""
+    gc.collect()
+    anon0, file0 = rss_bytes()
+    _, reader = RagStore(path).open()
+    metas = list(reader) if layout == "list of dicts" else reader
+    t0 = time.perf_counter()
+    for meta in metas:  # also pages the whole file in for the mapped layout
+        meta.get("url")
+    scan_s = time.perf_counter() - t0
+    gc.collect()
+    anon, file = rss_bytes()
+    picks = np.random.default_rng(0).integers(0, n, 10000)
+    t0 = time.perf_counter()
+    for i in picks:
+        metas[int(i)]["text"]
+    read_us = (time.perf_counter() - t0) / len(picks) * 1e6
+    return {"anon": anon - anon0, "file": file - file0, "read_us": read_us, "scan_s": scan_s}
+
+
+def metadata_report(args):
+    """Chunk metadata as the server holds it (mapped metadata.jsonl, decoded per access) vs a list of dicts.
+
+    Each layout is measured in its own process. Anonymous RSS is private to
+    a worker; file-backed RSS of the mapping is page cache shared by every
+    worker on the store.
+    """
+    with tempfile.TemporaryDirectory() as path:
+        RagStore(path).append(np.zeros((args.chunks, 1), dtype=np.float32), list(synthetic_records(args.chunks)))
+        print(f"{args.chunks} chunks of ~800 chars, metadata.jsonl {os.path.getsize(os.path.join(path, 'metadata.jsonl')) / 2**20:.1f} MB")
+        print(f"{'layout':<14} {'anon MB':>8} {'anon B/chunk':>13} {'file MB':>8} {'random read us':>15} {'full scan s':>12}")
+        ctx = multiprocessing.get_context("spawn")
+        for layout in ("list of dicts", "mmap jsonl"):
+            with ctx.Pool(1) as pool:
+                r = pool.apply(_measure_metadata, (layout, path, args.chunks))
+            print(f"{layout:<14} {r['anon'] / 2**20:>8.1f} {r['anon'] / args.chunks:>13.0f} {r['file'] / 2**20:>8.1f} "
+                  f"{r['read_us']:>15.2f} {r['scan_s']:>12.3f}")
+
+
+SENTENCE_ENDS = (".", "!", "?", "\"", "'", ")")
+
+
+def load_page(source: str) -> str:
+    if source.startswith(("http://", "https://")):
+        resp = requests.get(source, headers={"User-Agent": USER_AGENT}, timeout=FETCH_TIMEOUT)
+        resp.raise_for_status()
+        return resp.text
+    with open(source, encoding="utf-8") as f:
+        return f.read()
+
+
+def embedding_hits(chunks: List[str], queries: List[str], k: int) -> List[List[int]]:
+    """Top-k chunk positions per query by OpenAI embedding similarity."""
+    from openai import OpenAI
+    client = OpenAI()
+
+    def embed(texts):
+        vecs = []
+        for start in range(0, len(texts), 256):
+            res = client.embeddings.create(model="text-embedding-3-small", input=texts[start:start + 256])
+            vecs.extend(d.embedding for d in res.data)
+        vecs = np.array(vecs, dtype=np.float32)
+        return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+    return top_k_rows(embed(queries) @ embed(chunks).T, k).tolist()
+
+
+def chunking_report(args):
+    """Chunk count, embedding tokens and retrieval hit rate of chunk_text vs iter_chunks.
+
+    Queries are sentences sampled from the pages; a query is a hit when one of
+    its top-k chunks contains the whole sentence.
+    """
+    pages = [load_page(source) for source in args.pages]
+    splitters = [
+        ("chunk_text", lambda html, url: chunk_text(parse_html(html, url)[1])),
+        ("iter_chunks", lambda html, url: list(iter_chunks(iter_paragraphs(_content_root(html, url)[1])))),
+    ]
+    sentences = [s for html, url in zip(pages, args.pages)
+                 for p in iter_paragraphs(_content_root(html, url)[1])
+                 for s in split_sentences(p) if len(s.split()) >= 8]
+    if not sentences:
+        raise SystemExit("No sentences of 8+ words found in the given pages")
+    queries = random.Random(0).sample(sentences, min(args.queries, len(sentences)))
+
+    print(f"{len(pages)} pages, {len(queries)} sentence queries, hit@{args.k} by "
+          f"{'embeddings' if args.embed else 'BM25'}")
+    print(f"{'splitter':<12} {'chunks':>7} {'tokens':>8} {'tok/chunk':>10} {'mid-sentence':>13} {'hit rate':>9} {'chunk s':>8}")
+    for name, split in splitters:
+        t0 = time.perf_counter()
+        chunks = [c for html, url in zip(pages, args.pages) for c in split(html, url)]
+        split_s = time.perf_counter() - t0
+        tokens = sum(count_tokens(c) for c in chunks)
+        cut = sum(not c.endswith(SENTENCE_ENDS) for c in chunks)
+        if args.embed:
+            hits = embedding_hits(chunks, queries, args.k)
+        else:
+            bm25 = BM25Index()
+            bm25.add(range(len(chunks)), chunks)
+            hits = [[cid for cid, _ in bm25.search(q, args.k)] for q in queries]
+        flat = [" ".join(c.split()) for c in chunks]
+        hit_rate = sum(any(q in flat[i] for i in h) for q, h in zip(queries, hits)) / len(queries)
+        print(f"{name:<12} {len(chunks):>7} {tokens:>8} {tokens / max(len(chunks), 1):>10.0f} "
+              f"{cut:>13} {hit_rate:>9.3f} {split_s:>8.2f}")
+
+
+def reload_check(args):
+    """Saves each FAISS tier with the store, maps it back as the server does and appends to it.
+
+    The writer appends through its own index; a read-only worker maps the
+    saved index, then indexes the rows the writer commits after that.
+    """
+    if faiss is None:
+        raise SystemExit("faiss is required for the reload check (pip install faiss-cpu)")
+    embs = load_corpus(args)
+    n, d = embs.shape
+    extra = synthetic_corpus(args.add, d, seed=2)
+    extra_ids = np.arange(n, n + args.add, dtype=np.int64)
+    failed = False
+    print(f"Corpus: {n} x {d}, appending {args.add} rows after each reload")
+    for kind in ("flat", "hnsw", "ivf", "ivfpq"):
+        if choose_index_kind(n, kind) != kind:
+            print(f"{kind:<6} skipped (too few rows to train)")
+            continue
+        for role in ("writer", "reader"):
+            with tempfile.TemporaryDirectory() as path:
+                store = RagStore(path)
+                store.append(embs, [{"text": str(i)} for i in range(n)])
+                store.write_faiss(build_index(embs, kind, ids=store.read_ids()))
+                # load_index() in the server: mapped, clonable in every worker
+                idx = RagStore(path).read_faiss(use_mmap=True, writable=True)
+                try:
+                    idx = faiss.clone_index(idx)  # _map_committed_rows appends to a copy
+                    if role == "writer":
+                        idx.add_with_ids(extra, extra_ids)
+                    else:
+                        # The writer commits rows; the reader indexes the tail, as _map_committed_rows does
+                        store.append(extra, [{"text": str(i)} for i in extra_ids])
+                        reader_embs, _ = RagStore(path).open()
+                        idx.add_with_ids(np.ascontiguousarray(reader_embs[n:]), extra_ids)
+                    set_search_params(idx, nprobe=64, ef_search=64)
+                    _, found = idx.search(extra, 1)
+                    hits = float(np.mean(found[:, 0] == extra_ids))
+                    status = "ok" if idx.ntotal == n + args.add and hits > 0.9 else "WRONG"
+                    print(f"{kind:<6} {role:<6} {status}: ntotal {idx.ntotal}, appended rows found as top hit {hits:.2f}")
+                except RuntimeError as e:
+                    status = "FAILED"
+                    print(f"{kind:<6} {role:<6} FAILED: {str(e).splitlines()[-1]}")
+                failed |= status != "ok"
+    if failed:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG index benchmarks")
+    parser.add_argument("--index", default="rag_index", help="stored index directory")
+    parser.add_argument("--synthetic", type=int, default=0, help="use N synthetic vectors instead of the stored index")
+    parser.add_argument("--dim", type=int, default=1536, help="dimension of synthetic vectors")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ann = sub.add_parser("ann", help="recall vs latency of the ANN tiers against exact search")
+    ann.add_argument("--queries", type=int, default=200)
+    ann.add_argument("--k", type=int, default=10)
+    ann.set_defaults(func=ann_report)
+
+    batch = sub.add_parser("batch", help="search throughput of one-at-a-time vs batched queries")
+    batch.add_argument("--queries", type=int, default=2000)
+    batch.add_argument("--k", type=int, default=10)
+    batch.add_argument("--kind", default="flat", help="FAISS tier to measure (auto, flat, hnsw, ivf, ivfpq)")
+    batch.add_argument("--batch-sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1, 16, 64, 256])
+    batch.set_defaults(func=batch_report)
+
+    prec = sub.add_parser("precision", help="recall, latency and memory of float32 vs float16/int8 vectors")
+    prec.add_argument("--queries", type=int, default=200)
+    prec.add_argument("--k", type=int, default=10)
+    prec.add_argument("--kind", default="flat", help="FAISS tier to measure (flat, hnsw, ivf)")
+    prec.add_argument("--rerank", type=int, default=4, help="candidates fetched per result for float32 re-ranking")
+    prec.set_defaults(func=precision_report)
+
+    meta = sub.add_parser("metadata", help="RSS and access time of chunk metadata: mapped JSON lines vs list of dicts")
+    meta.add_argument("--chunks", type=int, default=100000)
+    meta.set_defaults(func=metadata_report)
+
+    chunking = sub.add_parser("chunking", help="chunk count, tokens and hit rate: chunk_text vs iter_chunks")
+    chunking.add_argument("pages", nargs="+", help="page URLs or saved HTML files")
+    chunking.add_argument("--queries", type=int, default=200)
+    chunking.add_argument("--k", type=int, default=3)
+    chunking.add_argument("--embed", action="store_true", help="rank with OpenAI embeddings instead of BM25")
+    chunking.set_defaults(func=chunking_report)
+
+    reload = sub.add_parser("reload", help="append to every FAISS tier after saving and mapping it back, as writer and reader")
+    reload.add_argument("--add", type=int, default=100, help="rows appended after the reload")
+    reload.set_defaults(func=reload_check)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
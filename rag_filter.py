@@ -0,0 +1,72 @@
+import threading
+import numpy as np
+from array import array
+from typing import Iterable, List, Optional
+
+# Inverted index from chunk metadata values to chunk IDs, used to restrict a
+# search to a candidate set before scoring. Postings are array("q") so they
+# cost 8 bytes per chunk and are read zero-copy with np.frombuffer.
+FIELDS = ("category", "url")
+
+
+class AttributeIndex:
+    """Maps category/url values to the chunk IDs carrying them, plus an ingested_at column."""
+
+    def __init__(self):
+        self._postings = {field: {} for field in FIELDS}
+        self._ids = array("q")  # every indexed chunk ID, ascending
+        self._ingested_at = array("d")  # aligned with _ids; 0 when unknown
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, ids: Iterable[int], metadatas: Iterable[dict]):
+        with self._lock:
+            for cid, meta in zip(ids, metadatas):
+                cid = int(cid)
+                for field in FIELDS:
+                    value = meta.get(field)
+                    if value is not None:
+                        self._postings[field].setdefault(value, array("q")).append(cid)
+                self._ids.append(cid)
+                self._ingested_at.append(float(meta.get("ingested_at") or 0.0))
+
+    # _union and _ingested_after run under _lock and return copies: an array
+    # cannot grow while a np.frombuffer view of it is alive.
+    def _ingested_after(self, t: float) -> np.ndarray:
+        ids = np.frombuffer(self._ids, dtype=np.int64)
+        return ids[np.frombuffer(self._ingested_at, dtype=np.float64) > t]
+
+    def _union(self, field: str, values: List[str]) -> np.ndarray:
+        lists = [np.frombuffer(self._postings[field][v], dtype=np.int64)
+                 for v in values if v in self._postings[field]]
+        if not lists:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(lists))
+
+    def select(self, categories: List[str] = None, exclude_categories: List[str] = None,
+               urls: List[str] = None, exclude_urls: List[str] = None,
+               ingested_after: float = None) -> Optional[np.ndarray]:
+        """Sorted chunk IDs passing every given condition, or None if no condition is set.
+
+        Include lists match any of their values; exclusions and the date
+        bound apply on top.
+        """
+        if not (categories or exclude_categories or urls or exclude_urls or ingested_after is not None):
+            return None
+        with self._lock:
+            allowed = None
+            for field, values in (("category", categories), ("url", urls)):
+                if values:
+                    ids = self._union(field, values)
+                    allowed = ids if allowed is None else np.intersect1d(allowed, ids, assume_unique=True)
+            if ingested_after is not None:
+                ids = self._ingested_after(ingested_after)
+                allowed = ids if allowed is None else np.intersect1d(allowed, ids, assume_unique=True)
+            if allowed is None:
+                allowed = np.array(self._ids, dtype=np.int64)
+            for field, values in (("category", exclude_categories), ("url", exclude_urls)):
+                if values:
+                    allowed = np.setdiff1d(allowed, self._union(field, values), assume_unique=True)
+            return allowed
@@ -0,0 +1,97 @@
+import re
+import math
+import threading
+import numpy as np
+from array import array
+from collections import Counter
+from typing import Iterable, List, Tuple
+
+# In-process BM25 over chunk text, for exact drug/condition names that
+# embedding similarity blurs. Postings are parallel array("q") chunk IDs and
+# array("I") term frequencies, so memory stays ~12 bytes per (term, chunk).
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have i in is it its of on or that the this to was were
+what when which who will with my me do does can not no your you how
+""".split())
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over chunks keyed by chunk ID; IDs must be added in ascending order."""
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}  # term -> (array("q") chunk IDs, array("I") term freqs)
+        self._ids = array("q")
+        self._lengths = array("I")  # tokens per chunk, aligned with _ids
+        self._total_len = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, ids: Iterable[int], texts: Iterable[str]):
+        with self._lock:
+            for cid, text in zip(ids, texts):
+                cid = int(cid)
+                counts = Counter(tokenize(text))
+                for term, tf in counts.items():
+                    posting = self._postings.get(term)
+                    if posting is None:
+                        posting = self._postings[term] = (array("q"), array("I"))
+                    posting[0].append(cid)
+                    posting[1].append(tf)
+                length = sum(counts.values())
+                self._ids.append(cid)
+                self._lengths.append(length)
+                self._total_len += length
+
+    def _score_terms(self, terms) -> Tuple[np.ndarray, np.ndarray]:
+        # Only called under _lock; the zero-copy views must not outlive this frame
+        # (an array cannot grow while a view of it exists)
+        n = len(self._ids)
+        avgdl = self._total_len / n
+        ids = np.frombuffer(self._ids, dtype=np.int64)
+        lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+        doc_parts, score_parts = [], []
+        for term in terms:
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            docs = np.frombuffer(posting[0], dtype=np.int64)
+            tf = np.frombuffer(posting[1], dtype=np.uint32).astype(np.float32)
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            dl = lengths[np.searchsorted(ids, docs)].astype(np.float32)
+            score_parts.append(idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl / avgdl)))
+            doc_parts.append(docs.copy())
+        if not doc_parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        docs, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        return docs, np.bincount(inverse, weights=np.concatenate(score_parts))
+
+    def search(self, query: str, k: int, allowed: np.ndarray = None,
+               exclude: np.ndarray = None) -> List[Tuple[int, float]]:
+        """Top-k (chunk ID, BM25 score), restricted to sorted allowed IDs and without excluded ones."""
+        terms = set(tokenize(query))
+        with self._lock:
+            if not terms or not self._ids:
+                return []
+            docs, scores = self._score_terms(terms)
+        keep = np.ones(len(docs), dtype=bool)
+        if allowed is not None:
+            keep &= np.isin(docs, allowed, assume_unique=True)
+        if exclude is not None and len(exclude):
+            keep &= ~np.isin(docs, exclude)
+        docs, scores = docs[keep], scores[keep]
+        if len(docs) > k:
+            top = np.argpartition(scores, -k)[-k:]
+            docs, scores = docs[top], scores[top]
+        order = np.argsort(scores)[::-1]
+        return [(int(docs[i]), float(scores[i])) for i in order]
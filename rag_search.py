@@ -0,0 +1,291 @@
+import math
+import numpy as np
+from typing import List, Tuple
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# FAISS index tiers, all over L2-normalized rows with inner-product scores:
+#   flat  - exact brute force (IndexFlatIP)
+#   hnsw  - graph search, no training, incremental adds (IndexHNSWFlat)
+#   ivf   - k-means partitioned lists, needs training (IndexIVFFlat)
+#   ivfpq - ivf with product-quantized codes, smallest memory (IndexIVFPQ)
+# The server wraps the tier in an IndexIDMap so searches return stable chunk
+# IDs rather than row positions (rows move when the store is compacted).
+# "auto" picks a tier from the corpus size using the thresholds below; an
+# explicit ivf/ivfpq request still falls back to flat until there is enough
+# data to train the centroids and PQ codebooks.
+INDEX_KINDS = ("flat", "hnsw", "ivf", "ivfpq")
+AUTO_HNSW_MIN_ROWS = 20_000
+AUTO_IVF_MIN_ROWS = 1_000_000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+PQ_M = 64  # sub-quantizers; must divide the embedding dim (1536 / 64 = 24)
+TRAIN_POINTS_PER_LIST = 39  # FAISS warns below this many training points per list
+MIN_TRAIN_ROWS = 256 * TRAIN_POINTS_PER_LIST  # trained tiers fall back to flat below this
+MAX_TRAIN_ROWS = 200_000
+# Storage precision of the vectors inside the index. float16 halves and int8
+# quarters the memory of the flat/hnsw/ivf tiers (ivfpq codes are already
+# compressed); int8 uses a per-dimension range fitted on the rows it is built
+# from, and later rows outside that range are clipped until it is refitted.
+PRECISIONS = ("float32", "float16", "int8")
+INT8_REFIT_GROWTH = 2  # refit int8 ranges each time the corpus doubles...
+INT8_STABLE_ROWS = 50_000  # ...until they were fitted on this many rows
+QUANTIZED_BLOCK_ROWS = 4096  # rows decoded to float32 at a time by QuantizedRows.scores
+
+
+def choose_index_kind(n_rows: int, kind: str = "auto") -> str:
+    """Resolves "auto" to a concrete tier for a corpus of n_rows."""
+    if kind != "auto":
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"Unknown index kind {kind!r}, expected auto or one of {INDEX_KINDS}")
+        if kind in ("ivf", "ivfpq") and n_rows < MIN_TRAIN_ROWS:
+            return "flat"
+        return kind
+    if n_rows >= AUTO_IVF_MIN_ROWS:
+        return "ivf"
+    if n_rows >= AUTO_HNSW_MIN_ROWS:
+        return "hnsw"
+    return "flat"
+
+
+def default_nlist(n_rows: int) -> int:
+    """Number of IVF lists: ~4*sqrt(n), capped so each list gets enough training points."""
+    nlist = int(4 * math.sqrt(max(n_rows, 1)))
+    return max(1, min(nlist, n_rows // TRAIN_POINTS_PER_LIST))
+
+
+def check_precision(precision: str) -> str:
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    return precision
+
+
+def _sq_type(precision: str):
+    return faiss.ScalarQuantizer.QT_fp16 if precision == "float16" else faiss.ScalarQuantizer.QT_8bit
+
+
+def build_index(embs: np.ndarray, kind: str = "flat", nlist: int = None, ids: np.ndarray = None,
+                precision: str = "float32"):
+    """Builds and fills a FAISS index of the given tier over normalized rows.
+
+    With ids the tier is wrapped in an IndexIDMap and searches return those IDs.
+    A float16/int8 precision stores scalar-quantized vectors (IndexScalarQuantizer
+    and its HNSW/IVF counterparts) instead of float32 ones.
+    """
+    embs = np.ascontiguousarray(embs, dtype=np.float32)
+    n, d = embs.shape
+    quantized = check_precision(precision) != "float32" and kind != "ivfpq"
+    if kind == "flat":
+        if quantized:
+            idx = faiss.IndexScalarQuantizer(d, _sq_type(precision), faiss.METRIC_INNER_PRODUCT)
+        else:
+            idx = faiss.IndexFlatIP(d)
+    elif kind == "hnsw":
+        if quantized:
+            idx = faiss.IndexHNSWSQ(d, _sq_type(precision), HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        else:
+            idx = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        idx.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif kind in ("ivf", "ivfpq"):
+        nlist = nlist or default_nlist(n)
+        quantizer = faiss.IndexFlatIP(d)
+        if kind == "ivfpq":
+            idx = faiss.IndexIVFPQ(quantizer, d, nlist, PQ_M, 8, faiss.METRIC_INNER_PRODUCT)
+        elif quantized:
+            idx = faiss.IndexIVFScalarQuantizer(quantizer, d, nlist, _sq_type(precision),
+                                                faiss.METRIC_INNER_PRODUCT)
+        else:
+            idx = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"Unknown index kind {kind!r}")
+    if not idx.is_trained:
+        if n > MAX_TRAIN_ROWS:
+            sample = embs[np.random.default_rng(0).choice(n, MAX_TRAIN_ROWS, replace=False)]
+        else:
+            sample = embs
+        idx.train(sample)
+    if ids is not None:
+        idx = faiss.IndexIDMap(idx)
+        if n:
+            idx.add_with_ids(embs, np.ascontiguousarray(ids, dtype=np.int64))
+    elif n:
+        idx.add(embs)
+    return idx
+
+
+def base_index(idx):
+    """The tier index inside an IndexIDMap wrapper (or idx itself)."""
+    idx = faiss.downcast_index(idx)
+    if isinstance(idx, faiss.IndexIDMap):
+        idx = faiss.downcast_index(idx.index)
+    return idx
+
+
+def set_search_params(idx, nprobe: int = None, ef_search: int = None):
+    """Applies query-time knobs: nprobe for IVF tiers, efSearch for HNSW."""
+    if idx is None:
+        return
+    if nprobe:
+        try:
+            faiss.extract_index_ivf(idx).nprobe = nprobe
+        except RuntimeError:
+            pass  # not an IVF index
+    base = base_index(idx)
+    if ef_search and hasattr(base, "hnsw"):
+        base.hnsw.efSearch = ef_search
+
+
+def index_kind_of(idx) -> str:
+    """Reports which tier a (possibly loaded-from-disk) FAISS index belongs to."""
+    idx = base_index(idx)
+    if isinstance(idx, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(idx, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(idx, faiss.IndexIVF):
+        return "ivf"
+    return "flat"
+
+
+def index_precision_of(idx) -> str:
+    """Storage precision of a FAISS index's vectors ("float32" for flat and PQ storage)."""
+    idx = base_index(idx)
+    if isinstance(idx, faiss.IndexHNSW):
+        idx = faiss.downcast_index(idx.storage)
+    sq = getattr(idx, "sq", None)
+    if sq is None:
+        return "float32"
+    return "float16" if sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+
+
+def int8_refit_due(precision: str, fitted_rows: int, n_rows: int) -> bool:
+    """Whether int8 ranges fitted on fitted_rows rows should be refitted for a corpus of n_rows.
+
+    Rows outside the fitted range are clipped, so ranges fitted on a small
+    first batch are refitted each time the corpus grows INT8_REFIT_GROWTH-fold,
+    until they were fitted on INT8_STABLE_ROWS rows.
+    """
+    return (precision == "int8" and fitted_rows < INT8_STABLE_ROWS
+            and n_rows >= INT8_REFIT_GROWTH * max(fitted_rows, 1))
+
+
+class QuantizedRows:
+    """float16 or int8 copy of a row matrix for exact-search scoring without FAISS.
+
+    int8 codes are round(x / scale) with a per-dimension scale fitted by the
+    first append() (on fitted_rows rows); the scale is folded into the query so
+    scoring is one float32 GEMM per block of decoded rows.
+    """
+
+    def __init__(self, precision: str, dim: int):
+        self.precision = check_precision(precision)
+        self.dtype = np.float16 if precision == "float16" else np.int8
+        self.scale = None
+        self.fitted_rows = 0
+        self._codes = np.empty((0, dim), dtype=self.dtype)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def nbytes(self) -> int:
+        return self._n * self._codes.shape[1] * self._codes.itemsize
+
+    @classmethod
+    def from_rows(cls, embs: np.ndarray, precision: str) -> "QuantizedRows":
+        """Encodes embs block by block, so a memory-mapped matrix is never copied whole."""
+        rows = cls(precision, embs.shape[1])
+        if rows.dtype == np.int8 and len(embs):
+            peak = np.zeros(embs.shape[1], dtype=np.float32)
+            for start in range(0, len(embs), QUANTIZED_BLOCK_ROWS):
+                np.maximum(peak, np.abs(embs[start:start + QUANTIZED_BLOCK_ROWS]).max(axis=0), out=peak)
+            rows.scale = np.maximum(peak, 1e-6) / 127
+            rows.fitted_rows = len(embs)
+        for start in range(0, len(embs), QUANTIZED_BLOCK_ROWS):
+            rows.append(embs[start:start + QUANTIZED_BLOCK_ROWS])
+        return rows
+
+    def encode(self, embs: np.ndarray) -> np.ndarray:
+        if self.dtype == np.float16:
+            return embs.astype(np.float16)
+        if self.scale is None:
+            self.scale = np.maximum(np.abs(embs).max(axis=0), 1e-6).astype(np.float32) / 127
+            self.fitted_rows = len(embs)
+        return np.clip(np.rint(embs / self.scale), -127, 127).astype(np.int8)
+
+    def append(self, embs: np.ndarray):
+        codes = self.encode(np.asarray(embs, dtype=np.float32))
+        end = self._n + len(codes)
+        if end > len(self._codes):
+            grown = np.empty((max(end, 2 * len(self._codes)), self._codes.shape[1]), dtype=self.dtype)
+            grown[:self._n] = self._codes[:self._n]
+            self._codes = grown
+        self._codes[self._n:end] = codes
+        self._n = end
+
+    def scores(self, q: np.ndarray, n: int = None, out: np.ndarray = None) -> np.ndarray:
+        """Approximate q @ rows.T over the first n rows, decoding QUANTIZED_BLOCK_ROWS at a time."""
+        n = self._n if n is None else min(n, self._n)
+        q = np.ascontiguousarray(q * self.scale if self.scale is not None else q, dtype=np.float32)
+        if out is None:
+            out = np.empty((len(q), n), dtype=np.float32)
+        for start in range(0, n, QUANTIZED_BLOCK_ROWS):
+            end = min(start + QUANTIZED_BLOCK_ROWS, n)
+            out[:, start:end] = q @ self._codes[start:end].astype(np.float32).T
+        return out
+
+
+def rerank_rows(q: np.ndarray, embs: np.ndarray, rows, k: int) -> List[Tuple[float, int]]:
+    """(exact score, row) of the k best candidate rows for one query, re-scored against float32 embs."""
+    rows = np.sort(np.asarray(rows, dtype=np.int64))  # reads a memory-mapped matrix front to back
+    exact = embs[rows] @ q
+    top = np.argsort(exact)[::-1][:k]
+    return [(float(exact[i]), int(rows[i])) for i in top]
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k highest scores in each row, best first, via O(n) partial selection."""
+    m, n = scores.shape
+    k = min(k, n)
+    if k <= 0:
+        return np.empty((m, 0), dtype=np.int64)
+    if k < n:
+        part = np.argpartition(scores, -k, axis=1)[:, -k:]
+    else:
+        part = np.broadcast_to(np.arange(n), (m, n))
+    order = np.argsort(np.take_along_axis(scores, part, axis=1), axis=1)[:, ::-1]
+    return np.take_along_axis(part, order, axis=1)
+
+
+def id_selector(allowed_ids: np.ndarray, id_bound: int):
+    """IDSelectorBitmap over [0, id_bound) accepting exactly allowed_ids.
+
+    Returns (selector, bitmap); keep the bitmap alive while the selector is in use.
+    """
+    bits = np.zeros(id_bound, dtype=bool)
+    bits[allowed_ids] = True
+    bitmap = np.packbits(bits, bitorder="little")
+    # n is the bitmap's size in bytes; IDs past it are rejected
+    return faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)), bitmap
+
+
+def search_params(idx, sel=None, nprobe: int = None, ef_search: int = None):
+    """SearchParameters of the type idx's tier expects, optionally restricted by an IDSelector."""
+    kind = index_kind_of(idx)
+    if kind in ("ivf", "ivfpq"):
+        params = faiss.SearchParametersIVF()
+        if nprobe:
+            params.nprobe = nprobe
+    elif kind == "hnsw":
+        params = faiss.SearchParametersHNSW()
+        if ef_search:
+            params.efSearch = ef_search
+    else:
+        params = faiss.SearchParameters()
+    if sel is not None:
+        params.sel = sel
+    return params
@@ -0,0 +1,498 @@
+import os
+import sys
+import json
+import mmap
+import time
+import pickle
+import hashlib
+import threading
+import numpy as np
+from contextlib import contextmanager
+from typing import List, Optional
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Optional fcntl (POSIX) for the inter-process locks; without it a single process is assumed
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# On-disk RAG index layout (one directory):
+#   manifest.json    - format version, dim, committed row count and byte sizes
+#   embeddings.f32   - raw little-endian float32 rows, appended, opened with np.memmap
+#   metadata.jsonl   - one JSON object per chunk, appended
+#   metadata.idx     - little-endian uint64 byte offset of each metadata line
+#   ids.i64          - little-endian int64 stable chunk ID of each row (ascending)
+#   tombstones.i64   - chunk IDs deleted since the last compaction
+#   faiss.index      - optional prebuilt FAISS index (faiss.write_index)
+#   sources.json     - per-URL crawl state (ETag, Last-Modified, body and chunk hashes)
+#   write.lock       - flock'd around every write, so processes never interleave them
+#   writer.lock      - flock'd for life by the one process allowed to write (acquire_writer)
+# Data files are appended first and the manifest is replaced atomically last,
+# so readers only ever see rows covered by a complete manifest. Compaction
+# writes the live rows to a new generation of data files (named in the
+# manifest's "files") and swaps the manifest, so readers of the old files are
+# never disturbed. Chunk IDs survive compaction; row positions do not.
+# "embeddings_sha256" in the manifest is a hash chain over every appended
+# embedding batch; the FAISS file records the chain value it was built from
+# and is only reused while both still match.
+
+FORMAT_NAME = "medhelp-rag"
+FORMAT_VERSION = 2  # v2 added ids.i64; v1 stores are upgraded on first append
+MANIFEST = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.f32"
+METADATA_FILE = "metadata.jsonl"
+OFFSETS_FILE = "metadata.idx"
+IDS_FILE = "ids.i64"
+TOMBSTONES_FILE = "tombstones.i64"
+FAISS_FILE = "faiss.index"
+SOURCES_FILE = "sources.json"
+LOCK_FILE = "write.lock"
+WRITER_FILE = "writer.lock"
+EMB_DTYPE = np.dtype("<f4")
+OFFSET_DTYPE = np.dtype("<u8")
+ID_DTYPE = np.dtype("<i8")
+DATA_FILES = {
+    "embeddings": EMBEDDINGS_FILE,
+    "metadata": METADATA_FILE,
+    "offsets": OFFSETS_FILE,
+    "ids": IDS_FILE,
+}
+
+
+class MetadataReader:
+    """Read-only sequence over metadata.jsonl; records are decoded on access, so each read is a fresh dict."""
+
+    def __init__(self, path: str = None, offsets_path: str = None, count: int = 0, size: int = 0):
+        self._count = count
+        self._file = None
+        self._mm = None
+        self._offsets = None
+        if count:
+            self._file = open(path, "rb")
+            self._mm = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+            self._offsets = np.memmap(offsets_path, dtype=OFFSET_DTYPE, mode="r", shape=(count,))
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("metadata index out of range")
+        start = int(self._offsets[i])
+        end = self._mm.find(b"\n", start)
+        return json.loads(self._mm[start:end])
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+
+class RagStore:
+    """Versioned, append-only index storage rooted at a directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+        self._writer_file = None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def locked(self):
+        """Exclusive lock over the store's files, across processes; reentrant within one."""
+        with self._lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                os.makedirs(self.path, exist_ok=True)
+                self._lock_file = open(self._file(LOCK_FILE), "a")
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_file is not None:
+                    self._lock_file.close()  # releases the flock
+                    self._lock_file = None
+
+    def acquire_writer(self) -> bool:
+        """Claims the single writer role for this process, until it exits.
+
+        Returns False while another process holds it. Each writer assigns
+        chunk IDs from its own in-memory state, so only one process may
+        append, delete or compact; the others only read.
+        """
+        if fcntl is None or self._writer_file is not None:
+            return True
+        os.makedirs(self.path, exist_ok=True)
+        f = open(self._file(WRITER_FILE), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._writer_file = f
+        return True
+
+    def exists(self) -> bool:
+        return os.path.exists(self._file(MANIFEST))
+
+    def read_manifest(self) -> Optional[dict]:
+        if not self.exists():
+            return None
+        with open(self._file(MANIFEST), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != FORMAT_NAME:
+            raise ValueError(f"{self.path} is not a {FORMAT_NAME} index")
+        if manifest.get("version", 0) > FORMAT_VERSION:
+            raise ValueError(f"Index format v{manifest['version']} is newer than supported v{FORMAT_VERSION}")
+        return manifest
+
+    def _write_manifest(self, manifest: dict):
+        manifest["updated_at"] = time.time()
+        tmp = self._file(MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file(MANIFEST))
+
+    def _empty_manifest(self, dim: int) -> dict:
+        return {
+            "format": FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "dim": dim,
+            "dtype": EMB_DTYPE.str,
+            "count": 0,
+            "next_id": 0,
+            "metadata_bytes": 0,
+            "embeddings_sha256": "",
+            "files": dict(DATA_FILES),
+        }
+
+    @staticmethod
+    def _files(manifest: dict) -> dict:
+        """Data file names of the manifest's generation (v1 manifests lack "ids")."""
+        files = dict(DATA_FILES)
+        files.update(manifest.get("files", {}))
+        return files
+
+    def open(self):
+        """Maps the committed rows; returns (embeddings memmap or None, MetadataReader)."""
+        manifest = self.read_manifest()
+        if manifest is None or manifest["count"] == 0:
+            return None, MetadataReader()
+        count, dim = manifest["count"], manifest["dim"]
+        files = self._files(manifest)
+        embs = np.memmap(self._file(files["embeddings"]), dtype=EMB_DTYPE, mode="r", shape=(count, dim))
+        metas = MetadataReader(self._file(files["metadata"]), self._file(files["offsets"]),
+                               count, manifest["metadata_bytes"])
+        return embs, metas
+
+    def read_ids(self) -> np.ndarray:
+        """Chunk ID of each committed row; v1 stores used the row position."""
+        manifest = self.read_manifest()
+        if manifest is None or manifest["count"] == 0:
+            return np.empty(0, dtype=np.int64)
+        path = self._file(self._files(manifest)["ids"])
+        if manifest.get("version", 1) < 2 or not os.path.exists(path):
+            return np.arange(manifest["count"], dtype=np.int64)
+        return np.memmap(path, dtype=ID_DTYPE, mode="r", shape=(manifest["count"],))
+
+    def _truncate_to(self, manifest: dict):
+        """Drops bytes left behind by an interrupted append."""
+        files = self._files(manifest)
+        if manifest.get("version", 1) < 2:
+            # Upgrade a v1 store: existing rows keep their positions as IDs
+            with open(self._file(files["ids"]), "wb") as f:
+                f.write(np.arange(manifest["count"], dtype=ID_DTYPE).tobytes())
+            manifest["version"] = FORMAT_VERSION
+            manifest["next_id"] = manifest["count"]
+            manifest["files"] = files
+        sizes = {
+            files["embeddings"]: manifest["count"] * manifest["dim"] * EMB_DTYPE.itemsize,
+            files["metadata"]: manifest["metadata_bytes"],
+            files["offsets"]: manifest["count"] * OFFSET_DTYPE.itemsize,
+            files["ids"]: manifest["count"] * ID_DTYPE.itemsize,
+        }
+        for name, size in sizes.items():
+            path = self._file(name)
+            if not os.path.exists(path):
+                open(path, "wb").close()
+            elif os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    def _write_rows(self, manifest: dict, embeddings: np.ndarray, metadatas: List[dict], ids: np.ndarray):
+        """Appends rows to the manifest's data files and advances the manifest (not yet saved)."""
+        files = self._files(manifest)
+        pos = manifest["metadata_bytes"]
+        offsets = np.empty(len(metadatas), dtype=OFFSET_DTYPE)
+        lines = []
+        for i, meta in enumerate(metadatas):
+            line = json.dumps(dict(meta), ensure_ascii=False).encode("utf-8") + b"\n"
+            offsets[i] = pos
+            pos += len(line)
+            lines.append(line)
+
+        for name, payload in ((files["embeddings"], embeddings.tobytes()),
+                              (files["metadata"], b"".join(lines)),
+                              (files["offsets"], offsets.tobytes()),
+                              (files["ids"], ids.tobytes())):
+            with open(self._file(name), "ab") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+
+        chain = hashlib.sha256(manifest.get("embeddings_sha256", "").encode("ascii"))
+        chain.update(embeddings.tobytes())
+        manifest["embeddings_sha256"] = chain.hexdigest()
+        manifest["count"] += len(embeddings)
+        manifest["next_id"] = max(manifest.get("next_id", 0), int(ids[-1]) + 1)
+        manifest["metadata_bytes"] = pos
+
+    @staticmethod
+    def _check_rows(embeddings: np.ndarray, metadatas: List[dict], ids):
+        embeddings = np.ascontiguousarray(embeddings, dtype=EMB_DTYPE)
+        if len(embeddings) != len(metadatas):
+            raise ValueError(f"{len(embeddings)} embeddings but {len(metadatas)} metadata records")
+        if ids is not None:
+            ids = np.ascontiguousarray(ids, dtype=ID_DTYPE)
+            if len(ids) != len(embeddings):
+                raise ValueError(f"{len(embeddings)} embeddings but {len(ids)} ids")
+        return embeddings, ids
+
+    def append(self, embeddings: np.ndarray, metadatas: List[dict], ids: np.ndarray = None):
+        """Appends rows to the data files, then commits them in the manifest.
+
+        ids default to the next free chunk IDs; given ids must ascend past
+        every stored one.
+        """
+        embeddings, ids = self._check_rows(embeddings, metadatas, ids)
+        if len(embeddings) == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        # Under the lock the manifest (and its next_id) is current, and the
+        # bytes past it really are leftovers, not another process's append
+        with self.locked():
+            manifest = self.read_manifest() or self._empty_manifest(embeddings.shape[1])
+            if embeddings.shape[1] != manifest["dim"]:
+                raise ValueError(f"Embedding dim {embeddings.shape[1]} does not match stored dim {manifest['dim']}")
+            self._truncate_to(manifest)
+            if ids is None:
+                ids = np.arange(manifest["next_id"], manifest["next_id"] + len(embeddings), dtype=ID_DTYPE)
+            elif ids[0] < manifest["next_id"] or np.any(np.diff(ids) <= 0):
+                raise ValueError("Chunk ids must be ascending and larger than every stored id")
+            self._write_rows(manifest, embeddings, metadatas, ids)
+            self._write_manifest(manifest)
+
+    def write(self, embeddings: np.ndarray, metadatas: List[dict]):
+        """Replaces the stored index with the given rows."""
+        with self.locked():
+            manifest = self.read_manifest()
+            if manifest is not None:
+                os.remove(self._file(MANIFEST))
+                self._remove_files(self._files(manifest).values())
+            self._remove_files([FAISS_FILE, TOMBSTONES_FILE])
+            self.append(embeddings, metadatas)
+
+    def _remove_files(self, names):
+        for name in names:
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+
+    def compact(self, embeddings: np.ndarray, metadatas: List[dict], ids: np.ndarray,
+                dropped_ids: np.ndarray = None):
+        """Rewrites the store as exactly the given (live) rows, keeping their chunk IDs.
+
+        The rows go to a fresh generation of data files; the manifest swap
+        commits them and the old generation is removed afterwards.
+        dropped_ids are removed from the tombstone file.
+        """
+        self.commit_generation(self.write_generation(embeddings, metadatas, ids), dropped_ids=dropped_ids)
+
+    def write_generation(self, embeddings: np.ndarray, metadatas: List[dict], ids: np.ndarray) -> dict:
+        """Writes rows to the next generation of data files without committing them; returns its manifest.
+
+        Runs without the store lock, so appends and deletes go on meanwhile;
+        only the writer compacts, one compaction at a time.
+        """
+        embeddings, ids = self._check_rows(embeddings, metadatas, ids)
+        old = self.read_manifest()
+        if old is None:
+            raise ValueError(f"No index to compact in {self.path}")
+        manifest = self._empty_manifest(old["dim"])
+        manifest["generation"] = old.get("generation", 0) + 1
+        manifest["next_id"] = old.get("next_id", old["count"])
+        manifest["files"] = {key: f"{name}.{manifest['generation']}" for key, name in DATA_FILES.items()}
+        self._remove_files(manifest["files"].values())  # leftovers of an interrupted compaction
+        for name in manifest["files"].values():
+            open(self._file(name), "wb").close()
+        if len(embeddings):
+            self._write_rows(manifest, embeddings, metadatas, ids)
+        return manifest
+
+    def commit_generation(self, manifest: dict, embeddings: np.ndarray = None, metadatas: List[dict] = None,
+                          ids: np.ndarray = None, dropped_ids: np.ndarray = None):
+        """Appends the given rows (committed since write_generation()) to the new generation, then swaps it in.
+
+        The old generation is removed afterwards and dropped_ids are removed
+        from the tombstone file.
+        """
+        with self.locked():
+            old = self.read_manifest()
+            if old is None or old.get("generation", 0) + 1 != manifest["generation"]:
+                raise ValueError(f"{self.path} changed generation during the compaction")
+            if embeddings is not None:
+                embeddings, ids = self._check_rows(embeddings, metadatas, ids)
+                if len(embeddings):
+                    self._write_rows(manifest, embeddings, metadatas, ids)
+            manifest["next_id"] = max(manifest["next_id"], old.get("next_id", old["count"]))
+            self._write_manifest(manifest)
+            try:
+                self._remove_files(self._files(old).values())
+            except OSError as e:
+                print(f"Could not remove old index files: {e}")  # still mapped on some platforms
+            if dropped_ids is not None and len(dropped_ids):
+                self.write_tombstones(np.setdiff1d(self.read_tombstones(), dropped_ids))
+
+    def read_tombstones(self) -> np.ndarray:
+        """Chunk IDs deleted since the last compaction."""
+        path = self._file(TOMBSTONES_FILE)
+        if not os.path.exists(path):
+            return np.empty(0, dtype=np.int64)
+        return np.fromfile(path, dtype=ID_DTYPE).astype(np.int64)
+
+    def write_tombstones(self, ids: np.ndarray):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._file(TOMBSTONES_FILE + ".tmp")
+        with self.locked():
+            with open(tmp, "wb") as f:
+                f.write(np.unique(np.asarray(ids, dtype=ID_DTYPE)).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._file(TOMBSTONES_FILE))
+
+    def read_sources(self) -> dict:
+        """Per-URL crawl state saved by write_sources(), or {}."""
+        path = self._file(SOURCES_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def write_sources(self, sources: dict):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self._file(SOURCES_FILE + ".tmp")
+        with self.locked():
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(sources, f, ensure_ascii=False)
+            os.replace(tmp, self._file(SOURCES_FILE))
+
+    def write_faiss(self, faiss_index, trained_rows: int = None) -> bool:
+        """Saves a FAISS index built over exactly the committed rows.
+
+        trained_rows is how many rows its quantizer was fitted on (default: all).
+        """
+        if faiss is None or faiss_index is None:
+            return False
+        with self.locked():
+            manifest = self.read_manifest()
+            if manifest is None or faiss_index.ntotal != manifest["count"]:
+                return False
+            tmp = self._file(FAISS_FILE + ".tmp")
+            faiss.write_index(faiss_index, tmp)
+            os.replace(tmp, self._file(FAISS_FILE))
+            manifest["faiss"] = {
+                "file": FAISS_FILE,
+                "count": manifest["count"],
+                "embeddings_sha256": manifest["embeddings_sha256"],
+                "trained_rows": faiss_index.ntotal if trained_rows is None else trained_rows,
+            }
+            self._write_manifest(manifest)
+        return True
+
+    def faiss_trained_rows(self) -> int:
+        """Rows the saved FAISS index's quantizer was fitted on (0 if unknown)."""
+        manifest = self.read_manifest()
+        saved = manifest.get("faiss") if manifest else None
+        return saved.get("trained_rows", 0) if saved else 0
+
+    def version(self) -> tuple:
+        """(generation, row count, tombstones mtime); changes with every commit, compaction or delete."""
+        manifest = self.read_manifest()
+        if manifest is None:
+            return None
+        try:
+            deleted = os.stat(self._file(TOMBSTONES_FILE)).st_mtime_ns
+        except FileNotFoundError:
+            deleted = 0
+        return manifest.get("generation", 0), manifest["count"], deleted
+
+    def faiss_is_current(self) -> bool:
+        manifest = self.read_manifest()
+        if manifest is None:
+            return False
+        saved = manifest.get("faiss")
+        return (saved is not None
+                and saved["count"] == manifest["count"]
+                and saved["embeddings_sha256"] == manifest.get("embeddings_sha256")
+                and os.path.exists(self._file(saved["file"])))
+
+    def read_faiss(self, use_mmap: bool = True, writable: bool = False):
+        """Loads the saved FAISS index, or returns None if it is missing or stale.
+
+        With writable, the result accepts add_with_ids: a mapped IVF index
+        keeps its lists in a read-only OnDiskInvertedLists, so it is read
+        into RAM instead (flat and HNSW indexes copy on the first append).
+        """
+        if faiss is None or not self.faiss_is_current():
+            return None
+        flags = faiss.IO_FLAG_MMAP if use_mmap else 0
+        try:
+            idx = faiss.read_index(self._file(FAISS_FILE), flags)
+            if use_mmap and writable and _has_read_only_lists(idx):
+                idx = faiss.read_index(self._file(FAISS_FILE))
+            return idx
+        except Exception as e:
+            print(f"Could not read {FAISS_FILE}: {e}")
+            return None
+
+
+def _has_read_only_lists(idx) -> bool:
+    ivf = faiss.try_extract_index_ivf(idx)
+    return ivf is not None and isinstance(faiss.downcast_InvertedLists(ivf.invlists), faiss.OnDiskInvertedLists)
+
+
+def convert_pickle(pkl_path: str, store_path: str) -> int:
+    """One-shot conversion of a legacy rag_index.pkl into the on-disk store."""
+    with open(pkl_path, "rb") as f:
+        data = pickle.load(f)
+    stored = data.get("index", {})
+    embs = stored.get("embeddings")
+    metas = list(stored.get("metadatas", []))
+    if embs is None or len(embs) == 0:
+        return 0
+    embs = np.array(embs, dtype=np.float32)
+    # The store holds L2-normalized rows, which the server searches directly
+    embs /= (np.linalg.norm(embs, axis=1, keepdims=True) + 1e-12)
+    RagStore(store_path).write(embs, metas)
+    return len(metas)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python rag_store.py <rag_index.pkl> <index_dir>")
+        sys.exit(1)
+    n = convert_pickle(sys.argv[1], sys.argv[2])
+    print(f"Converted {n} chunks into {sys.argv[2]}")
@@ -1,20 +1,33 @@
 import os
+import re
 import json
 import time
-import pickle
-import requests
+import random
+import asyncio
+import threading
+from collections import defaultdict
 import numpy as np
 from datetime import datetime
 from typing import List, Tuple, Optional
 from bson import ObjectId
-from bs4 import BeautifulSoup
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+
+from rag_store import MetadataReader, RagStore, convert_pickle
+from rag_search import (QuantizedRows, build_index, check_precision, choose_index_kind,
+                        id_selector, index_kind_of, index_precision_of, int8_refit_due, rerank_rows, search_params,
+                        set_search_params, top_k_rows)
+from rag_filter import AttributeIndex
+from rag_lexical import BM25Index
+from embed_cache import EmbeddingCache, normalize_query
+from chat_prompt import assemble_prompt, format_message
+from ingest import JobQueue, chunk_hash, run_ingest_pipeline
 
 MAX_QUESTIONS = 10
 
@@ -26,6 +39,14 @@ try:
 except ImportError:
     faiss = None
     _HAS_FAISS = False
+
+# Optional Motor for non-blocking MongoDB access in /chat_step
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+    _HAS_MOTOR = True
+except ImportError:
+    AsyncIOMotorClient = None
+    _HAS_MOTOR = False
     
     
     
@@ -38,14 +59,37 @@ load_dotenv("backend/sourceCode/.env") # Keep your existing path
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MONGO_URI = os.getenv("MONGO_CONNECTION_STRING")
 EMBED_MODEL = "text-embedding-3-small"
-INDEX_PKL = "rag_index.pkl"
+INDEX_DIR = "rag_index"
+INDEX_PKL = "rag_index.pkl"  # legacy format, converted on first load
+FAISS_MMAP = True  # map the saved FAISS index instead of reading it into RAM
+INDEX_KIND = os.getenv("RAG_INDEX_KIND", "auto")  # auto | flat | hnsw | ivf | ivfpq
+NPROBE = int(os.getenv("RAG_NPROBE", "16"))  # IVF lists scanned per query
+EF_SEARCH = int(os.getenv("RAG_EF_SEARCH", "64"))  # HNSW candidate list size
+EMBED_PRECISION = check_precision(os.getenv("RAG_PRECISION", "float32"))  # float32 | float16 | int8 searched vectors
+RERANK_FACTOR = int(os.getenv("RAG_RERANK", "4"))  # quantized searches re-score top_k * this in float32; 0 disables
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "5000"))  # query embeddings kept in memory
+EMBED_CACHE_FILE = os.getenv("EMBED_CACHE_FILE", "embed_cache.npz")  # empty to disable persistence
+EMBED_MAX_ATTEMPTS = 4  # per embedding batch, with exponential backoff
+INGEST_JOB_WORKERS = 2  # ingestion jobs running at the same time
+JOB_POLL_SECONDS = 1.0  # how often the writer looks for write jobs forwarded by read-only workers
+COMPACT_TOMBSTONE_RATIO = float(os.getenv("RAG_COMPACT_RATIO", "0.2"))  # deleted share of rows that triggers compaction
+STORE_REFRESH_SECONDS = float(os.getenv("RAG_STORE_REFRESH", "5"))  # how often read-only workers look for the writer's changes
 SIMILARITY_THRESHOLD = 0.25
 TOP_K = 3
+QUERY_EMBED_BATCH = 512  # queries per embeddings request in retrieve_many
+QUERY_BLOCK = 256  # queries per FAISS search / GEMM in search_many
+SCORE_BLOCK_FLOATS = 1 << 24  # cap on the NumPy score matrix (64 MB)
+MAX_BATCH_QUERIES = 10000
+FILTER_EXACT_MAX = 20000  # filters matching at most this many chunks are scored exactly, without FAISS
+HYBRID_SEARCH = os.getenv("RAG_HYBRID", "1") != "0"  # fuse BM25 with vector search in retrieve()
+FUSION_CANDIDATES = 20  # hits taken from each ranking before fusion
+RRF_K = 60  # reciprocal-rank fusion constant
 
 if not OPENAI_API_KEY:
     print("CRITICAL: OPENAI_API_KEY not found in .env")
 
 client = OpenAI(api_key=OPENAI_API_KEY)
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 # MongoDB Setup
 mongo_client = MongoClient(MONGO_URI)
@@ -54,6 +98,30 @@ conversations_collection = db["Conversations"]
 users_collection = db["Users"] # <--- NEW: Reference to Users collection
 
 
+class ThreadedCollection:
+    """Awaitable stand-in for a Motor collection: runs PyMongo calls in worker threads."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+
+# Async handles used by the chat pipeline
+if _HAS_MOTOR:
+    async_db = AsyncIOMotorClient(MONGO_URI)["MedHelp"]
+    async_conversations = async_db["Conversations"]
+    async_users = async_db["Users"]
+else:
+    async_conversations = ThreadedCollection(conversations_collection)
+    async_users = ThreadedCollection(users_collection)
+
+
 app = FastAPI()
 
 app.add_middleware(
@@ -65,9 +133,54 @@ app.add_middleware(
 )
 
 # ---------- RAG STATE ----------
-# Global index to hold embeddings and metadata
-index = {"embeddings": None, "metadatas": [], "dim": None}
+# Global index to hold embeddings and metadata. The rows are committed to the
+# store before they are indexed, so index["embeddings"] is always a memmap of
+# embeddings.f32 and the float32 rows never take anonymous RAM; searches and
+# re-ranking read only the rows they touch. Rows are stored L2-normalized so
+# search is a plain inner product. index["ids"] holds the stable chunk ID of
+# each row (ascending); FAISS returns these, not row positions.
+index = {"embeddings": None, "metadatas": MetadataReader(), "ids": None, "dim": None}
 faiss_index = None
+_next_chunk_id = 0
+# float16/int8 copy of the rows searched instead of index["embeddings"] when
+# RAG_PRECISION is reduced and FAISS is not installed
+_quantized = None
+# Rows the FAISS index's quantizer was fitted on; an int8 index is rebuilt as the corpus outgrows them
+_faiss_fit_rows = 0
+# Deleted chunk IDs, hidden from search until compaction drops their rows
+tombstones = set()
+_dead_rows = np.empty(0, dtype=np.int64)  # row positions of tombstoned chunks
+_compaction_job_id = None
+_compact_lock = threading.Lock()
+_index_lock = threading.RLock()
+# Bumped when row positions change (compaction, reload); appends keep them
+_row_epoch = 0
+INITIAL_CAPACITY = 1024
+# On-disk store
+store = RagStore(INDEX_DIR)
+# Only one process appends to the store (see RagStore.acquire_writer); with
+# several uvicorn workers the others serve reads and refuse write endpoints
+_is_writer = True
+_store_version = None  # store.version() the in-memory index reflects
+_save_lock = threading.Lock()
+# Per-URL crawl state (validators, body hash, chunk hashes) for incremental re-crawls
+sources = {}
+# Content hash -> live chunk IDs with that text, so identical text is never embedded twice
+_chunk_hashes = None
+_chunk_hashes_build_lock = threading.Lock()
+# category/url -> chunk IDs, for filtered retrieval; built on the first filtered search
+_attr_index = None
+_attr_index_build_lock = threading.Lock()
+# BM25 over chunk text; built by a background job, vector-only retrieval until then
+_bm25 = None
+_bm25_job_id = None
+query_cache = EmbeddingCache(EMBED_CACHE_SIZE)
+# Background ingestion (scrape + embed + index commit), polled via /jobs/{id}.
+# Job records are shared through rag_index/jobs/, so any worker answers the
+# poll, and read-only workers forward write requests there for the writer.
+jobs = JobQueue(INGEST_JOB_WORKERS, path=os.path.join(INDEX_DIR, "jobs"))
+# Per-thread score buffers for the NumPy fallback search
+_scratch = threading.local()
 
 # Trusted Default Sites
 TRUSTED_SITES = [
@@ -85,10 +198,18 @@ TRUSTED_SITES = [
 
 
 # 2. Data Models
+class RetrievalFilter(BaseModel):
+    categories: List[str] | None = None  # only chunks in any of these
+    exclude_categories: List[str] | None = None
+    urls: List[str] | None = None
+    exclude_urls: List[str] | None = None
+    ingested_after: datetime | None = None
+
 class ChatRequest(BaseModel):
     message: str
     conversation_id: str | None = None
     user_id: str | None = None
+    filters: RetrievalFilter | None = None
 
 class IngestRequest(BaseModel):
     url: str
@@ -96,91 +217,366 @@ class IngestRequest(BaseModel):
 class BuildIndexRequest(BaseModel):
     persist: bool = True
 
-# 3. RAG Helper Functions
-
+class RetrieveBatchRequest(BaseModel):
+    queries: List[str]
+    top_k: int = TOP_K
+    filters: RetrievalFilter | None = None
 
+class DeleteRequest(BaseModel):
+    url: str | None = None
+    category: str | None = None
 
+# 3. RAG Helper Functions
 
 
 
-def ingest_trusted_sites():
-    print("🔄 Ingesting trusted medical websites...")
-    success_count = 0
-    
-    for site in TRUSTED_SITES:
-        url = site["url"]
-        category = site["category"]
-        try:
-            print(f"   Downloading {url}...")
-            title, text = scrape_url(url)
-            if not text:
-                print(f"   ⚠️ No text found for {url}")
-                continue
-
-            chunks = chunk_text(text)
-            embs = embed_texts(chunks)
-            
-            metas = [{
-                "source_title": title,
-                "url": url,
-                "text": chunk,
-                "category": category,
-                "ingested_at": time.time()
-            } for chunk in chunks]
-            
-            add_to_index(embs, metas)
-            success_count += 1
-            print(f"   ✅ Ingested {len(chunks)} chunks from {title}")
-            
-        except Exception as e:
-            print(f"   ❌ Failed {url}: {e}")
-
-    if success_count > 0:
-        save_index()
-        print("💾 Index saved to disk.")
 
 
 
+def ingest_sites(sites: List[dict], job: dict = None) -> Tuple[int, dict, List[str]]:
+    """Crawls sites incrementally and commits new chunks.
 
+    Returns (new chunk count, per-URL crawl records, URLs whose content changed).
+    """
+    def progress(done, total):
+        if job is not None:
+            jobs.update(job, progress={"done": done, "total": total})
 
-
-def scrape_url(url: str) -> Tuple[str, str]:
-    """Scrapes text content from a URL."""
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        resp = requests.get(url, timeout=10, headers=headers)
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "html.parser")
-        
-        # Cleanup
-        for tag in soup(["script", "style", "nav", "footer"]):
-            tag.decompose()
-            
-        title = soup.title.string.strip() if soup.title else url
-        # Try to find main content, fallback to body
-        content_div = soup.find("main") or soup.find("div", {"id": "content"}) or soup.body
-        
-        paragraphs = [p.get_text(separator=" ", strip=True) for p in content_div.find_all("p")]
-        text = "\n\n".join([p for p in paragraphs if len(p) > 50])
-        
-        return title, text
-    except Exception as e:
-        print(f"Scrape error for {url}: {e}")
-        return url, ""
-
-def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
-    """Splits text into overlapping chunks."""
-    text = text.strip()
-    if not text: return []
-    chunks = []
-    i = 0
-    while i < len(text):
-        end = min(i + chunk_size, len(text))
-        chunk = text[i:end].strip()
-        if chunk:
-            chunks.append(chunk)
-        i += (chunk_size - overlap)
-    return chunks
+    embs, metas, updates = run_ingest_pipeline(sites, embed_batch, indexed_vector=indexed_vector,
+                                               page_hashes=page_chunk_hashes, sources=sources,
+                                               progress=progress)
+    if metas:
+        # One index commit for the whole crawl
+        add_to_index(embs, metas)
+        print("💾 Index saved to disk.")
+    changed = [url for url, rec in updates.items()
+               if rec.get("body_sha256") != sources.get(url, {}).get("body_sha256")]
+    # A changed page keeps only the chunks still on it. Pages indexed before
+    # crawl records existed have none, so they are pruned the same way.
+    removed = 0
+    for url in changed:
+        keep = set(updates[url]["chunk_hashes"])
+        removed += _delete_where(lambda m: _meta_hash(m) not in keep,
+                                 candidates=_allowed_chunk_ids(RetrievalFilter(urls=[url])))
+    if removed:
+        print(f"🗑️ Removed {removed} chunks that are no longer on their page.")
+    if updates:
+        with _save_lock:
+            sources.update(updates)
+            store.write_sources(sources)
+    return len(metas), updates, changed
+
+def ingest_trusted_sites(job: dict = None) -> str:
+    print("🔄 Ingesting trusted medical websites...")
+    n_chunks, _, changed = ingest_sites(TRUSTED_SITES, job)
+    return f"Ingested {n_chunks} new chunks from trusted sites ({len(changed)} pages changed)"
+
+def ingest_url_job(job: dict, url: str, category: str = "User Ingested") -> str:
+    """Scrapes, embeds and indexes one URL on the ingestion job pool."""
+    n_chunks, updates, changed = ingest_sites([{"url": url, "category": category}], job)
+    if url not in updates:
+        raise ValueError("Could not extract text from URL")
+    if changed:
+        return f"Ingested {n_chunks} new chunks from {url}"
+    if n_chunks:  # same page, but some of its chunks had been deleted
+        return f"{url} is unchanged since the last crawl; re-added {n_chunks} missing chunks"
+    return f"{url} is unchanged since the last crawl"
+
+def _scan_rows_off_lock(make, add, install):
+    """Feeds every row to add(built, ids, metas) outside the index lock, then the rows
+    appended meanwhile under it, and returns install(built) from under the lock.
+
+    Starts over with a fresh make() if the rows were compacted or reset during the scan.
+    """
+    while True:
+        with _index_lock:
+            metas, ids, epoch = index["metadatas"], index["ids"], _row_epoch
+            n = len(metas)
+        built = make()
+        if n:
+            add(built, ids[:n], (metas[i] for i in range(n)))
+        with _index_lock:
+            if _row_epoch != epoch:
+                continue
+            if len(index["metadatas"]) > n:
+                add(built, index["ids"][n:], index["metadatas"][n:])
+            return install(built)
+
+def known_chunk_hashes() -> dict:
+    """Content hash -> live chunk IDs, built on first use and kept current by add_to_index."""
+    if _chunk_hashes is not None:
+        return _chunk_hashes
+    with _chunk_hashes_build_lock:  # one scan at a time; ingests go on meanwhile
+        if _chunk_hashes is not None:
+            return _chunk_hashes
+        with _index_lock:
+            dead = set(tombstones)
+
+        def add(hashes, ids, metas):
+            for m, cid in zip(metas, ids):
+                if int(cid) not in dead:
+                    hashes[_meta_hash(m)].append(int(cid))
+
+        def install(hashes):
+            global _chunk_hashes
+            # Drop the chunks deleted during the scan
+            deleted = np.fromiter(tombstones - dead, dtype=np.int64)
+            for r in _rows_of(index["ids"], np.sort(deleted)) if len(deleted) else []:
+                h, cid = _meta_hash(index["metadatas"][r]), int(index["ids"][r])
+                if cid in hashes.get(h, []):
+                    hashes[h].remove(cid)
+                    if not hashes[h]:
+                        hashes.pop(h)
+            _chunk_hashes = hashes
+            return hashes
+
+        return _scan_rows_off_lock(lambda: defaultdict(list), add, install)
+
+def indexed_vector(content_hash: str) -> Optional[np.ndarray]:
+    """The stored embedding of a live chunk with this content hash, or None."""
+    hashes = known_chunk_hashes()
+    with _index_lock:
+        cids = hashes.get(content_hash)
+        if not cids:
+            return None
+        rows = _rows_of(index["ids"], np.array(cids[:1], dtype=np.int64))
+        return np.array(index["embeddings"][rows[0]]) if len(rows) else None
+
+def page_chunk_hashes(url: str) -> set:
+    """Content hashes of the live chunks indexed under url."""
+    allowed = _allowed_chunk_ids(RetrievalFilter(urls=[url]))
+    with _index_lock:
+        rows = _rows_of(index["ids"], allowed) if index["ids"] is not None else []
+        return {_meta_hash(index["metadatas"][r]) for r in rows}
+
+def attribute_index() -> AttributeIndex:
+    """The category/url inverted index, built on first use and kept current by add_to_index."""
+    if _attr_index is not None:
+        return _attr_index
+    with _attr_index_build_lock:  # one scan at a time; unfiltered searches go on meanwhile
+        if _attr_index is not None:
+            return _attr_index
+
+        def install(attrs):
+            global _attr_index
+            _attr_index = attrs
+            return attrs
+
+        return _scan_rows_off_lock(AttributeIndex, lambda attrs, ids, metas: attrs.add(ids, metas), install)
+
+def lexical_index() -> Optional[BM25Index]:
+    """The BM25 index, or None (scheduling a build) if it is not ready yet."""
+    if _bm25 is None:
+        _schedule_lexical_build()
+    return _bm25
+
+def _schedule_lexical_build():
+    global _bm25_job_id
+    with _index_lock:
+        running = jobs.get(_bm25_job_id) if _bm25_job_id else None
+        if running and running["status"] in ("queued", "running"):
+            return
+        _bm25_job_id = jobs.submit("lexical_index", build_lexical_index)["id"]
+
+def build_lexical_index(job: dict = None) -> str:
+    """Builds the BM25 index off the request path, then installs it under the index lock."""
+    def install(bm25):
+        global _bm25
+        _bm25 = bm25
+        return f"Built BM25 index over {len(bm25)} chunks"
+
+    return _scan_rows_off_lock(BM25Index, lambda bm25, ids, metas: bm25.add(ids, (m["text"] for m in metas)), install)
+
+def _allowed_chunk_ids(filters: Optional[RetrievalFilter]) -> Optional[np.ndarray]:
+    """Sorted live chunk IDs passing the filter, or None when nothing is filtered."""
+    if filters is None:
+        return None
+    allowed = attribute_index().select(
+        categories=filters.categories,
+        exclude_categories=filters.exclude_categories,
+        urls=filters.urls,
+        exclude_urls=filters.exclude_urls,
+        ingested_after=filters.ingested_after.timestamp() if filters.ingested_after else None,
+    )
+    if allowed is None:
+        return None
+    with _index_lock:
+        dead = np.fromiter(tombstones, dtype=np.int64, count=len(tombstones))
+    return np.setdiff1d(allowed, dead, assume_unique=True) if len(dead) else allowed
+
+def _rows_of(ids: np.ndarray, chunk_ids: np.ndarray) -> np.ndarray:
+    """Row positions of the chunk IDs present in the ascending ids column."""
+    pos = np.searchsorted(ids, chunk_ids)
+    found = pos < len(ids)
+    pos, chunk_ids = pos[found], chunk_ids[found]
+    return pos[np.asarray(ids[pos]) == chunk_ids]
+
+def _meta_hash(meta: dict) -> str:
+    # Chunks indexed before hashing was added are hashed from their text
+    return meta.get("content_hash") or chunk_hash(meta["text"])
+
+def _delete_where(match, candidates: np.ndarray = None) -> int:
+    """Tombstones every live chunk whose metadata satisfies match(); returns how many.
+
+    candidates (sorted chunk IDs, e.g. from the attribute index) limits the
+    scan to those chunks instead of decoding every record.
+    """
+    with _index_lock:
+        n = len(index["metadatas"])
+        metas, ids = index["metadatas"], index["ids"]
+    if n == 0 or (candidates is not None and len(candidates) == 0):
+        return 0
+    rows = _rows_of(ids[:n], candidates) if candidates is not None else range(n)
+    # Scan a snapshot outside the lock; chunk IDs stay valid across a compaction
+    doomed, hashes = [], []
+    for i in rows:
+        cid = int(ids[i])
+        if cid in tombstones:
+            continue
+        meta = metas[i]
+        if match(meta):
+            doomed.append(cid)
+            hashes.append(_meta_hash(meta))
+    if not doomed:
+        return 0
+    with _index_lock:
+        tombstones.update(doomed)
+        _refresh_dead_rows()
+        if _chunk_hashes is not None:
+            for cid, h in zip(doomed, hashes):
+                cids = _chunk_hashes.get(h, [])
+                if cid in cids:
+                    cids.remove(cid)
+                if not cids:
+                    _chunk_hashes.pop(h, None)
+    with _save_lock:
+        store.write_tombstones(np.fromiter(tombstones, dtype=np.int64, count=len(tombstones)))
+    _maybe_schedule_compaction()
+    return len(doomed)
+
+def delete_chunks(url: str = None, category: str = None) -> int:
+    """Deletes the chunks of a source URL and/or category; they vanish from search at once."""
+    candidates = _allowed_chunk_ids(RetrievalFilter(urls=[url] if url is not None else None,
+                                                    categories=[category] if category is not None else None))
+    deleted = _delete_where(lambda m: (url is None or m.get("url") == url)
+                            and (category is None or m.get("category") == category), candidates)
+    if url is not None and url in sources:
+        # Forget the crawl state so a later ingest fetches the page in full
+        with _save_lock:
+            sources.pop(url, None)
+            store.write_sources(sources)
+    return deleted
+
+def _refresh_dead_rows():
+    """Recomputes the row positions of tombstoned chunks (call under _index_lock)."""
+    global _dead_rows
+    ids = index["ids"]
+    if not tombstones or ids is None or len(ids) == 0:
+        _dead_rows = np.empty(0, dtype=np.int64)
+        return
+    dead = np.fromiter(tombstones, dtype=np.int64, count=len(tombstones))
+    _dead_rows = np.sort(_rows_of(ids, dead))
+
+def _maybe_schedule_compaction():
+    """Queues a compaction job once tombstones exceed COMPACT_TOMBSTONE_RATIO of the rows."""
+    global _compaction_job_id
+    n = len(index["metadatas"])
+    if not n or len(tombstones) < COMPACT_TOMBSTONE_RATIO * n:
+        return
+    running = jobs.get(_compaction_job_id) if _compaction_job_id else None
+    if running and running["status"] in ("queued", "running"):
+        return
+    _compaction_job_id = jobs.submit("compact", compact_index)["id"]
+    print(f"🧹 {len(tombstones)} of {n} chunks deleted, compaction queued as job {_compaction_job_id}.")
+
+def compact_index(job: dict = None) -> str:
+    """Rewrites the store and FAISS index without tombstoned rows.
+
+    The live rows are copied and indexed outside _save_lock, so ingests and
+    deletions go on meanwhile and searches keep running on the old rows.
+    Rows committed during the rebuild are carried over when the new
+    generation is committed and swapped in, under both locks, at the end.
+    """
+    global faiss_index, _faiss_fit_rows, _quantized, _attr_index, _bm25, _row_epoch
+    with _compact_lock:  # one compaction at a time
+        with _index_lock:
+            n = len(index["metadatas"])
+            embs, metas, ids, epoch = index["embeddings"], index["metadatas"], index["ids"], _row_epoch
+            dead = np.fromiter(tombstones, dtype=np.int64, count=len(tombstones))
+        if n == 0 or len(dead) == 0:
+            return "Nothing to compact"
+        live = np.flatnonzero(~np.isin(ids[:n], dead))
+        live_embs = np.ascontiguousarray(embs[live])
+        live_ids = np.ascontiguousarray(ids[live], dtype=np.int64)
+        live_metas = [metas[int(i)] for i in live]
+        new_faiss = None
+        if _HAS_FAISS and len(live):
+            new_faiss = build_index(live_embs, choose_index_kind(len(live), INDEX_KIND), ids=live_ids,
+                                    precision=EMBED_PRECISION)
+            set_search_params(new_faiss, nprobe=NPROBE, ef_search=EF_SEARCH)
+        new_quantized = _build_quantized(live_embs)
+        new_attrs = None
+        if _attr_index is not None:  # rebuilt here rather than on the next filtered search
+            new_attrs = AttributeIndex()
+            new_attrs.add(live_ids, live_metas)
+        generation = store.write_generation(live_embs, live_metas, live_ids)
+
+        with _save_lock:  # no appends while the new generation is committed
+            with _index_lock:
+                if _row_epoch != epoch:
+                    return "The index was reloaded during compaction; nothing compacted"
+                cur_embs, cur_metas, cur_ids = index["embeddings"], index["metadatas"], index["ids"]
+            # Rows committed during the rebuild (a row deleted meanwhile stays tombstoned)
+            extra = len(cur_metas) - n
+            extra_embs = np.ascontiguousarray(cur_embs[n:], dtype=np.float32) if extra else None
+            extra_metas = cur_metas[n:] if extra else None
+            extra_ids = np.ascontiguousarray(cur_ids[n:], dtype=np.int64) if extra else None
+            if extra:
+                if new_faiss is not None:
+                    new_faiss.add_with_ids(extra_embs, extra_ids)
+                elif _HAS_FAISS:
+                    new_faiss = build_index(extra_embs, choose_index_kind(extra, INDEX_KIND), ids=extra_ids,
+                                            precision=EMBED_PRECISION)
+                    set_search_params(new_faiss, nprobe=NPROBE, ef_search=EF_SEARCH)
+                if new_quantized is not None:
+                    new_quantized.append(extra_embs)
+                elif not len(live):
+                    new_quantized = _build_quantized(extra_embs)
+                if new_attrs is not None:
+                    new_attrs.add(extra_ids, extra_metas)
+            store.commit_generation(generation, extra_embs, extra_metas, extra_ids, dropped_ids=dead)
+            new_embs, new_metas = store.open()
+
+            with _index_lock:
+                index.update({"embeddings": new_embs, "metadatas": new_metas, "ids": store.read_ids()})
+                _row_epoch += 1
+                faiss_index = new_faiss
+                _faiss_fit_rows = len(live) if len(live) else extra
+                _quantized = new_quantized
+                _attr_index = new_attrs
+                _bm25 = None
+                tombstones.difference_update(dead.tolist())
+                _refresh_dead_rows()
+    save_faiss_index()
+    if HYBRID_SEARCH:
+        _schedule_lexical_build()
+    msg = f"Compacted index: dropped {n - len(live)} deleted chunks, {len(index['metadatas'])} remain"
+    print(f"🧹 {msg}")
+    return msg
+
+def embed_batch(texts: List[str]) -> np.ndarray:
+    """Embeds one batch, retrying with exponential backoff; raises if every attempt fails."""
+    delay = 1.0
+    for attempt in range(1, EMBED_MAX_ATTEMPTS + 1):
+        try:
+            res = client.embeddings.create(model=EMBED_MODEL, input=texts)
+            return np.array([r.embedding for r in res.data], dtype=np.float32)
+        except Exception as e:
+            if attempt == EMBED_MAX_ATTEMPTS:
+                raise
+            print(f"Embedding error (attempt {attempt}/{EMBED_MAX_ATTEMPTS}): {e}; retrying in {delay:.0f}s")
+            time.sleep(delay * random.uniform(1.0, 1.5))
+            delay *= 2
 
 def embed_texts(texts: List[str]) -> np.ndarray:
     """Generates embeddings using OpenAI."""
@@ -190,118 +586,462 @@ def embed_texts(texts: List[str]) -> np.ndarray:
     for i in range(0, len(texts), 32):
         batch = texts[i:i + 32]
         try:
-            res = client.embeddings.create(model=EMBED_MODEL, input=batch)
-            embeddings.extend([r.embedding for r in res.data])
+            embeddings.extend(embed_batch(batch))
         except Exception as e:
             print(f"Embedding error: {e}")
     return np.array(embeddings, dtype=np.float32)
 
-def save_index():
-    """Saves the RAG index to disk."""
-    with open(INDEX_PKL, "wb") as f:
-        pickle.dump({
-            "index": index,
-            "has_faiss": _HAS_FAISS,
-            # We don't serialize FAISS object directly here to keep it simple, 
-            # we rely on rebuilding faiss from numpy on load or using numpy fallback
-        }, f)
+def embed_query(query: str) -> np.ndarray:
+    """Embeds a single search query, served from the LRU cache when possible."""
+    vec = query_cache.get(EMBED_MODEL, query)
+    if vec is None:
+        vec = embed_texts([query])[0]
+        query_cache.put(EMBED_MODEL, query, vec)
+    return vec
+
+def embed_queries(queries: List[str]) -> np.ndarray:
+    """Embeds many queries: cached ones are reused, the rest go out in full batches."""
+    vecs = [query_cache.get(EMBED_MODEL, q) for q in queries]
+    pending = {}  # normalized query -> positions still missing a vector
+    for i, vec in enumerate(vecs):
+        if vec is None:
+            pending.setdefault(normalize_query(queries[i]), []).append(i)
+    texts = [queries[positions[0]] for positions in pending.values()]
+    for start in range(0, len(texts), QUERY_EMBED_BATCH):
+        batch = texts[start:start + QUERY_EMBED_BATCH]
+        for text, vec in zip(batch, embed_batch(batch)):
+            query_cache.put(EMBED_MODEL, text, vec)
+            for i in pending[normalize_query(text)]:
+                vecs[i] = vec
+    return np.vstack(vecs)
+
+async def aembed_query(query: str) -> np.ndarray:
+    """embed_query() over the async OpenAI client."""
+    vec = query_cache.get(EMBED_MODEL, query)
+    if vec is None:
+        res = await async_client.embeddings.create(model=EMBED_MODEL, input=[query])
+        vec = np.array(res.data[0].embedding, dtype=np.float32)
+        query_cache.put(EMBED_MODEL, query, vec)
+    return vec
+
+def save_faiss_index():
+    """Writes the FAISS index next to the corpus if the saved copy is out of date."""
+    if not _HAS_FAISS:
+        return
+    # A published faiss_index is never changed (appends and rebuilds swap in a new
+    # one under _save_lock), so it is written without blocking searches
+    with _save_lock:
+        if store.faiss_is_current():
+            return
+        with _index_lock:
+            idx, n, trained_rows = faiss_index, len(index["metadatas"]), _faiss_fit_rows
+        if idx is not None and idx.ntotal == n:
+            store.write_faiss(idx, trained_rows=trained_rows)
 
 def load_index():
-    """Loads the RAG index from disk."""
-    global index, faiss_index
-    if not os.path.exists(INDEX_PKL):
-        return False
+    """Maps the on-disk RAG index, converting a legacy rag_index.pkl once if present."""
+    global faiss_index, _faiss_fit_rows, _quantized, _next_chunk_id, _store_version
     try:
-        with open(INDEX_PKL, "rb") as f:
-            data = pickle.load(f)
-        index.update(data.get("index", {}))
-        # Rebuild FAISS if available
-        if _HAS_FAISS and index["embeddings"] is not None:
-            build_faiss_from_numpy(index["embeddings"])
-        return True
+        sources.update(store.read_sources())
+        if not store.exists() and os.path.exists(INDEX_PKL):
+            print(f"🔄 Converting {INDEX_PKL} to {INDEX_DIR}/ ...")
+            convert_pickle(INDEX_PKL, INDEX_DIR)
+        if not store.exists():
+            return False
+        version = store.version()  # taken first: a commit during the load is picked up by the next refresh
+        embs, metas = store.open()
+        with _index_lock:
+            reset_index()
+            index["embeddings"] = embs
+            index["metadatas"] = metas
+            index["ids"] = store.read_ids()
+            index["dim"] = embs.shape[1] if embs is not None else None
+            _next_chunk_id = store.read_manifest().get("next_id", len(metas))
+            tombstones.update(store.read_tombstones().tolist())
+            _refresh_dead_rows()
+            _quantized = _build_quantized(embs)
+            if embs is not None and _HAS_FAISS:
+                # Clonable in every worker: _map_committed_rows adds new rows to a copy of it
+                faiss_index = store.read_faiss(use_mmap=FAISS_MMAP, writable=True)
+                _faiss_fit_rows = store.faiss_trained_rows()
+                if faiss_index is not None and not _faiss_matches_config(faiss_index, len(embs)):
+                    faiss_index = None  # saved before chunk IDs, corpus outgrew the tier or its int8 ranges, or the config changed
+                set_search_params(faiss_index, nprobe=NPROBE, ef_search=EF_SEARCH)
+                if faiss_index is None:
+                    print("🔄 Saved FAISS index missing or stale, rebuilding...")
+                    build_faiss_from_numpy(embs, index["ids"])
+                    if _is_writer:
+                        store.write_faiss(faiss_index, trained_rows=_faiss_fit_rows)
+            _store_version = version
+        return len(metas) > 0
     except Exception as e:
         print(f"Error loading index: {e}")
         return False
 
-def build_faiss_from_numpy(embs: np.ndarray):
-    global faiss_index
+def refresh_from_store() -> bool:
+    """Picks up the rows, deletions and compactions another process committed; returns whether anything changed.
+
+    Appended rows are indexed incrementally; a compaction moves every row,
+    so the index is loaded again.
+    """
+    global _store_version
+    version = store.version()
+    if version is None or version == _store_version:
+        return False
+    if _store_version is None or version[0] != _store_version[0]:
+        sources.clear()
+        return load_index() or True
+    with _save_lock:
+        _map_committed_rows()
+    with _index_lock:
+        tombstones.clear()
+        tombstones.update(store.read_tombstones().tolist())
+        _refresh_dead_rows()
+        _store_version = version
+    with _save_lock:
+        sources.clear()
+        sources.update(store.read_sources())
+    return True
+
+def _follow_store():
+    """Read-only workers: re-maps the store every STORE_REFRESH_SECONDS while the writer changes it."""
+    while True:
+        time.sleep(STORE_REFRESH_SECONDS)
+        try:
+            if refresh_from_store():
+                print(f"🔄 Picked up the writer's changes: {len(index['metadatas'])} chunks.")
+        except Exception as e:
+            print(f"Could not refresh the index from {INDEX_DIR}: {e}")
+
+def reset_index():
+    """Drops all in-memory vectors, metadata and the FAISS index."""
+    global faiss_index, _quantized, _chunk_hashes, _next_chunk_id, _attr_index, _bm25, _row_epoch
+    with _index_lock:
+        _row_epoch += 1
+        index.update({"embeddings": None, "metadatas": MetadataReader(), "ids": None, "dim": None})
+        faiss_index = None
+        _quantized = None
+        _chunk_hashes = None
+        _attr_index = None
+        _bm25 = None
+        _next_chunk_id = 0
+        tombstones.clear()
+        _refresh_dead_rows()
+
+def build_faiss_from_numpy(embs: np.ndarray, ids: np.ndarray):
+    """Rebuilds the FAISS index from scratch over already-normalized rows and their chunk IDs."""
+    global faiss_index, _faiss_fit_rows
     if _HAS_FAISS and len(embs) > 0:
-        d = embs.shape[1]
-        idx = faiss.IndexFlatIP(d)
-        faiss.normalize_L2(embs)
-        idx.add(embs)
+        kind = choose_index_kind(len(embs), INDEX_KIND)
+        idx = build_index(embs, kind, ids=ids, precision=EMBED_PRECISION)
+        set_search_params(idx, nprobe=NPROBE, ef_search=EF_SEARCH)
         faiss_index = idx
-
-def add_to_index(new_embeddings: np.ndarray, new_metadatas: List[dict]):
-    global index
+        _faiss_fit_rows = len(embs)
+
+def _faiss_matches_config(idx, n_rows: int) -> bool:
+    """Whether a loaded FAISS index has chunk IDs, the tier and precision the config asks for, and current int8 ranges."""
+    kind = choose_index_kind(n_rows, INDEX_KIND)
+    precision = "float32" if kind == "ivfpq" else EMBED_PRECISION  # PQ codes are not scalar-quantized
+    return (isinstance(faiss.downcast_index(idx), faiss.IndexIDMap)
+            and index_kind_of(idx) == kind and index_precision_of(idx) == precision
+            and not int8_refit_due(precision, _faiss_fit_rows, n_rows))
+
+def _build_quantized(embs: np.ndarray):
+    """QuantizedRows over embs for the NumPy path, or None if FAISS is used or RAG_PRECISION is float32."""
+    if _HAS_FAISS or EMBED_PRECISION == "float32" or embs is None:
+        return None
+    return QuantizedRows.from_rows(embs, EMBED_PRECISION)
+
+def normalize_rows(vecs: np.ndarray) -> np.ndarray:
+    """L2-normalizes a float32 matrix in place and returns it."""
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    vecs /= (norms + 1e-12)
+    return vecs
+
+def _score_buffer(n: int) -> np.ndarray:
+    """Returns a reusable float32 buffer of length n for the calling thread."""
+    buf = getattr(_scratch, "scores", None)
+    if buf is None or len(buf) < n:
+        buf = np.empty(max(n, INITIAL_CAPACITY), dtype=np.float32)
+        _scratch.scores = buf
+    return buf[:n]
+
+def add_to_index(new_embeddings: np.ndarray, new_metadatas: List[dict], ids: np.ndarray = None):
+    """Commits vectors to the on-disk store, then indexes them; only the new rows are normalized.
+
+    New chunks get the next free chunk IDs unless ids are given. Searches
+    keep using the previous mapping until the new rows are indexed.
+    """
     if len(new_embeddings) == 0: return
-
-    if index["embeddings"] is None:
-        index["embeddings"] = new_embeddings
-    else:
-        index["embeddings"] = np.vstack([index["embeddings"], new_embeddings])
-    
-    index["metadatas"].extend(new_metadatas)
-    index["dim"] = index["embeddings"].shape[1]
-    
+    rows = normalize_rows(np.array(new_embeddings, dtype=np.float32))
+    k, d = rows.shape
+    if k != len(new_metadatas):
+        raise ValueError(f"{k} embeddings but {len(new_metadatas)} metadata records")
+
+    with _save_lock:  # one append at a time, and none while compaction rewrites the store
+        with _index_lock:
+            if index["dim"] is not None and d != index["dim"]:
+                raise ValueError(f"Embedding dim {d} does not match index dim {index['dim']}")
+            row_ids = np.arange(_next_chunk_id, _next_chunk_id + k) if ids is None else ids
+        store.append(rows, new_metadatas, row_ids)
+        _map_committed_rows()
+
+def _map_committed_rows():
+    """Indexes the store's rows past the mapped ones and maps the grown files (call under _save_lock).
+
+    The FAISS index is never changed once searches can see it: new rows go
+    into a copy (or a rebuild) outside _index_lock, which is swapped in with
+    the grown files. If indexing raises, the previous mapping stays in place
+    and the next call picks the rows up again.
+    """
+    global faiss_index, _faiss_fit_rows, _quantized, _next_chunk_id
+    with _index_lock:
+        n, idx, fit_rows, quantized, epoch = (len(index["metadatas"]), faiss_index, _faiss_fit_rows,
+                                              _quantized, _row_epoch)
+    embs, metas = store.open()
+    if embs is None or len(metas) <= n:
+        return
+    ids = store.read_ids()
+    rows, row_ids = np.ascontiguousarray(embs[n:]), np.ascontiguousarray(ids[n:], dtype=np.int64)
+
+    # int8 ranges fitted on far fewer rows are refitted over all of them
     if _HAS_FAISS:
-        build_faiss_from_numpy(index["embeddings"])
-
-def retrieve(query: str, top_k: int = TOP_K) -> List[dict]:
-    """Finds relevant chunks for the user query."""
+        if idx is None or int8_refit_due(index_precision_of(idx), fit_rows, len(embs)):
+            idx = build_index(embs, choose_index_kind(len(embs), INDEX_KIND), ids=ids, precision=EMBED_PRECISION)
+            fit_rows = len(embs)
+        else:
+            idx = faiss.clone_index(idx)
+            idx.add_with_ids(rows, row_ids)
+        set_search_params(idx, nprobe=NPROBE, ef_search=EF_SEARCH)
+    elif quantized is not None and not int8_refit_due(quantized.precision, quantized.fitted_rows, len(embs)):
+        quantized.append(rows)  # searches only read the first len(metadatas) codes
+    else:
+        quantized = _build_quantized(embs)
+
+    new_metadatas = metas[n:]
+    with _index_lock:
+        if _row_epoch != epoch:
+            return  # reloaded meanwhile; the reload mapped these rows
+        faiss_index, _faiss_fit_rows, _quantized = idx, fit_rows, quantized
+        index.update({"embeddings": embs, "metadatas": metas, "ids": ids, "dim": embs.shape[1]})
+        _next_chunk_id = max(_next_chunk_id, int(row_ids[-1]) + 1)
+        if _chunk_hashes is not None:
+            for m, cid in zip(new_metadatas, row_ids):
+                _chunk_hashes[_meta_hash(m)].append(int(cid))
+        if _attr_index is not None:
+            _attr_index.add(row_ids, new_metadatas)
+        if _bm25 is not None:
+            _bm25.add(row_ids, (m["text"] for m in new_metadatas))
+
+def retrieve(query: str, top_k: int = TOP_K, filters: RetrievalFilter = None,
+             lexical_query: str = None) -> List[dict]:
+    """Finds relevant chunks for the user query, optionally restricted by filters.
+
+    lexical_query is the text BM25 matches (default: query), so terms added
+    to steer the embedding do not drive keyword hits.
+    """
     if index["embeddings"] is None or len(index["metadatas"]) == 0:
         return []
 
     # Create embedding for query
     try:
-        q_emb = embed_texts([query])[0]
+        q_emb = embed_query(query)
     except Exception:
         return []
+    return hybrid_search([lexical_query or query], q_emb.reshape(1, -1), top_k, filters)[0]
 
-    # Search logic
-    if _HAS_FAISS and faiss_index is not None:
-        q = q_emb.reshape(1, -1).astype(np.float32)
-        faiss.normalize_L2(q)
-        distances, idxs = faiss_index.search(q, top_k)
-        res = []
-        for i, idx in enumerate(idxs[0]):
-            if idx < 0 or idx >= len(index["metadatas"]): continue
-            meta = index["metadatas"][idx].copy()
-            meta["score"] = float(distances[0][i])
-            if meta["score"] >= SIMILARITY_THRESHOLD:
-                res.append(meta)
-        return res
-    else:
-        # Numpy Fallback (Cosine Similarity)
-        embs = index["embeddings"]
-        # Normalize
-        norm_embs = embs / (np.linalg.norm(embs, axis=1, keepdims=True) + 1e-12)
-        norm_q = q_emb / (np.linalg.norm(q_emb) + 1e-12)
-        scores = np.dot(norm_embs, norm_q)
-        
-        top_indices = np.argsort(scores)[::-1][:top_k]
-        res = []
-        for idx in top_indices:
-            score = float(scores[idx])
-            if score >= SIMILARITY_THRESHOLD:
-                meta = index["metadatas"][idx].copy()
+async def aretrieve(query: str, top_k: int = TOP_K, filters: RetrievalFilter = None,
+                    lexical_query: str = None) -> List[dict]:
+    """Async retrieve(): awaits the query embedding, then searches in a worker thread."""
+    if index["embeddings"] is None or len(index["metadatas"]) == 0:
+        return []
+    try:
+        q_emb = await aembed_query(query)
+    except Exception:
+        return []
+    results = await asyncio.to_thread(hybrid_search, [lexical_query or query], q_emb.reshape(1, -1), top_k, filters)
+    return results[0]
+
+def retrieve_many(queries: List[str], top_k: int = TOP_K, filters: RetrievalFilter = None) -> List[List[dict]]:
+    """retrieve() for many queries: batched embedding calls, then batched searches.
+
+    Unlike retrieve(), an embedding failure raises instead of returning no hits.
+    """
+    if not queries:
+        return []
+    if index["embeddings"] is None or len(index["metadatas"]) == 0:
+        return [[] for _ in queries]
+    return hybrid_search(queries, embed_queries(queries), top_k, filters)
+
+def hybrid_search(queries: List[str], q_embs: np.ndarray, top_k: int = TOP_K,
+                  filters: RetrievalFilter = None) -> List[List[dict]]:
+    """Vector search fused with BM25 over chunk text by reciprocal-rank fusion.
+
+    queries are the texts BM25 matches. Falls back to vector search alone
+    with RAG_HYBRID=0 or while the BM25 index is being built. Every hit is
+    above SIMILARITY_THRESHOLD and carries "score" (cosine), "bm25" and "rrf".
+    """
+    bm25 = lexical_index() if HYBRID_SEARCH else None
+    if bm25 is None:
+        return search_many(q_embs, top_k, filters)
+    if index["embeddings"] is None or len(index["metadatas"]) == 0:
+        return [[] for _ in queries]
+    allowed = _allowed_chunk_ids(filters)
+    if allowed is not None and len(allowed) == 0:
+        return [[] for _ in queries]
+    n_cand = max(top_k, FUSION_CANDIDATES)
+    vector_hits = _vector_search(q_embs, n_cand, allowed)
+    with _index_lock:
+        embs, metas, ids = index["embeddings"], index["metadatas"], index["ids"]
+        dead = np.fromiter(tombstones, dtype=np.int64, count=len(tombstones))
+
+    results = []
+    for query, q_emb, v_hits in zip(queries, q_embs, vector_hits):
+        lexical_hits = bm25.search(query, n_cand, allowed=allowed, exclude=dead)
+        rrf, bm25_scores = {}, {}
+        for rank, hit in enumerate(v_hits):
+            rrf[hit["chunk_id"]] = 1.0 / (RRF_K + rank + 1)
+        for rank, (cid, score) in enumerate(lexical_hits):
+            rrf[cid] = rrf.get(cid, 0.0) + 1.0 / (RRF_K + rank + 1)
+            bm25_scores[cid] = score
+        by_id = {hit["chunk_id"]: hit for hit in v_hits}
+        q = q_emb / (np.linalg.norm(q_emb) + 1e-12)
+        fused = []
+        for cid in sorted(rrf, key=rrf.get, reverse=True):
+            if len(fused) == top_k:
+                break
+            meta = by_id.get(cid)
+            if meta is None:
+                # Lexical-only hit: score it against the query vector too, and hold it to the same floor
+                row = int(np.searchsorted(ids, cid))
+                if row >= len(metas) or ids[row] != cid: continue
+                score = float(np.dot(embs[row], q))
+                if score < SIMILARITY_THRESHOLD: continue
+                meta = metas[row]
                 meta["score"] = score
-                res.append(meta)
-        return res
+                meta["chunk_id"] = cid
+            meta["bm25"] = bm25_scores.get(cid, 0.0)
+            meta["rrf"] = rrf[cid]
+            fused.append(meta)
+        results.append(fused)
+    return results
+
+def search_index(q_emb: np.ndarray, top_k: int = TOP_K, filters: RetrievalFilter = None) -> List[dict]:
+    """Returns the chunks closest to an embedded query, above SIMILARITY_THRESHOLD."""
+    return search_many(np.asarray(q_emb).reshape(1, -1), top_k, filters)[0]
+
+def search_many(q_embs: np.ndarray, top_k: int = TOP_K, filters: RetrievalFilter = None) -> List[List[dict]]:
+    """search_index() for a matrix of query embeddings, one FAISS search or GEMM per block.
+
+    Filters restrict the candidates inside the search: an IDSelector for
+    FAISS, or scoring only the allowed rows when few chunks match.
+    """
+    if index["embeddings"] is None or len(index["metadatas"]) == 0:
+        return [[] for _ in range(len(q_embs))]
+    allowed = _allowed_chunk_ids(filters)
+    if allowed is not None and len(allowed) == 0:
+        return [[] for _ in range(len(q_embs))]
+    return _vector_search(q_embs, top_k, allowed)
+
+def _vector_search(q_embs: np.ndarray, top_k: int, allowed: np.ndarray = None) -> List[List[dict]]:
+    use_faiss = (_HAS_FAISS and faiss_index is not None
+                 and (allowed is None or len(allowed) > FILTER_EXACT_MAX))
+    # Blocks bound the score matrix of the NumPy path and the result matrices of FAISS
+    block = QUERY_BLOCK if use_faiss else max(1, min(QUERY_BLOCK, SCORE_BLOCK_FLOATS // len(index["metadatas"])))
+    results = []
+    for start in range(0, len(q_embs), block):
+        # Copy: cached vectors are read-only
+        q = normalize_rows(np.array(q_embs[start:start + block], dtype=np.float32))
+        results.extend(_faiss_search(q, top_k, allowed) if use_faiss else _numpy_search(q, top_k, allowed))
+    return results
+
+def _scored_metas(scored_rows, metas, ids) -> List[dict]:
+    """Metadata records with "score" and "chunk_id" for (score, row) pairs above SIMILARITY_THRESHOLD."""
+    res = []
+    for score, row in scored_rows:
+        if score >= SIMILARITY_THRESHOLD:
+            meta = metas[row]  # decoded afresh on every read, so it is safe to annotate
+            meta["score"] = score
+            meta["chunk_id"] = int(ids[row])
+            res.append(meta)
+    return res
+
+def _live_hits(distances: np.ndarray, chunk_ids: np.ndarray, ids: np.ndarray, dead_rows: np.ndarray,
+               want: int) -> List[List[tuple]]:
+    """Up to want (score, row) pairs per query for the FAISS hits that are mapped, live rows of ids."""
+    rows = np.searchsorted(ids, chunk_ids)
+    found = (chunk_ids >= 0) & (rows < len(ids))
+    found[found] = ids[rows[found]] == chunk_ids[found]
+    found &= ~np.isin(rows, dead_rows)
+    return [[(float(dist), int(row)) for dist, row in zip(d_row[ok], r_row[ok])][:want]
+            for d_row, r_row, ok in zip(distances, rows, found)]
+
+def _faiss_search(q: np.ndarray, top_k: int, allowed: np.ndarray = None) -> List[List[dict]]:
+    # Snapshot: an appended or rebuilt index is swapped in whole, so this one is searched without the lock
+    with _index_lock:
+        idx, embs, metas, ids = faiss_index, index["embeddings"], index["metadatas"], index["ids"]
+        dead_rows, id_bound = _dead_rows, _next_chunk_id
+    ids = ids[:len(metas)]
+    # Quantized vectors: fetch extra candidates and re-score them against the float32 rows
+    rerank = RERANK_FACTOR > 0 and index_precision_of(idx) != "float32"
+    want = top_k * RERANK_FACTOR if rerank else top_k
+    if allowed is not None:
+        # Only allowed (and therefore live) chunks are scored; bitmap backs sel during the search
+        sel, bitmap = id_selector(allowed, id_bound)
+        params = search_params(idx, sel, nprobe=NPROBE, ef_search=EF_SEARCH)
+        distances, chunk_ids = idx.search(q, min(want, len(allowed)), params=params)
+        hits = _live_hits(distances, chunk_ids, ids, dead_rows, want)
+    else:
+        # Over-fetch past tombstoned hits, widening until every query has enough live ones
+        fetch = min(idx.ntotal, want + min(len(dead_rows), 4 * want))
+        while True:
+            distances, chunk_ids = idx.search(q, fetch)
+            hits = _live_hits(distances, chunk_ids, ids, dead_rows, want)
+            if fetch >= idx.ntotal or all(len(h) >= want for h in hits):
+                break
+            fetch = min(idx.ntotal, fetch * 4)
+    results = []
+    for q_row, scored_rows in zip(q, hits):
+        if rerank and scored_rows:
+            scored_rows = rerank_rows(q_row, embs, [row for _, row in scored_rows], top_k)
+        results.append(_scored_metas(scored_rows, metas, ids))
+    return results
+
+def _numpy_search(q: np.ndarray, top_k: int, allowed: np.ndarray = None) -> List[List[dict]]:
+    # Numpy Fallback (Cosine Similarity over the pre-normalized rows)
+    with _index_lock:
+        # Consistent snapshot: rows and metadata are only ever appended together
+        embs, metas, ids, dead_rows = index["embeddings"], index["metadatas"], index["ids"], _dead_rows
+        quantized = _quantized
+    m, n = len(q), len(embs)
+    rows = _rows_of(ids, allowed) if allowed is not None else None
+    if rows is not None and 2 * len(rows) < n:
+        # Selective filter: score just the candidate rows
+        scores = np.dot(q, embs[rows].T)
+        top = top_k_rows(scores, top_k)
+        return [_scored_metas(((float(scores[i, j]), int(rows[j])) for j in top[i]), metas, ids) for i in range(m)]
+    out = _score_buffer(n).reshape(1, n) if m == 1 else np.empty((m, n), dtype=np.float32)
+    if quantized is not None:
+        scores = quantized.scores(q, n, out=out)
+    else:
+        scores = np.dot(q, embs.T, out=out)
+    if rows is None:
+        scores[:, dead_rows] = -np.inf
+    else:
+        masked = np.ones(n, dtype=bool)
+        masked[rows] = False
+        scores[:, masked] = -np.inf
+    if quantized is not None and RERANK_FACTOR > 0:
+        top = top_k_rows(scores, top_k * RERANK_FACTOR)
+        return [_scored_metas(rerank_rows(q[i], embs, [r for r in top[i] if scores[i, r] > -np.inf], top_k),
+                              metas, ids) for i in range(m)]
+    top = top_k_rows(scores, top_k)
+    return [_scored_metas(((float(scores[i, r]), int(r)) for r in top[i]), metas, ids) for i in range(m)]
 
 # 4. Standard Helpers
 def format_conversation_for_ai(messages):
     """Reconstructs history string."""
-    history_str = ""
-    for msg in messages:
-        sender = msg.get("sender", "")
-        text = msg.get("text", "")
-        if sender == "user":
-            history_str += f" | Patient: {text}"
-        elif sender == "bot":
-            if "Final Medical Analysis" not in text:
-                history_str += f" | AI Question: {text}"
-    return history_str
+    return "".join(format_message(msg) for msg in messages)
 
 def format_final_report(ai_data):
     """Generates the text report for storage in DB, including RAG links."""
@@ -333,40 +1073,136 @@ def format_final_report(ai_data):
 
 # 5. API Endpoints
 
+def delete_chunks_job(job: dict, url: str = None, category: str = None) -> str:
+    """delete_chunks() as a job, for deletions forwarded by a read-only worker."""
+    return f"Deleted {delete_chunks(url=url, category=category)} chunks"
+
+# Write requests a read-only worker forwards to the writer, by job kind
+WRITE_JOBS = {
+    "ingest_url": ingest_url_job,
+    "trusted_sites": ingest_trusted_sites,
+    "compact": compact_index,
+    "delete_chunks": delete_chunks_job,
+}
+
+def _submit_write(kind: str, *args) -> dict:
+    """Runs a write job here in the writer, or forwards it to the writer from a read-only worker."""
+    if _is_writer:
+        return jobs.submit(kind, WRITE_JOBS[kind], *args)
+    return jobs.forward(kind, *args)
+
+def _run_forwarded_jobs():
+    """Writer: starts the write jobs read-only workers forward, every JOB_POLL_SECONDS."""
+    while True:
+        try:
+            jobs.run_forwarded(WRITE_JOBS)
+        except Exception as e:
+            print(f"Could not pick up forwarded jobs: {e}")
+        time.sleep(JOB_POLL_SECONDS)
+
 @app.on_event("startup")
 def startup_event():
+    global _is_writer
+    if EMBED_CACHE_FILE:
+        try:
+            print(f"✅ Loaded {query_cache.load(EMBED_CACHE_FILE)} cached query embeddings.")
+        except Exception as e:
+            print(f"Could not load query cache: {e}")
+    _is_writer = store.acquire_writer()
+    if _is_writer:
+        threading.Thread(target=_run_forwarded_jobs, daemon=True).start()
+    else:
+        print("📖 Another process owns index writes; this worker serves reads and forwards writes to it.")
+        threading.Thread(target=_follow_store, daemon=True).start()
     if not load_index():
-        print("Empty index. Run client /ingest to add data, or uncomment ingest_trusted_sites() logic.")
-        # Optional: Auto-ingest on first run
-        ingest_trusted_sites() 
+        if _is_writer:
+            # Auto-ingest on first run, in the background so the API is up immediately
+            job = jobs.submit("trusted_sites", ingest_trusted_sites)
+            print(f"Empty index. Ingesting trusted sites in background job {job['id']}.")
+        else:
+            print("Empty index. The writing worker ingests the trusted sites; they appear here as they are committed.")
     else:
         print(f"✅ Loaded RAG index with {len(index['metadatas'])} chunks.")
+    if HYBRID_SEARCH:
+        _schedule_lexical_build()  # BM25 is built in the background; retrieval is vector-only until then
+
+@app.on_event("shutdown")
+def shutdown_event():
+    jobs.shutdown()
+    if _is_writer:
+        save_faiss_index()
+    if EMBED_CACHE_FILE:
+        query_cache.save(EMBED_CACHE_FILE)
 
 @app.post("/ingest_url")
 def ingest_url_endpoint(req: IngestRequest):
-    title, text = scrape_url(req.url)
-    if not text:
-        raise HTTPException(400, "Could not extract text from URL")
-    
-    chunks = chunk_text(text)
-    embs = embed_texts(chunks)
-    metas = [{
-        "source_title": title,
-        "url": req.url,
-        "text": chunk,
-        "category": "User Ingested",
-        "ingested_at": time.time()
-    } for chunk in chunks]
-    
-    add_to_index(embs, metas)
-    save_index()
-    return {"message": f"Ingested {len(chunks)} chunks from {title}"}
+    job = _submit_write("ingest_url", req.url)
+    return {"job_id": job["id"], "status": job["status"], "message": f"Ingestion queued as job {job['id']}"}
+
+@app.post("/ingest_trusted_sites")
+def ingest_trusted_sites_endpoint():
+    job = _submit_write("trusted_sites")
+    return {"job_id": job["id"], "status": job["status"], "message": f"Ingestion queued as job {job['id']}"}
+
+@app.post("/retrieve_batch")
+async def retrieve_batch(req: RetrieveBatchRequest):
+    """Retrieves chunks for many queries at once; reports throughput in queries/second."""
+    if len(req.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(400, f"At most {MAX_BATCH_QUERIES} queries per request")
+    if not 1 <= req.top_k <= 100:
+        raise HTTPException(400, "top_k must be between 1 and 100")
+    t0 = time.perf_counter()
+    try:
+        results = await asyncio.to_thread(retrieve_many, req.queries, req.top_k, req.filters)
+    except Exception as e:
+        raise HTTPException(502, f"Embedding failed: {e}")
+    seconds = time.perf_counter() - t0
+    return {
+        "results": results,
+        "count": len(results),
+        "seconds": round(seconds, 4),
+        "queries_per_second": round(len(results) / seconds, 1) if seconds > 0 else None
+    }
+
+@app.post("/delete_chunks")
+def delete_chunks_endpoint(req: DeleteRequest):
+    """Deletes at once in the writer; a read-only worker forwards the deletion and returns its job instead."""
+    if req.url is None and req.category is None:
+        raise HTTPException(400, "Give a url and/or a category to delete")
+    if not _is_writer:
+        job = _submit_write("delete_chunks", req.url, req.category)
+        return {"job_id": job["id"], "status": job["status"], "message": f"Deletion queued as job {job['id']}"}
+    deleted = delete_chunks(url=req.url, category=req.category)
+    return {"deleted": deleted, "tombstones": len(tombstones), "compaction_job_id": _compaction_job_id}
+
+@app.post("/compact")
+def compact_endpoint():
+    job = _submit_write("compact")
+    return {"job_id": job["id"], "status": job["status"], "message": f"Compaction queued as job {job['id']}"}
+
+@app.get("/jobs")
+def list_jobs():
+    return jobs.list()
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(404, "Job not found")
+    return job
 
 @app.get("/index_info")
 def get_index_info():
     return {
-        "num_chunks": len(index["metadatas"]),
-        "has_faiss": _HAS_FAISS
+        "num_chunks": len(index["metadatas"]) - len(_dead_rows),
+        "has_faiss": _HAS_FAISS,
+        "index_kind": index_kind_of(faiss_index) if faiss_index is not None else None,
+        "precision": (index_precision_of(faiss_index) if faiss_index is not None
+                      else _quantized.precision if _quantized is not None else "float32"),
+        "num_sources": len(sources),
+        "tombstones": len(tombstones),
+        "lexical_index": len(_bm25) if _bm25 is not None else None,
+        "query_cache": query_cache.stats()
     }
 
 
@@ -374,57 +1210,16 @@ def get_index_info():
 # ... (imports and setup remain the same) ...
 
 MAX_QUESTIONS_LIMIT = 5  # Set your desired limit here
-
-@app.post("/chat_step")
-def chat_step(req: ChatRequest):
-    """Main Handler: RAG Retrieval + History + GPT-4 Analysis"""
-    
-    # A. Retrieve/Create Chat
-    if req.conversation_id:
-        chat = conversations_collection.find_one({"_id": ObjectId(req.conversation_id)})
-        if not chat: raise HTTPException(404, "Chat not found")
-        conversation_id = ObjectId(req.conversation_id)
-    else:
-        new_chat = {
-            "title": req.message[:30] + "...",
-            "created_at": datetime.now(),
-            "messages": []
-        }
-        res = conversations_collection.insert_one(new_chat)
-        conversation_id = res.inserted_id
-        chat = new_chat
-
-    # B. Save User Message
-    user_msg_entry = {
-        "sender": "user",
-        "text": req.message,
-        "timestamp": datetime.now().isoformat()
-    }
-    conversations_collection.update_one(
-        {"_id": conversation_id},
-        {"$push": {"messages": user_msg_entry}}
-    )
-
-    # C. RAG RETRIEVAL
-    query_text = f"{req.message} symptoms diagnosis medical"
-    retrieved_docs = retrieve(query_text, top_k=3)
-    
-    evidence_block = ""
-    if retrieved_docs:
-        evidence_texts = []
-        for r in retrieved_docs:
-            evidence_texts.append(f"Source: {r['source_title']} (Score: {r['score']:.2f})\nContent: {r['text'][:400]}...")
-        evidence_block = "\n\n=== RELEVANT MEDICAL KNOWLEDGE ===\n" + "\n---\n".join(evidence_texts) + "\n==================================\n"
-
-    # D. Build Prompt
-    # Fetch updated history to count turns
-    updated_chat = conversations_collection.find_one({"_id": conversation_id})
-    history_str = format_conversation_for_ai(updated_chat["messages"])
-
-    # --- NEW: COUNT QUESTIONS ---
-    # We count how many times the bot has spoken previously (excluding the final report if it exists)
-    bot_turn_count = len([m for m in updated_chat["messages"] if m["sender"] == "bot"])
-    
+HISTORY_WINDOW = 50  # most recent messages read back per turn
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))  # system prompt + evidence + history
+EVIDENCE_TOKEN_BUDGET = int(os.getenv("EVIDENCE_TOKEN_BUDGET", "600"))
+RECENT_MESSAGES = 6  # newest messages sent verbatim; older ones go into the rolling summary
+SUMMARY_MIN_MESSAGES = 4  # unsummarized older messages that trigger a summary refresh
+SUMMARY_MODEL = "gpt-4o-mini"
+_background_tasks = set()  # summary refreshes and streamed turns still running; keeps the tasks referenced
+
+def build_system_prompt(bot_turn_count: int) -> str:
+    """System prompt for the triage model, with the question budget for this turn."""
     # Base Instructions
     system_instructions = """You are a medical triage assistant. 
     Analyze the history and evidence. 
@@ -445,7 +1240,7 @@ def chat_step(req: ChatRequest):
         Otherwise, ask a specific follow-up question.
         """
 
-    system_prompt = f"""{system_instructions}
+    return f"""{system_instructions}
 
     RESPOND ONLY WITH VALID JSON IN THIS EXACT FORMAT (no markdown, no code blocks):
 {{
@@ -466,82 +1261,272 @@ RULES:
 - Probabilities should sum to ~1.0
 - Use the medical evidence if relevant
 - Return ONLY the JSON, nothing else"""
-    
-    user_content = f"{evidence_block}\n\nPatient History: {history_str}"
 
+def build_report_entry(ai_data: dict) -> dict:
+    """Summary of a finished consultation, stored in the user's history."""
+    # 1. Sort candidates to find top 3
+    candidates = sorted(ai_data.get("candidates", []), key=lambda x: x['probability'], reverse=True)
+
+    # 2. Prepare the strings (handle cases where we might have fewer than 3)
+    diag1 = candidates[0]['condition'] if len(candidates) > 0 else "Unknown"
+    diag2 = candidates[1]['condition'] if len(candidates) > 1 else "None"
+    diag3 = candidates[2]['condition'] if len(candidates) > 2 else "None"
+
+    # 3. Create the object structure you requested
+    return {
+        "report_date": datetime.now().isoformat(),
+        "final_diagnostic": {
+            "most_probable_diagnostic": diag1,
+            "second_most_probable": diag2,
+            "third_most_probable": diag3
+        },
+        "recommendation": ai_data.get("top_recommendation", "") # Optional: Good to have
+    }
+
+JSON_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+
+def partial_json_string(buf: str, key: str) -> Optional[str]:
+    """Decodes as much of a string field as has arrived in a partial JSON document."""
+    m = re.search(r'"%s"\s*:\s*"' % re.escape(key), buf)
+    if not m:
+        return None
+    out = []
+    i = m.end()
+    while i < len(buf):
+        c = buf[i]
+        if c == '"':
+            break
+        if c == "\\":
+            if i + 1 >= len(buf):
+                break  # escape split across chunks
+            esc = buf[i + 1]
+            if esc == "u":
+                if i + 6 > len(buf):
+                    break
+                out.append(chr(int(buf[i + 2:i + 6], 16)))
+                i += 6
+                continue
+            out.append(JSON_ESCAPES.get(esc, esc))
+            i += 2
+            continue
+        out.append(c)
+        i += 1
+    return "".join(out)
+
+async def prepare_chat_turn(req: ChatRequest):
+    """Steps A-D of a chat turn: returns (conversation_id, retrieved_docs, prompt, bot_turn_count).
+
+    prompt is assemble_prompt()'s result; prompt["messages"] goes to the model.
+    """
+    user_msg_entry = {
+        "sender": "user",
+        "text": req.message,
+        "timestamp": datetime.now().isoformat()
+    }
+
+    # A + B. Save the user message and read back the recent history in one round trip
+    if req.conversation_id:
+        save_user_msg = async_conversations.find_one_and_update(
+            {"_id": ObjectId(req.conversation_id)},
+            {"$push": {"messages": user_msg_entry}},
+            projection={"messages": {"$slice": -HISTORY_WINDOW}, "bot_turn_count": 1,
+                        "summary": 1, "summary_until": 1},
+            return_document=ReturnDocument.AFTER
+        )
+    else:
+        new_chat = {
+            "_id": ObjectId(),
+            "title": req.message[:30] + "...",
+            "created_at": datetime.now(),
+            "messages": [user_msg_entry],
+            "bot_turn_count": 0
+        }
+
+        async def create_chat():
+            await async_conversations.insert_one(new_chat)
+            return new_chat
+        save_user_msg = create_chat()
+
+    # C. RAG RETRIEVAL (runs while the message is being saved)
+    query_text = f"{req.message} symptoms diagnosis medical"
+    chat, retrieved_docs = await asyncio.gather(save_user_msg, aretrieve(query_text, top_k=3, filters=req.filters,
+                                                                         lexical_query=req.message))
+    if not chat: raise HTTPException(404, "Chat not found")
+    conversation_id = chat["_id"]
+
+    # --- NEW: COUNT QUESTIONS ---
+    # We count how many times the bot has spoken previously (excluding the final report if it exists)
+    bot_turn_count = chat.get("bot_turn_count")
+    if bot_turn_count is None:
+        # Conversations stored before the counter existed: seed it once, so turns can $inc it
+        bot_turn_count = len([m for m in chat["messages"] if m["sender"] == "bot"])
+        await async_conversations.update_one(
+            {"_id": conversation_id, "bot_turn_count": {"$exists": False}},
+            {"$set": {"bot_turn_count": bot_turn_count}}
+        )
+
+    # D. Build Prompt: this turn's evidence, the cached summary, then recent turns, within the budget
+    prompt = assemble_prompt(
+        build_system_prompt(bot_turn_count), chat["messages"], retrieved_docs,
+        summary=chat.get("summary"), summary_until=chat.get("summary_until"), budget=PROMPT_TOKEN_BUDGET,
+        evidence_budget=EVIDENCE_TOKEN_BUDGET, recent_messages=RECENT_MESSAGES
+    )
+    prompt["summary"] = chat.get("summary")
+    prompt["summary_until"] = chat.get("summary_until")
+    return conversation_id, retrieved_docs, prompt, bot_turn_count
+
+async def refresh_summary(conversation_id, summary: Optional[str], summary_until: Optional[str], messages: List[dict]):
+    """Folds messages into the conversation's rolling summary and caches it on the document.
+
+    The update only applies if no other turn has moved summary_until meanwhile.
+    """
+    transcript = format_conversation_for_ai(messages)
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            response_format={"type": "json_object"},
+        response = await async_client.chat.completions.create(
+            model=SUMMARY_MODEL,
             messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content}
+                {"role": "system", "content": "You keep a running summary of a medical triage conversation. "
+                 "Update the summary with the new messages. Keep every reported symptom, duration, severity, "
+                 "medication, relevant history and answer to a question. At most 150 words, no preamble."},
+                {"role": "user", "content": f"Current summary: {summary or '(none)'}\n\nNew messages: {transcript}"}
             ],
+            temperature=0
+        )
+        new_summary = response.choices[0].message.content.strip()
+        await async_conversations.update_one(
+            {"_id": conversation_id, "summary_until": summary_until},
+            {"$set": {"summary": new_summary, "summary_until": messages[-1].get("timestamp") or ""}}
+        )
+    except Exception as e:
+        print(f"Could not refresh conversation summary: {e}")
+
+async def finish_chat_turn(req: ChatRequest, conversation_id, retrieved_docs: List[dict],
+                           ai_data: dict, bot_turn_count: int, prompt: dict) -> dict:
+    """Steps E-F: stores the bot reply (and final report) and builds the API response.
+
+    Once enough older messages are unsummarized, also refreshes the rolling
+    summary in the background.
+    """
+    ai_data["_retrieved"] = retrieved_docs
+
+    # E. Determine Bot Response
+    if ai_data.get("next_question") == "DIAGNOSIS_COMPLETE":
+        bot_text = format_final_report(ai_data)
+        if req.user_id:
+            try:
+                # Push to MongoDB "Users" collection
+                await async_users.update_one(
+                    {"_id": ObjectId(req.user_id)},
+                    {"$push": {"previous_conversations": build_report_entry(ai_data)}}
+                )
+                print(f"✅ Saved report to user {req.user_id}")
+
+            except Exception as db_err:
+                print(f"❌ Error saving to user history: {db_err}")
+    else:
+        bot_text = ai_data.get("next_question")
+
+    # F. Save Bot Message
+    bot_msg_entry = {
+        "sender": "bot",
+        "text": bot_text,
+        "timestamp": datetime.now().isoformat(),
+        "retrieved_sources": [d['url'] for d in retrieved_docs] if retrieved_docs else []
+    }
+    await async_conversations.update_one(
+        {"_id": conversation_id},
+        {"$push": {"messages": bot_msg_entry}, "$inc": {"bot_turn_count": 1}}
+    )
+    if len(prompt["unsummarized"]) >= SUMMARY_MIN_MESSAGES:
+        task = asyncio.create_task(refresh_summary(
+            conversation_id, prompt["summary"], prompt["summary_until"], prompt["unsummarized"]))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    return {
+        "gpt_json": json.dumps(ai_data), 
+        "conversation_id": str(conversation_id)
+    }
+
+@app.post("/chat_step")
+async def chat_step(req: ChatRequest):
+    """Main Handler: RAG Retrieval + History + GPT-4 Analysis"""
+    conversation_id, retrieved_docs, prompt, bot_turn_count = await prepare_chat_turn(req)
+
+    try:
+        response = await async_client.chat.completions.create(
+            model="gpt-4o",
+            response_format={"type": "json_object"},
+            messages=prompt["messages"],
             temperature=0.3
         )
         gpt_json_str = response.choices[0].message.content
         ai_data = json.loads(gpt_json_str)
-        
-        ai_data["_retrieved"] = retrieved_docs
-
-        # E. Determine Bot Response
-        if ai_data.get("next_question") == "DIAGNOSIS_COMPLETE":
-            bot_text = format_final_report(ai_data)
-            if req.user_id:
-                try:
-                    # 1. Sort candidates to find top 3
-                    candidates = sorted(ai_data.get("candidates", []), key=lambda x: x['probability'], reverse=True)
-                    
-                    # 2. Prepare the strings (handle cases where we might have fewer than 3)
-                    diag1 = candidates[0]['condition'] if len(candidates) > 0 else "Unknown"
-                    diag2 = candidates[1]['condition'] if len(candidates) > 1 else "None"
-                    diag3 = candidates[2]['condition'] if len(candidates) > 2 else "None"
-
-                    # 3. Create the object structure you requested
-                    report_entry = {
-                        "report_date": datetime.now().isoformat(),
-                        "final_diagnostic": {
-                            "most_probable_diagnostic": diag1,
-                            "second_most_probable": diag2,
-                            "third_most_probable": diag3
-                        },
-                        "recommendation": ai_data.get("top_recommendation", "") # Optional: Good to have
-                    }
-
-                    # 4. Push to MongoDB "Users" collection
-                    users_collection.update_one(
-                        {"_id": ObjectId(req.user_id)},
-                        {"$push": {"previous_conversations": report_entry}}
-                    )
-                    print(f"✅ Saved report to user {req.user_id}")
-
-                except Exception as db_err:
-                    print(f"❌ Error saving to user history: {db_err}")
-            # ---------------------------------------
-        else:
-            bot_text = ai_data.get("next_question")
-
-        # F. Save Bot Message
-        bot_msg_entry = {
-            "sender": "bot",
-            "text": bot_text,
-            "timestamp": datetime.now().isoformat(),
-            "retrieved_sources": [d['url'] for d in retrieved_docs] if retrieved_docs else []
-        }
-        conversations_collection.update_one(
-            {"_id": conversation_id},
-            {"$push": {"messages": bot_msg_entry}}
-        )
-
-        return {
-            "gpt_json": json.dumps(ai_data), 
-            "conversation_id": str(conversation_id)
-        }
+        return await finish_chat_turn(req, conversation_id, retrieved_docs, ai_data, bot_turn_count, prompt)
 
     except Exception as e:
         print(f"Error: {e}")
         return {"error": str(e)}
 
+@app.post("/chat_step_stream")
+async def chat_step_stream(req: ChatRequest):
+    """Streaming /chat_step: NDJSON events, forwarding next_question as it is generated.
+
+    Events: {"type": "start", "conversation_id"}, then any number of
+    {"type": "delta", "next_question": <text fragment>}, then either
+    {"type": "done", "gpt_json", "conversation_id"} (same payload as /chat_step)
+    or {"type": "error", "error"}.
+    """
+    conversation_id, retrieved_docs, prompt, bot_turn_count = await prepare_chat_turn(req)
+
+    def event(payload: dict) -> str:
+        return json.dumps(payload) + "\n"
+
+    async def produce(queue: asyncio.Queue):
+        # Runs as its own task, so a client that disconnects mid-stream cancels
+        # only events(): the completion is still collected and the turn saved
+        try:
+            stream = await async_client.chat.completions.create(
+                model="gpt-4o",
+                response_format={"type": "json_object"},
+                messages=prompt["messages"],
+                temperature=0.3,
+                stream=True
+            )
+            gpt_json_str = ""
+            sent = 0
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                gpt_json_str += chunk.choices[0].delta.content
+                question = partial_json_string(gpt_json_str, "next_question")
+                # Hold back text that may still turn out to be the completion marker
+                if question is None or "DIAGNOSIS_COMPLETE".startswith(question):
+                    continue
+                if len(question) > sent:
+                    queue.put_nowait(event({"type": "delta", "next_question": question[sent:]}))
+                    sent = len(question)
+
+            ai_data = json.loads(gpt_json_str)
+            result = await finish_chat_turn(req, conversation_id, retrieved_docs, ai_data, bot_turn_count, prompt)
+            queue.put_nowait(event({"type": "done", **result}))
+        except Exception as e:
+            print(f"Error: {e}")
+            queue.put_nowait(event({"type": "error", "error": str(e)}))
+        finally:
+            queue.put_nowait(None)
+
+    async def events():
+        queue = asyncio.Queue()
+        task = asyncio.create_task(produce(queue))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        yield event({"type": "start", "conversation_id": str(conversation_id)})
+        while (line := await queue.get()) is not None:
+            yield line
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 
 
 @app.get("/conversations")
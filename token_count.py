@@ -0,0 +1,30 @@
+from functools import lru_cache
+
+# Optional tiktoken for exact token counts; ~4 characters per token otherwise
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+FALLBACK_ENCODING = "cl100k_base"  # in every tiktoken release
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str):
+    """The tiktoken encoding called name, or None if tiktoken is not installed."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except ValueError:  # tiktoken releases older than the encoding
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def count_tokens(text: str, encoding_name: str) -> int:
+    """Tokens of text under the named encoding, or an estimate without tiktoken."""
+    if not text:
+        return 0
+    encoding = get_encoding(encoding_name)
+    if encoding is not None:
+        return len(encoding.encode_ordinary(text))
+    return max(1, (len(text) + 3) // 4)